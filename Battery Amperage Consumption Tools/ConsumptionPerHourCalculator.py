@@ -1,36 +1,119 @@
 import numpy as np
 import pandas as pd
 import os
+import io
+import sys
+import math
+from concurrent.futures import ProcessPoolExecutor
 
 #directory = "C:\\Users\\phelpsa\\Desktop\\batteryconsumption\\sleep mode\\"
 directory = "C:\\Users\\phelpsa\\Desktop\\batteryconsumption\\FPS\\1262023\\CurrentRanger\\"
 newfile = "C:\\Users\\phelpsa\\Desktop\\batteryconsumption\\FPS\\1262023\\CurrentRanger\\consumptiondata2.csv"
+#Files are read in pieces of about this many bytes (cut at line ends), every piece is a task for the process pool
+CHUNK_BYTES = 32 << 20
 
-def readfiles():
+#(file, start, stop) byte ranges of about CHUNK_BYTES covering a file
+def chunkRanges(file, chunk_bytes=None):
+    chunk_bytes = chunk_bytes or CHUNK_BYTES
+    size = os.path.getsize(file)
+    return [(file, start, min(size, start + chunk_bytes)) for start in range(0, size, chunk_bytes)]
+
+#Per column kind, sum and count of non-missing values of the lines starting inside a byte range.
+#kind: 'bool' (True/False column), 'number' or 'other' (text, never averaged), like the dtype read_csv gives the column.
+#A range that cannot be read or parsed gives the error message (a str) instead, so one bad file does not stop the others.
+def chunkSums(task):
+    try:
+        return rangeSums(*task)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+
+def rangeSums(file, start, stop):
+    with open(file, 'rb') as f:
+        if start > 0:
+            ## skip the line that started in the previous range
+            f.seek(start - 1)
+            f.readline()
+        begin = f.tell()
+        if begin >= stop:
+            return []
+        data = f.read(stop - begin)
+        if not data.endswith(b'\n'):
+            data += f.readline()
+    if not data.strip():
+        return []
+    df = pd.read_csv(io.BytesIO(data), header = None)
+    sums = []
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_bool_dtype(values):
+            sums.append(('bool', float(np.count_nonzero(values.to_numpy())), len(values)))
+        elif pd.api.types.is_numeric_dtype(values):
+            values = values.to_numpy(dtype=np.float64)
+            present = ~np.isnan(values)
+            sums.append(('number', float(np.sum(values[present])), int(np.count_nonzero(present))))
+        else:
+            sums.append(('other', 0.0, 0))
+    return sums
+
+#Column means of a whole file from the sums of its ranges: the partial sums are added with math.fsum and divided by the
+#total count, so the mean does not depend on how the file was cut. A column is averaged when read_csv would read it as
+#numbers in the whole file, i.e. it has the same numeric kind in every range (a range where it is empty counts as numbers).
+def combineSums(parts):
+    columns = max((len(sums) for sums in parts), default=0)
+    means = []
+    for column in range(columns):
+        kinds = set()
+        totals = []
+        count = 0
+        for sums in parts:
+            if column < len(sums):
+                kind, total, values = sums[column]
+                kinds.add('empty' if kind == 'number' and values == 0 else kind)
+                totals.append(total)
+                count += values
+        if kinds <= {'number', 'empty'} or kinds == {'bool'}:
+            means.append(math.fsum(totals) / count if count else float('nan'))
+    return pd.Series(means, dtype=np.float64)
+
+#Average of every numeric column of every log file in directory, appended to newfile as "<means>,<file>" lines in one
+#write. The pieces of all files are summed on a pool of processes; a file that cannot be read is reported and skipped.
+def readfiles(workers=None):
     print("reading file")
-    for filename in os.listdir(directory):
-        file = directory + filename
-        with open(file, 'r') as f: # open in readonly mode
-        # do your stuff
-            df = pd.read_csv(file, header = None)
-            df2 = df.mean(axis='rows', numeric_only = True )
-            #debug 
-            #print(df2.to_string(index= False))
-            #print(file)
-            consumption = df2.to_string(index= False)
-            try:
-                g = open(newfile, 'a')
-                data = "{consumption},{file}\n".format(consumption = consumption,file = file)
-                g.write(data)
-                g.close()
-            except:
-                print("ERROR writing to file")
-                pass
-            
+    files = [directory + filename for filename in os.listdir(directory)]
+    files = [file for file in files if os.path.isfile(file) and os.path.abspath(file) != os.path.abspath(newfile)]
+    tasks = [task for file in files for task in chunkRanges(file)]
+    parts = {file: [] for file in files}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for task, sums in zip(tasks, pool.map(chunkSums, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1))))):
+            parts[task[0]].append(sums)
+    lines = []
+    for file in files:
+        errors = [sums for sums in parts[file] if isinstance(sums, str)]
+        if errors:
+            print("ERROR reading {}: {}".format(file, errors[0]))
+            continue
+        if not any(parts[file]):
+            print("ERROR no data in {}".format(file))
+            continue
+        consumption = combineSums(parts[file]).to_string(index= False)
+        lines.append("{consumption},{file}\n".format(consumption = consumption,file = file))
+    try:
+        g = open(newfile, 'a')
+        g.write("".join(lines))
+        g.close()
+    except:
+        print("ERROR writing to file")
+        pass
 
 
+#usage: python ConsumptionPerHourCalculator.py [log directory (with trailing separator)] [summary file]
 def main():
+    global directory, newfile
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    if len(sys.argv) > 2:
+        newfile = sys.argv[2]
     readfiles()
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
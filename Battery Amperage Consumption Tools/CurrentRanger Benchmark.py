@@ -0,0 +1,290 @@
+#CurrentRanger stream benchmark
+#Replays a synthetic USB logging stream through the original per-sample loop, through StreamDecoder
+#and the threaded StreamPipeline, checks that all of them produce exactly the same per-second CSV rows and reports the time each one needs.
+#Usage: python "CurrentRanger Benchmark.py" [samples per second] [seconds]
+#
+#pty mode runs CurrentRangerSimulator in a separate process and streams it through the real serial port code at
+#increasing rates, reporting samples dropped by the device or the pipeline, CPU time per sample and end-to-end latency
+#(sample leaving the simulator -> sample processed by the aggregator). Linux only.
+#Usage: python "CurrentRanger Benchmark.py" pty [seconds per rate] [samples per second ...]
+
+import os
+import sys
+import time
+import logging
+import datetime
+import tempfile
+import subprocess
+import numpy as np
+from CurrentRangerStream import READ_CHUNK, HourlyWriter, StreamDecoder, StreamPipeline, formatRow, startLogging, reenableLogging
+
+PTY_RATES = [1000, 5000, 10000, 20000, 50000, 100000, 200000]
+
+#Synthetic stream: idle current with noise, a solenoid pulse every 2.5 seconds, a few banners and malformed lines
+def synthetic_stream(rate, seconds, seed=1):
+    rng = np.random.default_rng(seed)
+    n = rate * seconds
+    current = 0.0005 + rng.normal(0, 0.0001, n)
+    pulse_width = max(8, rate // 100)
+    for pulse_start in range(rate, n, int(rate * 2.5)):
+        current[pulse_start:pulse_start + pulse_width] = 0.35 + rng.normal(0, 0.01, pulse_width)[:n - pulse_start]
+    lines = ["{:.9f}".format(value) for value in current.tolist()]
+    for position in range(rate // 2, n, rate * 7):
+        lines[position] = "USB_LOGGING_ENABLED"
+    for position in range(rate // 3, n, rate * 11):
+        lines[position] = "1.2.3"
+    return ("\r\n".join(lines) + "\r\n").encode("ascii"), n
+
+#Clock that only moves when data is read, so both loops see identical timestamps for identical bytes
+class ReplayClock:
+    def __init__(self, bytes_per_second):
+        self.start = datetime.datetime(2022, 12, 11, 10, 0, 0, 250000)
+        self.bytes_per_second = bytes_per_second
+        self.position = 0
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.position / self.bytes_per_second)
+
+#Stands in for serial.Serial, hands the stream out in uneven chunks of at most 4096 bytes
+class ReplaySerial:
+    def __init__(self, data, clock):
+        self.data = memoryview(data)
+        self.clock = clock
+        self.position = 0
+        self.sizes = [4096, 1500, 333, 4096, 64, 2048, 4096, 777]
+        self.reads = 0
+
+    @property
+    def in_waiting(self):
+        return self.sizes[self.reads % len(self.sizes)]
+
+    def read(self, n):
+        if self.position >= len(self.data):
+            raise EOFError
+        chunk = bytes(self.data[self.position:self.position + n])
+        self.position += len(chunk)
+        self.reads += 1
+        self.clock.position = self.position
+        return chunk
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+#The streaming loop as it was before StreamDecoder (solenoid_counter initialised, file output replaced by a list).
+#It gets stuck after a second without samples (SecondAggregator starts a new window there); the synthetic stream has
+#samples in every second, so the rows still compare.
+def original_loop(connection, clock):
+    rows = []
+    solenoid_counter = 0
+    solenoid_activated = False
+    device_data = bytearray()
+    amperage = 0.0000000000
+    sampling = 0
+    previousSampleTime = clock.now()
+    while True:
+        try:
+            ts = clock.now()
+            chunk_len = device_data.find(b"\n")
+            if chunk_len >= 0:
+                line = device_data[:chunk_len]
+                device_data = device_data[chunk_len+1:]
+            else:
+                line = None
+                while line == None:
+                    chunk_len = max(1, min(4096, connection.in_waiting))
+                    chunk = connection.read(chunk_len)
+                    chunk_len = chunk.find(b"\n")
+                    if chunk_len >= 0:
+                        line = device_data + chunk[:chunk_len]
+                        device_data[0:] = chunk[chunk_len+1:]
+                    else:
+                        device_data.extend(chunk)
+            line = line.decode(encoding="ascii", errors="strict")
+            if (line.startswith("USB_LOGGING")):
+                continue
+            data = float(line)
+            now = clock.now()
+            if now.second == previousSampleTime.second:
+                if data >= (.250):
+                    solenoid_counter += 1
+                else:
+                    if solenoid_counter > 0:
+                        solenoid_counter -= 1
+                if solenoid_counter == 5:
+                    solenoid_activated = True
+                    solenoid_counter = 0
+                amperage = amperage + float(data)
+                sampling = sampling + 1
+            else:
+                try:
+                    avgAmperage = float(amperage / sampling)
+                    rows.append("{ts_start},{ts_stop},{avgAmerage_perSamples},{solenoid_bool}\n".format(ts_start = previousSampleTime, ts_stop = now ,avgAmerage_perSamples = avgAmperage, solenoid_bool = solenoid_activated))
+                    previousSampleTime = clock.now()
+                    sampling = 0
+                    amperage = 0.0000000000
+                    solenoid_activated = False
+                except:
+                    pass
+        except ValueError:
+            pass
+        except EOFError:
+            return rows
+
+def decoder_loop(connection, clock):
+    rows = []
+    decoder = StreamDecoder(clock=clock.now)
+    while True:
+        try:
+            rows.extend(formatRow(row) for row in decoder.readFrom(connection))
+        except EOFError:
+            return rows, decoder
+
+#Collects the rows the pipeline writer thread would have appended to the hourly files
+class ListWriter:
+    def __init__(self):
+        self.name = "memory"
+        self.lines = []
+
+    def write(self, rows):
+        self.lines.extend(formatRow(row) for row in rows)
+
+    def close(self):
+        pass
+
+#Reader side of the threaded pipeline; queues are sized so nothing is dropped and the rows can be compared
+def pipeline_loop(connection, clock):
+    writer = ListWriter()
+    pipeline = StreamPipeline(writer, clock=clock.now, chunk_queue_depth=0, flush_interval=0.05, stats_interval=3600)
+    pipeline.start()
+    while True:
+        try:
+            chunk = connection.read(max(1, min(4096, connection.in_waiting)))
+        except EOFError:
+            break
+        pipeline.putChunk(chunk, clock.now())
+    pipeline.stop()
+    return writer.lines, pipeline
+
+def run(loop, data, bytes_per_second):
+    clock = ReplayClock(bytes_per_second)
+    connection = ReplaySerial(data, clock)
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    result = loop(connection, clock)
+    return result, time.perf_counter() - started, time.process_time() - cpu_started
+
+#Pipeline sink remembering how many samples the aggregator had processed at what time
+class LatencySink:
+    def __init__(self):
+        self.count = 0
+        self.marks = []
+
+    def add(self, values, times_ns, now, gap=False):
+        self.count += len(values)
+        self.marks.append((self.count, time.monotonic_ns()))
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+#Stream the simulator at one rate for the given time through serial.Serial + StreamPipeline, like the logger does
+def pty_run(rate, seconds, directory):
+    import serial
+    log_path = os.path.join(directory, "emission {}.npy".format(rate))
+    simulator_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CurrentRangerSimulator.py")
+    simulator = subprocess.Popen([sys.executable, simulator_script, str(rate), str(seconds), log_path], stdout=subprocess.PIPE, text=True)
+    port = simulator.stdout.readline().strip()
+    connection = serial.Serial(port, 9600, timeout=0.2)
+    latency = LatencySink()
+    pipeline = StreamPipeline(HourlyWriter(directory + os.sep, "bench {}".format(rate)), sinks=[latency], stats_interval=3600,
+                              on_banner=lambda banner: reenableLogging(connection, banner))
+    cpu_started = time.process_time()
+    startLogging(connection)
+    pipeline.start()
+    while simulator.poll() is None:
+        try:
+            chunk = connection.read(max(1, min(READ_CHUNK, connection.in_waiting)))
+        except serial.SerialException:
+            break
+        if chunk:
+            pipeline.putChunk(chunk, datetime.datetime.now())
+    pipeline.stop()
+    cpu = time.process_time() - cpu_started
+    device_summary = simulator.stdout.read().split()
+    simulator.wait()
+    connection.close()
+
+    emission = np.load(log_path)
+    delivered = int(emission[-1, 0])
+    device_dropped = int(device_summary[device_summary.index("dropped") + 1])
+    stats = pipeline.stats()
+    received = stats['samples']
+    marks = np.array(latency.marks or [(0, 0)], dtype=np.int64)
+    marks = marks[(marks[:, 0] > 0) & (marks[:, 0] <= delivered)]
+    if len(marks):
+        emitted_at = emission[np.minimum(np.searchsorted(emission[:, 0], marks[:, 0]), len(emission) - 1), 1]
+        latency_ms = (marks[:, 1] - emitted_at) / 1e6
+    else:
+        latency_ms = np.zeros(1)
+    return {
+        'rate': rate, 'delivered': delivered, 'received': received, 'device_dropped': device_dropped,
+        'pipeline_dropped': stats['dropped_chunks'], 'cpu_us': cpu / max(1, received) * 1e6,
+        'p50_ms': float(np.percentile(latency_ms, 50)), 'p99_ms': float(np.percentile(latency_ms, 99)), 'max_ms': float(np.max(latency_ms)),
+        'ok': device_dropped == 0 and stats['dropped_chunks'] == 0 and received == delivered,
+    }
+
+def pty_main(arguments):
+    seconds = float(arguments[0]) if arguments else 5
+    rates = [int(rate) for rate in arguments[1:]] or PTY_RATES
+    print("{:>9} {:>10} {:>10} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8}".format(
+        "rate", "delivered", "received", "dev drop", "pipe drop", "us CPU", "p50 ms", "p99 ms", "max ms"))
+    sustained = None
+    with tempfile.TemporaryDirectory() as directory:
+        for rate in rates:
+            result = pty_run(rate, seconds, directory)
+            print("{rate:>9} {delivered:>10} {received:>10} {device_dropped:>9} {pipeline_dropped:>9} {cpu_us:>9.2f} "
+                  "{p50_ms:>8.2f} {p99_ms:>8.2f} {max_ms:>8.2f}  {status}".format(status="OK" if result['ok'] else "DROPS", **result))
+            if result['ok']:
+                sustained = result
+    if sustained == None:
+        print("No rate was sustained without dropping samples")
+    else:
+        print("Maximum sustained rate: {rate} samples/s at {cpu_us:.2f} us CPU/sample, p99 latency {p99_ms:.2f} ms".format(**sustained))
+
+def main():
+    #the synthetic streams contain malformed lines on purpose, keep their error messages out of the results
+    logging.disable(logging.ERROR)
+    if len(sys.argv) > 1 and sys.argv[1] == 'pty':
+        pty_main(sys.argv[2:])
+        return
+    sample_rate = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    duration = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    data, samples = synthetic_stream(sample_rate, duration)
+    bytes_per_second = len(data) / duration
+    print("Stream: {} samples at {} samples/s, {} bytes".format(samples, sample_rate, len(data)))
+
+    original_rows, original_wall, original_cpu = run(original_loop, data, bytes_per_second)
+    (decoder_rows, decoder), decoder_wall, decoder_cpu = run(decoder_loop, data, bytes_per_second)
+    (pipeline_rows, pipeline), pipeline_wall, pipeline_cpu = run(pipeline_loop, data, bytes_per_second)
+
+    if original_rows != decoder_rows:
+        for index, (expected, got) in enumerate(zip(original_rows, decoder_rows)):
+            if expected != got:
+                print("Row {} differs:\n  original: {}  decoder:  {}".format(index, expected, got))
+                break
+        sys.exit("FAIL: {} original rows, {} decoder rows".format(len(original_rows), len(decoder_rows)))
+    if pipeline_rows != decoder_rows:
+        sys.exit("FAIL: pipeline wrote {} rows, expected {}".format(len(pipeline_rows), len(decoder_rows)))
+    print("Rows identical: {} per-second rows, {} solenoid activations, {} invalid lines".format(len(decoder_rows), sum(row.endswith("True\n") for row in decoder_rows), decoder.error_count))
+
+    for label, wall, cpu in (("original loop", original_wall, original_cpu), ("StreamDecoder", decoder_wall, decoder_cpu), ("StreamPipeline", pipeline_wall, pipeline_cpu)):
+        print("{:14} {:8.3f} s  {:12.0f} samples/s  {:7.3f} us CPU/sample".format(label, wall, samples / wall, cpu / samples * 1e6))
+    print("Speedup: {:.1f}x".format(original_wall / decoder_wall))
+    print("Pipeline: " + pipeline.statsLine())
+
+if __name__ == '__main__':
+    main()
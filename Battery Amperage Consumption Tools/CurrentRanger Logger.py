@@ -1,3 +1,5 @@
+#Usage: python "CurrentRanger Logger.py" <device> <com port> <output path> [raw] [trigger]
+#       python "CurrentRanger Logger.py" multi <output path> <device>=<com port> [<device>=<com port> ...] [raw] [trigger]
 #Revision 2.0 (12/11/2022) - Removed hard coding of device naming(argument one), com port(argument two), output file path(argument three). 
 ####Added command line arguments for improved overall system functionality when being paired with the automated test station.
 ###Solenoid activations per every second are now counted, solenoid pulse must exceed 200mA to be valid.
@@ -7,17 +9,45 @@ import time
 import serial
 import datetime
 import logging
-import numpy as np
 from threading import Thread
 import os
+import asyncio
+from CurrentRangerStream import READ_CHUNK, HourlyWriter, StreamPipeline, startLogging, reenableLogging, stopLogging
+from CurrentRangerSupervisor import superviseDevices
+from CurrentRangerRaw import RawRecorder, RawWriter
+from CurrentRangerTrigger import EventWriter, TriggerRecorder
 
 #CSV name (make sure to end with .csv to open in excel)
 output_type = '.csv'
-device = sys.argv[1]
-comport = sys.argv[2]
-output_path = sys.argv[3] + '\\CurrentRanger\\'
-logfile_dir = sys.argv[3] + '\\CurrentRanger\\Logging\\'
+#'multi' runs several CurrentRangers from one process: multi <output path> <device>=<com port> ... [raw] [trigger]
+multi_mode = len(sys.argv) > 1 and sys.argv[1] == 'multi'
+if multi_mode:
+    base_path = sys.argv[2]
+    devices = [tuple(argument.split('=', 1)) for argument in sys.argv[3:] if '=' in argument]
+    options = [argument for argument in sys.argv[3:] if '=' not in argument]
+else:
+    device = sys.argv[1]
+    comport = sys.argv[2]
+    base_path = sys.argv[3]
+    options = sys.argv[4:]
+output_path = base_path + '\\CurrentRanger\\'
+logfile_dir = base_path + '\\CurrentRanger\\Logging\\'
 logfile = logfile_dir+'CurrentRanger.log'
+#Optional arguments after the output path: 'raw' also stores every sample in hourly binary files under CurrentRanger\Raw,
+#'trigger' stores a window of samples around every solenoid pulse under CurrentRanger\Events
+raw_mode = 'raw' in options
+raw_path = output_path + 'Raw\\'
+trigger_mode = 'trigger' in options
+events_path = output_path + 'Events\\'
+
+#Per-sample consumers for one device's pipeline, depending on the optional arguments
+def makeSinks(device):
+    sinks = []
+    if raw_mode:
+        sinks.append(RawRecorder(RawWriter(raw_path, device)))
+    if trigger_mode:
+        sinks.append(TriggerRecorder(EventWriter(events_path, device)))
+    return sinks
 
 class CurrentRanger:
     def __init__(self):
@@ -26,8 +56,7 @@ class CurrentRanger:
         self.baud = 9600
         self.thread = None
         self.serialConnection = None
-        self.sample_count = 0
-        self.solenoid_activated = False
+        self.pipeline = None
 
     def serialStart(self):
         try:
@@ -65,137 +94,44 @@ class CurrentRanger:
             print("OK\n")
             return True
 
+    #Samples parsed so far by the aggregator thread
+    @property
+    def sample_count(self) -> int:
+        return self.pipeline.decoder.sample_count if self.pipeline != None else 0
+
+    #Reader thread: only drains the port into the pipeline, parsing and file output happen on the pipeline threads
     def serialStream(self):
-        #Write to CurrrentRanger to turn on bias reading first to ensure autoranging is always enabled
-        self.serialConnection.write(b'5\n')
-        self.serialConnection.write(b'6\n')
+        startLogging(self.serialConnection)
+        self.dataStartTS = datetime.datetime.now()
 
-        #Write to Current ranger to enable USB logging
-        self.serialConnection.write(b'u\n')
+        self.pipeline = StreamPipeline(HourlyWriter(output_path, device, output_type), sinks=makeSinks(device),
+                                       on_banner=lambda banner: reenableLogging(self.serialConnection, banner))
+        self.pipeline.start()
 
-        self.serialConnection.reset_input_buffer()
-        self.sample_count = 0
-        line_count = 0
-        error_count = 0
-        self.dataStartTS = datetime.datetime.now()
+        logging.info("Starting USB streaming loop")
 
-        # data timeout threshold (seconds) - bails out of no samples received
-        data_timeout_ths = 0.5
+        try:
+            while (self.stream_data and not self.pipeline.aborted):
 
-        line = None
-        device_data = bytearray()
+                try:
+                    chunk = self.serialConnection.read(max(1, min(READ_CHUNK, self.serialConnection.in_waiting)))
+                    if chunk:
+                        self.pipeline.putChunk(chunk, datetime.datetime.now())
 
-        logging.info("Starting USB streaming loop")
+                except KeyboardInterrupt:
+                    logging.info('Terminated by user')
+                    break
 
-        amperage = 0.0000000000
-        sampling = 0
-        previousSampleTime = datetime.datetime.now()
-        sampleTS = datetime.datetime.now()
-
-        while (self.stream_data):
-
-            try:
-                # get the timestamp before the data string, likely to align better with the actual reading
-                ts = datetime.datetime.now()
-
-                chunk_len = device_data.find(b"\n")
-                if chunk_len >= 0:
-                    line = device_data[:chunk_len]
-                    device_data = device_data[chunk_len+1:]
-                else:
-                    line = None
-                    while line == None and self.stream_data:
-                        chunk_len = max(1, min(4096, self.serialConnection.in_waiting))
-                        chunk = self.serialConnection.read(chunk_len)
-                        chunk_len = chunk.find(b"\n")
-                        if chunk_len >= 0:
-                            line = device_data + chunk[:chunk_len]
-                            device_data[0:] = chunk[chunk_len+1:]
-                        else:
-                            device_data.extend(chunk)
-
-                if line == None:
-                    continue
-
-                line = line.decode(encoding="ascii", errors="strict")
-
-                if (line.startswith("USB_LOGGING")):
-                    if (line.startswith("USB_LOGGING_DISABLED")):
-                        # must have been left open by a different process/instance
-                        logging.info("CR USB Logging was disabled. Re-enabling")
-                        self.serialConnection.write(b'u')
-                        self.serialConnection.flush()
-                    continue
-
-                data = float(line)
-                self.sample_count += 1
-                line_count += 1
-
-
-                #Collect amperage per "sample" and write to file after one second of sampling
-                now = datetime.datetime.now()
-                if now.second == previousSampleTime.second:
-                    #if sampling == 0:
-                    #    sampleTS = datetime.datetime.now()
-                    if data >= (.250):
-                        self.solenoid_counter += 1
-                    else:
-                        if self.solenoid_counter > 0:
-                            self.solenoid_counter -= 1
-                    if self.solenoid_counter == 5:
-                        self.solenoid_activated = True
-                        self.solenoid_counter = 0
-                    amperage = amperage + float(data)
-                    sampling = sampling + 1
-                else:
-                    try:
-                        
-                        avgAmperage = float(amperage / sampling)
-                        #print(avgAmperage)
-                        #print(sampling)
-                        name = output_path + device + " - {date}".format(date = now.strftime("%Y%m%d%H")) + output_type
-                        f = open(name, 'a')
-                        #data = "{ts_start},{ts_stop},{avgAmerage_perSamples},{numberOfSamples}\n".format(ts_start = previousSampleTime, ts_stop = now ,avgAmerage_perSamples = avgAmperage,numberOfSamples = sampling)
-                        data = "{ts_start},{ts_stop},{avgAmerage_perSamples},{solenoid_bool}\n".format(ts_start = previousSampleTime, ts_stop = now ,avgAmerage_perSamples = avgAmperage, solenoid_bool = self.solenoid_activated)
-                        f.write(data)
-                        f.close()
-                        self.solenoid_activated = False
-                        previousSampleTime = datetime.datetime.now()
-                        sampling = 0
-                        amperage = 0.0000000000
-                        self.solenoid_activated = False
-                    except:
-                        pass
-                
-            except KeyboardInterrupt:
-                logging.info('Terminated by user')
-                break
-
-            except ValueError:
-                logging.error("Invalid data format: '{}': {}".format(line, sys.exc_info()))
-                error_count += 1
-                last_sample = (np.datetime64(datetime.now()) - (self.timestamps[-1] if self.sample_count else np.datetime64(datetime.now())))/np.timedelta64(1, 's')
-                if (error_count > 100) and  last_sample > data_timeout_ths:
-                    logging.error("Aborting. Error rate is too high {} errors, last valid sample received {} seconds ago".format(error_count, last_sample))
+                except serial.SerialException as e:
+                    logging.error('Serial read error: {}: {}'.format(e.strerror, sys.exc_info()))
                     self.stream_data = False
                     break
-                pass
+        finally:
+            #rows already read are still written, whatever stopped the loop
+            self.pipeline.stop()
+            self.stream_data = False
 
-            except serial.SerialException as e:
-                logging.error('Serial read error: {}: {}'.format(e.strerror, sys.exc_info()))
-                self.stream_data = False
-                break
-
-        self.stream_data = False
-
-        # stop streaming so the device shuts down if in auto mode
-        logging.info('Telling CR to stop USB streaming')
-        
-        try:
-            # this will throw if the device has failed.disconnected already
-            self.serialConnection.write(b'u')
-        except:
-            logging.warning('Was not able to clean disconnect from the device')
+        stopLogging(self.serialConnection)
 
         logging.info('Serial streaming terminated')
 
@@ -211,6 +147,17 @@ class CurrentRanger:
         logging.info("Connection closed.")
 
 def main():
+    if multi_mode:
+        try:
+            os.makedirs(logfile_dir, exist_ok=True)
+        except OSError:
+            pass
+        logging.basicConfig()
+        try:
+            asyncio.run(superviseDevices(devices, output_path, output_type, makeSinks))
+        except KeyboardInterrupt:
+            print("Program terminated due to Keyboard Interrupt")
+        return
     CR = CurrentRanger()
     CR.serialStart()
     try:
@@ -0,0 +1,150 @@
+#Full rate raw sample storage for the CurrentRanger logger.
+#Every sample is stored as an 8 byte record (uint32 microseconds since the file was opened + float32 amps) after a
+#64 byte header, one append-only file per device per hour. Files can be memory mapped with readRaw().
+
+import os
+import queue
+import time
+import logging
+from threading import Thread
+import numpy as np
+
+RAW_MAGIC = b'CRRAW001'
+RAW_HEADER_SIZE = 64
+#base_monotonic_ns: time.monotonic_ns() at t_us == 0, base_epoch_ns: wall clock (ns since 1970) at the same instant
+RAW_HEADER = np.dtype([('magic', 'S8'), ('base_monotonic_ns', '<i8'), ('base_epoch_ns', '<i8'), ('reserved', 'V40')])
+RAW_SAMPLE = np.dtype([('t_us', '<u4'), ('amps', '<f4')])
+raw_type = '.crraw'
+
+#Per-sample monotonic timestamps for n samples whose lines completed between two reads.
+#The serial port only tells us when a chunk arrived, so the samples are spread evenly over the gap since the previous chunk.
+def sampleTimes(previous_ns, now_ns, n):
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    if previous_ns is None or previous_ns >= now_ns:
+        return np.full(n, now_ns, dtype=np.int64)
+    return now_ns - ((np.arange(n - 1, -1, -1, dtype=np.int64) * (now_ns - previous_ns)) // n)
+
+#Append-only hourly raw files: "<device> - YYYYMMDDHH.crraw". If the file for the hour already exists
+#(logger restarted) a new part "<device> - YYYYMMDDHH_2.crraw" is started, since its time base belongs to the old process.
+class RawWriter:
+    def __init__(self, output_path, device):
+        self.output_path = output_path
+        self.device = device
+        self.hour = None
+        self.name = None
+        self.file = None
+        self.base_ns = 0
+        self.samples_written = 0
+
+    #first_ns / last_ns: monotonic time of the first sample and of the chunk arrival (now)
+    def open(self, now, first_ns, last_ns):
+        self.close()
+        try:
+            os.makedirs(self.output_path, exist_ok=True)
+        except OSError:
+            pass
+        hour = now.strftime("%Y%m%d%H")
+        name = self.output_path + self.device + " - " + hour + raw_type
+        part = 1
+        while os.path.exists(name):
+            part += 1
+            name = self.output_path + self.device + " - " + hour + "_{}".format(part) + raw_type
+        header = np.zeros(1, dtype=RAW_HEADER)
+        header['magic'] = RAW_MAGIC
+        header['base_monotonic_ns'] = first_ns
+        header['base_epoch_ns'] = int(now.timestamp() * 1e9) - (last_ns - first_ns)
+        self.file = open(name, 'ab', buffering=1 << 20)
+        self.file.write(header.tobytes())
+        self.name = name
+        self.hour = hour
+        self.base_ns = first_ns
+
+    #values (amps) with their monotonic timestamps (ns); now is the wall clock time of the chunk and picks the hourly file
+    def write(self, values, times_ns, now):
+        if len(values) == 0:
+            return
+        if self.file == None or now.strftime("%Y%m%d%H") != self.hour:
+            self.open(now, int(times_ns[0]), int(times_ns[-1]))
+        records = np.empty(len(values), dtype=RAW_SAMPLE)
+        records['t_us'] = (np.asarray(times_ns) - self.base_ns) // 1000
+        records['amps'] = values
+        self.file.write(records.tobytes())
+        self.samples_written += len(values)
+
+    def flush(self):
+        if self.file != None:
+            self.file.flush()
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+        self.file = None
+        self.hour = None
+
+#Runs a RawWriter on its own thread so a slow disk never holds up the aggregator.
+#Samples are queued per chunk; when the queue is full the chunk is dropped and counted.
+class RawRecorder:
+    def __init__(self, writer, queue_depth=1024, flush_interval=1.0):
+        self.writer = writer
+        self.blocks = queue.Queue(maxsize=queue_depth)
+        self.flush_interval = flush_interval
+        self.dropped_samples = 0
+        self.write_errors = 0
+        self.thread = Thread(target=self.run, name="CR raw writer")
+        self.thread.start()
+
+    #gap (samples dropped before this chunk) needs no handling, the timestamps of the stored samples show it
+    def add(self, values, times_ns, now, gap=False):
+        if len(values) == 0:
+            return
+        try:
+            self.blocks.put_nowait((values, times_ns, now))
+        except queue.Full:
+            self.dropped_samples += len(values)
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self.blocks.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                try:
+                    self.writer.write(*item)
+                except OSError as e:
+                    self.write_errors += 1
+                    self.dropped_samples += len(item[0])
+                    logging.error("ERROR writing raw samples to {}: {}".format(self.writer.name, e))
+                    self.writer.close()
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.writer.flush()
+                last_flush = time.monotonic()
+        self.writer.close()
+
+    def stats(self) -> dict:
+        return {'raw_queue_depth': self.blocks.qsize(), 'raw_samples': self.writer.samples_written,
+                'raw_dropped_samples': self.dropped_samples, 'raw_write_errors': self.write_errors}
+
+    def close(self):
+        self.blocks.put(None)
+        self.thread.join()
+
+#Memory map a raw file. Returns the header (dict) and a read-only structured array with fields t_us and amps.
+#A file that is still being written can be mapped, a trailing partial record is ignored.
+def readRaw(path):
+    header = np.fromfile(path, dtype=RAW_HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] != RAW_MAGIC:
+        raise ValueError("{} is not a CurrentRanger raw file".format(path))
+    count = (os.path.getsize(path) - RAW_HEADER_SIZE) // RAW_SAMPLE.itemsize
+    info = {'base_monotonic_ns': int(header['base_monotonic_ns'][0]), 'base_epoch_ns': int(header['base_epoch_ns'][0]), 'samples': count}
+    if count == 0:
+        return info, np.empty(0, dtype=RAW_SAMPLE)
+    return info, np.memmap(path, dtype=RAW_SAMPLE, mode='r', offset=RAW_HEADER_SIZE, shape=(count,))
+
+#Wall clock time of every sample as numpy datetime64[ns]
+def rawTimestamps(info, samples):
+    return (info['base_epoch_ns'] + samples['t_us'].astype(np.int64) * 1000).astype('datetime64[ns]')
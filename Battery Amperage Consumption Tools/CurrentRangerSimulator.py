@@ -0,0 +1,177 @@
+#CurrentRanger simulator on a Linux pseudo terminal.
+#Answers the 5/6/u commands the logger sends, prints the USB_LOGGING_* banners and streams current readings at a
+#configurable rate with synthetic solenoid pulses and the occasional malformed line.
+#Like the real device it has a limited transmit buffer: samples that do not fit because the host is not reading
+#fast enough are dropped and counted.
+#Usage: python CurrentRangerSimulator.py [samples per second] [seconds] [emission log .npy]
+#The pty path is printed on the first line of stdout, e.g. python "CurrentRanger Logger.py" sim /dev/pts/3 /tmp
+
+import os
+import sys
+import tty
+import time
+import select
+from threading import Thread, Lock
+import numpy as np
+
+class CurrentRangerSimulator:
+    def __init__(self, rate=1000, pulse_interval=2.5, pulse_width=0.01, pulse_amps=0.35, idle_amps=0.0005,
+                 malformed_every=50000, tx_buffer=65536, tick=0.001, seed=1):
+        self.rate = rate
+        self.tx_buffer = tx_buffer
+        self.tick = tick
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.logging_enabled = False
+        self.bias = False
+        self.autorange = False
+        self.running = False
+        self.threads = []
+        #counters
+        self.emitted = 0
+        self.dropped = 0
+        self.malformed = 0
+        #(valid samples written so far, time.monotonic_ns() when the last of them left the buffer)
+        self.emission_log = []
+        #every malformed_every-th line of the stream (counted over the whole stream, not per pulse period) is malformed
+        self.malformed_every = malformed_every
+        self.lines = self.pattern(pulse_interval, pulse_width, pulse_amps, idle_amps, seed)
+        #bytes waiting for the host, shared by the command and stream threads
+        self.lock = Lock()
+        self.pending = bytearray()
+        self.pending_marks = []
+        self.written_bytes = 0
+
+    #One pulse period of pre-formatted lines, replayed in a loop
+    def pattern(self, pulse_interval, pulse_width, pulse_amps, idle_amps, seed):
+        rng = np.random.default_rng(seed)
+        period = max(1, int(self.rate * pulse_interval))
+        current = idle_amps + rng.normal(0, idle_amps * 0.2, period)
+        width = max(6, int(self.rate * pulse_width))
+        current[period // 2:period // 2 + width] = pulse_amps + rng.normal(0, 0.01, len(current[period // 2:period // 2 + width]))
+        return ["{:.9f}\r\n".format(value).encode("ascii") for value in current.tolist()]
+
+    #Line index of the stream (and whether it is a valid sample): the pattern, or the malformed line every malformed_every lines
+    def line(self, index):
+        if self.malformed_every and index % self.malformed_every == self.malformed_every // 2:
+            return b"1.2.3\r\n", False
+        return self.lines[index % len(self.lines)], True
+
+    def start(self):
+        self.running = True
+        self.threads = [Thread(target=self.commands, daemon=True), Thread(target=self.stream, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def send(self, data):
+        with self.lock:
+            self.pending.extend(data)
+        self.flushPending()
+
+    def commands(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 256)
+            except (BlockingIOError, OSError):
+                continue
+            for command in data:
+                if command == ord('5'):
+                    self.bias = True
+                elif command == ord('6'):
+                    self.autorange = True
+                elif command == ord('u'):
+                    self.logging_enabled = not self.logging_enabled
+                    self.send(b"USB_LOGGING_ENABLED\r\n" if self.logging_enabled else b"USB_LOGGING_DISABLED\r\n")
+
+    #Emit rate samples per second in small batches, keeping at most tx_buffer bytes queued
+    def stream(self):
+        position = 0
+        started = time.monotonic()
+        due = 0
+        while self.running:
+            time.sleep(self.tick)
+            if not self.logging_enabled:
+                started = time.monotonic()
+                due = 0
+                self.flushPending()
+                continue
+            target = int((time.monotonic() - started) * self.rate)
+            count = target - due
+            due = target
+            if count <= 0:
+                self.flushPending()
+                continue
+            batch = []
+            valid = 0
+            for index in range(position, position + count):
+                line, is_valid = self.line(index)
+                batch.append(line)
+                valid += is_valid
+            position += count
+            data = b"".join(batch)
+            with self.lock:
+                if len(self.pending) + len(data) > self.tx_buffer:
+                    self.dropped += valid
+                else:
+                    self.malformed += count - valid
+                    self.pending.extend(data)
+                    self.emitted += valid
+                    self.pending_marks.append((self.written_bytes + len(self.pending), self.emitted))
+            self.flushPending()
+
+    def flushPending(self):
+        with self.lock:
+            while self.pending:
+                try:
+                    written = os.write(self.master, self.pending)
+                except (BlockingIOError, OSError):
+                    return
+                if written <= 0:
+                    return
+                del self.pending[:written]
+                self.written_bytes += written
+                now = time.monotonic_ns()
+                while self.pending_marks and self.pending_marks[0][0] <= self.written_bytes:
+                    self.emission_log.append((self.pending_marks.pop(0)[1], now))
+
+def main():
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    log_path = sys.argv[3] if len(sys.argv) > 3 else None
+    simulator = CurrentRangerSimulator(rate=rate)
+    simulator.start()
+    print(simulator.port, flush=True)
+    try:
+        if seconds:
+            #run for the given time after the host has enabled logging
+            while not simulator.logging_enabled:
+                time.sleep(0.01)
+            time.sleep(seconds)
+            simulator.logging_enabled = False
+            #give the host a moment to drain the pty
+            time.sleep(0.5)
+            simulator.flushPending()
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    if log_path:
+        np.save(log_path, np.array(simulator.emission_log or [(0, 0)], dtype=np.int64))
+    print("emitted {} dropped {} malformed {}".format(simulator.emitted, simulator.dropped, simulator.malformed), flush=True)
+    simulator.stop()
+
+if __name__ == '__main__':
+    main()
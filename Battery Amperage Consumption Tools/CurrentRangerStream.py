@@ -0,0 +1,471 @@
+#Line framing and per-second aggregation for the CurrentRanger USB logging stream.
+#Kept out of "CurrentRanger Logger.py" so the benchmark can drive the exact same code path without a device.
+
+import datetime
+import logging
+import queue
+import time
+from threading import Thread
+import numpy as np
+from CurrentRangerRaw import sampleTimes
+
+#Solenoid pulse must reach this amperage on 5 consecutive (net) samples to count as an activation
+SOLENOID_THRESHOLD = .250
+SOLENOID_SAMPLES = 5
+#Largest single read() request, same as the original streaming loop
+READ_CHUNK = 4096
+
+#Preallocated receive buffer. Serial chunks are read straight into it, every complete line is handed back
+#in one block and only the trailing partial line is kept. When the write position reaches the end the partial
+#line is moved back to the start, so the buffer wraps around without ever being reallocated or resliced.
+class LineFramer:
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def pending(self) -> int:
+        return self.end - self.start
+
+    #Make room for n more bytes after the partial line
+    def reserve(self, n):
+        if self.end + n <= len(self.buffer):
+            return
+        partial = self.end - self.start
+        if partial + n > len(self.buffer):
+            #a line longer than the whole buffer, only happens with a garbage stream - grow once and carry on
+            self.view.release()
+            grown = bytearray(max(2 * len(self.buffer), partial + n))
+            grown[:partial] = self.buffer[self.start:self.end]
+            self.buffer = grown
+            self.view = memoryview(self.buffer)
+        else:
+            self.view[:partial] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = partial
+
+    #Read up to n bytes from a serial port (or any object with readinto/read) into the buffer
+    def fill(self, connection, n) -> int:
+        self.reserve(n)
+        readinto = getattr(connection, 'readinto', None)
+        if readinto is not None:
+            count = readinto(self.view[self.end:self.end + n])
+        else:
+            chunk = connection.read(n)
+            count = len(chunk)
+            self.view[self.end:self.end + count] = chunk
+        self.end += count or 0
+        return count or 0
+
+    def feed(self, chunk):
+        self.reserve(len(chunk))
+        self.view[self.end:self.end + len(chunk)] = chunk
+        self.end += len(chunk)
+
+    #Forget the partial line, used after data has been dropped and the next bytes no longer continue it
+    def discard(self):
+        self.start = self.end = 0
+
+    #Returns every complete line received so far as one newline separated block (without the final newline),
+    #or None if there is no complete line yet
+    def takeBlock(self):
+        last = self.buffer.rfind(b"\n", self.start, self.end)
+        if last < 0:
+            return None
+        block = bytes(self.view[self.start:last])
+        self.start = last + 1
+        if self.start == self.end:
+            self.start = self.end = 0
+        return block
+
+#Parse a block of lines into a float array. Status banners and lines that are not numbers are returned separately.
+#The common case (only readings) is a single fromiter call over the whole block.
+def parseBlock(block):
+    lines = block.split(b"\n")
+    if block.find(b"USB_LOGGING") < 0:
+        try:
+            return np.fromiter(map(float, lines), dtype=np.float64, count=len(lines)), [], []
+        except ValueError:
+            pass
+    values = []
+    banners = []
+    invalid = []
+    for line in lines:
+        if line.startswith(b"USB_LOGGING"):
+            banners.append(line.decode(encoding="ascii", errors="replace").strip())
+            continue
+        try:
+            values.append(float(line))
+        except ValueError:
+            invalid.append(line)
+    return np.array(values, dtype=np.float64), banners, invalid
+
+#Row format of the hourly CSV files: ts_start, ts_stop, average amperage, solenoid activated
+def formatRow(row):
+    return "{ts_start},{ts_stop},{avgAmerage_perSamples},{solenoid_bool}\n".format(ts_start = row[0], ts_stop = row[1], avgAmerage_perSamples = row[2], solenoid_bool = row[3])
+
+#Collects samples and produces one row every time the wall clock second changes.
+#Follows the original per-sample loop exactly: the sample that arrives in the new second closes the previous row
+#and is not counted, the amperage is summed sample by sample in arrival order and the solenoid counter carries
+#over between rows.
+class SecondAggregator:
+    def __init__(self, start):
+        self.previousSampleTime = start
+        self.amperage = 0.0000000000
+        self.sampling = 0
+        self.solenoid_counter = 0
+        self.solenoid_activated = False
+
+    #values all share the timestamp now; returns the list of finished rows
+    def add(self, values, now):
+        rows = []
+        if len(values) == 0:
+            return rows
+        if now.second != self.previousSampleTime.second:
+            if self.sampling:
+                rows.append((self.previousSampleTime, now, float(self.amperage / self.sampling), self.solenoid_activated))
+                self.previousSampleTime = now
+                self.sampling = 0
+                self.amperage = 0.0000000000
+                self.solenoid_activated = False
+                ## like the original loop, the sample that closes a row is not counted
+                values = values[1:]
+                if len(values) == 0:
+                    return rows
+            else:
+                #nothing collected in the window (the first samples, or the first after a silent second): it starts at
+                #these samples instead, the original loop got stuck here and dropped every later sample
+                self.previousSampleTime = now
+        self.countSolenoid(values)
+        #cumsum adds left to right, so the total is bit for bit the same as adding one sample at a time
+        self.amperage = float(np.cumsum(np.concatenate(([self.amperage], values)))[-1])
+        self.sampling += len(values)
+        return rows
+
+    def countSolenoid(self, values):
+        above = values >= SOLENOID_THRESHOLD
+        if not above.any():
+            #counter only goes down, it can never reach the activation count here
+            self.solenoid_counter = max(0, self.solenoid_counter - len(values))
+            return
+        counter = self.solenoid_counter
+        for hit in above.tolist():
+            if hit:
+                counter += 1
+            elif counter > 0:
+                counter -= 1
+            if counter == SOLENOID_SAMPLES:
+                self.solenoid_activated = True
+                counter = 0
+        self.solenoid_counter = counter
+
+#Reads the serial port one chunk at a time and turns it into per-second rows.
+#Takes one timestamp per chunk instead of two per sample; every line in a chunk arrived together anyway.
+class StreamDecoder:
+    def __init__(self, clock=datetime.datetime.now, buffer_size=65536):
+        self.clock = clock
+        self.framer = LineFramer(buffer_size)
+        self.started = clock()
+        self.aggregator = SecondAggregator(self.started)
+        self.sample_count = 0
+        self.error_count = 0
+        self.last_sample = None
+        self.values = np.empty(0, dtype=np.float64)
+        self.banners = []
+        self.invalid_lines = []
+        self.resync = False
+
+    #Read one chunk from the connection. Every sample, banner and invalid line from this chunk is left in
+    #self.values / self.banners / self.invalid_lines for the caller.
+    def readFrom(self, connection):
+        n = max(1, min(READ_CHUNK, connection.in_waiting))
+        self.framer.fill(connection, n)
+        return self.process(self.clock())
+
+    #Add a chunk that was read elsewhere (e.g. by the reader thread) and process it with its read timestamp.
+    #resync means data was dropped before this chunk: the partial line and the bytes up to the next newline are skipped.
+    def feed(self, chunk, now, resync=False):
+        if resync or self.resync:
+            self.framer.discard()
+            newline = chunk.find(b"\n")
+            self.resync = newline < 0
+            if self.resync:
+                self.values = np.empty(0, dtype=np.float64)
+                return []
+            chunk = chunk[newline+1:]
+        self.framer.feed(chunk)
+        return self.process(now)
+
+    #Process every complete line currently in the buffer with the timestamp now
+    def process(self, now):
+        block = self.framer.takeBlock()
+        if block is None:
+            self.values = np.empty(0, dtype=np.float64)
+            self.banners = []
+            self.invalid_lines = []
+            return []
+        values, self.banners, self.invalid_lines = parseBlock(block)
+        self.values = values
+        self.error_count += len(self.invalid_lines)
+        if len(values):
+            self.sample_count += len(values)
+            self.last_sample = now
+        return self.aggregator.add(values, now)
+
+    #Seconds since the last valid reading, or since the stream started if there has not been one
+    def secondsSinceSample(self) -> float:
+        last = self.last_sample if self.last_sample is not None else self.started
+        return (self.clock() - last).total_seconds()
+
+#Write to CurrrentRanger to turn on bias reading first to ensure autoranging is always enabled, then enable USB logging
+def startLogging(connection):
+    connection.write(b'5\n')
+    connection.write(b'6\n')
+    connection.write(b'u\n')
+    connection.reset_input_buffer()
+
+def reenableLogging(connection, banner):
+    if (banner.startswith("USB_LOGGING_DISABLED")):
+        # must have been left open by a different process/instance
+        logging.info("CR USB Logging was disabled. Re-enabling")
+        connection.write(b'u')
+        connection.flush()
+
+#Stop streaming so the device shuts down if in auto mode
+def stopLogging(connection):
+    logging.info('Telling CR to stop USB streaming')
+    try:
+        # this will throw if the device has failed.disconnected already
+        connection.write(b'u')
+    except:
+        logging.warning('Was not able to clean disconnect from the device')
+
+#Name of the hourly CSV file a row ending at now belongs to
+def hourlyFileName(output_path, device, now, output_type='.csv'):
+    return output_path + device + " - {date}".format(date = now.strftime("%Y%m%d%H")) + output_type
+
+#Keeps the current hourly CSV open and appends rows to it in batches, switching files when the hour changes
+class HourlyWriter:
+    def __init__(self, output_path, device, output_type='.csv'):
+        self.output_path = output_path
+        self.device = device
+        self.output_type = output_type
+        self.name = None
+        self.file = None
+
+    def write(self, rows):
+        batch = []
+        for row in rows:
+            name = hourlyFileName(self.output_path, self.device, row[1], self.output_type)
+            if name != self.name:
+                self.flushBatch(batch)
+                batch = []
+                self.open(name)
+            batch.append(formatRow(row))
+        self.flushBatch(batch)
+
+    def open(self, name):
+        self.close()
+        self.file = open(name, 'a')
+        self.name = name
+
+    def flushBatch(self, batch):
+        if batch:
+            self.file.write("".join(batch))
+            self.file.flush()
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+        self.file = None
+        self.name = None
+
+#Put the end marker on a bounded queue, giving up once the thread that reads the queue is no longer running
+def endQueue(items, thread, poll=0.1):
+    try:
+        items.put_nowait(None)
+        return
+    except queue.Full:
+        pass
+    while thread.is_alive():
+        try:
+            items.put(None, timeout=poll)
+            return
+        except queue.Full:
+            pass
+
+#Reader -> aggregator -> writer pipeline for one CurrentRanger.
+#The reader (the caller's serial thread) only hands raw chunks to putChunk, which never blocks: when the aggregator
+#falls behind the chunk is dropped and counted instead of stalling the port. The aggregator thread frames and
+#aggregates, the writer thread keeps the hourly file open and writes the rows every flush_interval seconds.
+#sinks receive every sample of every chunk as add(values, times_ns, now, gap), e.g. a RawRecorder; gap is True when
+#samples were dropped right before the chunk.
+class StreamPipeline:
+    def __init__(self, writer, clock=datetime.datetime.now, chunk_queue_depth=256, row_queue_depth=3600, flush_interval=5.0,
+                 stats_interval=60.0, on_banner=None, max_errors=100, data_timeout=0.5, sinks=(), name=""):
+        self.writer = writer
+        #prefix for log messages when several devices share one process
+        self.name = name + ": " if name else ""
+        self.sinks = list(sinks)
+        self.previous_ns = None
+        self.decoder = StreamDecoder(clock=clock)
+        self.chunks = queue.Queue(maxsize=chunk_queue_depth)
+        self.rows = queue.Queue(maxsize=row_queue_depth)
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+        self.on_banner = on_banner
+        self.max_errors = max_errors
+        self.data_timeout = data_timeout
+        self.aborted = False
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+        self.dropped_rows = 0
+        self.write_errors = 0
+        self.rows_written = 0
+        self.max_chunk_depth = 0
+        self.max_row_depth = 0
+        self.pending_resync = False
+        #exception that stopped the aggregator or writer thread, the reader stops once aborted is set
+        self.error = None
+        self.threads = []
+
+    def start(self):
+        self.threads = [Thread(target=self.aggregate, name="CR aggregator"), Thread(target=self.write, name="CR writer")]
+        for thread in self.threads:
+            thread.start()
+
+    #Called from the reader thread with each chunk and the time it was read
+    def putChunk(self, chunk, now):
+        try:
+            self.chunks.put_nowait((now, time.monotonic_ns(), chunk, self.pending_resync))
+            self.pending_resync = False
+        except queue.Full:
+            self.dropped_chunks += 1
+            self.dropped_bytes += len(chunk)
+            self.pending_resync = True
+            return
+        depth = self.chunks.qsize()
+        if depth > self.max_chunk_depth:
+            self.max_chunk_depth = depth
+
+    def aggregate(self):
+        try:
+            while True:
+                item = self.chunks.get()
+                if item is None:
+                    break
+                self.aggregateChunk(*item)
+        except Exception as e:
+            self.fail("aggregator", e)
+        finally:
+            #the writer always gets its end marker, also when the aggregator died
+            endQueue(self.rows, self.threads[1])
+
+    def aggregateChunk(self, now, now_ns, chunk, resync):
+        #samples were dropped before this chunk's first sample: this chunk follows a dropped one, or an earlier chunk
+        #after a drop had no complete line yet
+        gap = resync or self.decoder.resync
+        rows = self.decoder.feed(chunk, now, resync)
+        if self.sinks:
+            times_ns = sampleTimes(None if resync else self.previous_ns, now_ns, len(self.decoder.values))
+            for sink in self.sinks:
+                sink.add(self.decoder.values, times_ns, now, gap)
+        self.previous_ns = now_ns
+        for banner in self.decoder.banners:
+            if self.on_banner != None:
+                self.on_banner(banner)
+        if self.decoder.invalid_lines:
+            for line in self.decoder.invalid_lines:
+                logging.error(self.name + "Invalid data format: '{}'".format(line.decode(encoding="ascii", errors="replace").strip()))
+            last_sample = self.decoder.secondsSinceSample()
+            if (self.decoder.error_count > self.max_errors) and last_sample > self.data_timeout:
+                logging.error(self.name + "Aborting. Error rate is too high {} errors, last valid sample received {} seconds ago".format(self.decoder.error_count, last_sample))
+                self.aborted = True
+        for row in rows:
+            try:
+                self.rows.put_nowait(row)
+            except queue.Full:
+                self.dropped_rows += 1
+        depth = self.rows.qsize()
+        if depth > self.max_row_depth:
+            self.max_row_depth = depth
+
+    #Keep the first error of a pipeline thread and make the reader stop
+    def fail(self, stage, e):
+        logging.exception(self.name + "Pipeline {} stopped: {}".format(stage, e))
+        if self.error is None:
+            self.error = e
+        self.aborted = True
+
+    def write(self):
+        try:
+            self.writeRows()
+        except Exception as e:
+            self.fail("writer", e)
+        finally:
+            self.writer.close()
+
+    def writeRows(self):
+        last_stats = time.monotonic()
+        running = True
+        while running:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    row = self.rows.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    running = False
+                    break
+                batch.append(row)
+            if batch:
+                try:
+                    self.writer.write(batch)
+                    self.rows_written += len(batch)
+                except OSError as e:
+                    self.write_errors += 1
+                    logging.error(self.name + "ERROR writing {} rows to {}: {}".format(len(batch), self.writer.name, e))
+                    self.writer.close()
+            if time.monotonic() - last_stats >= self.stats_interval:
+                logging.info(self.statsLine())
+                last_stats = time.monotonic()
+
+    def stats(self) -> dict:
+        stats = {
+            'chunk_queue_depth': self.chunks.qsize(),
+            'chunk_queue_max': self.max_chunk_depth,
+            'row_queue_depth': self.rows.qsize(),
+            'row_queue_max': self.max_row_depth,
+            'dropped_chunks': self.dropped_chunks,
+            'dropped_bytes': self.dropped_bytes,
+            'dropped_rows': self.dropped_rows,
+            'write_errors': self.write_errors,
+            'rows_written': self.rows_written,
+            'samples': self.decoder.sample_count,
+        }
+        for sink in self.sinks:
+            stats.update(sink.stats())
+        return stats
+
+    def statsLine(self) -> str:
+        line = self.name + ("Chunk queue {chunk_queue_depth} (max {chunk_queue_max}), row queue {row_queue_depth} (max {row_queue_max}), "
+                "dropped {dropped_chunks} chunks / {dropped_bytes} bytes / {dropped_rows} rows, {write_errors} write errors, "
+                "{rows_written} rows written, {samples} samples").format(**self.stats())
+        for sink in self.sinks:
+            line += "".join(", {} {}".format(key, value) for key, value in sink.stats().items())
+        return line
+
+    #Let the aggregator and writer finish everything already queued, then stop them. Never blocks on a dead aggregator.
+    def stop(self):
+        if not self.threads:
+            return
+        endQueue(self.chunks, self.threads[0])
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for sink in self.sinks:
+            sink.close()
+        logging.info(self.statsLine())
@@ -0,0 +1,123 @@
+#Single process supervisor for several CurrentRangers.
+#Each device gets its own asyncio task that reads the port (blocking reads run on a dedicated thread pool, pyserial has
+#no asyncio support) and feeds the same StreamPipeline / HourlyWriter the single device logger uses.
+#A device that fails is closed and reconnected with backoff without touching the other devices.
+
+import asyncio
+import datetime
+import logging
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from CurrentRangerStream import READ_CHUNK, HourlyWriter, StreamPipeline, startLogging, reenableLogging, stopLogging
+
+BAUD = 9600
+#Seconds to wait before reconnecting after the 1st, 2nd, ... consecutive failure
+RETRY_DELAYS = (1, 2, 5, 10, 30)
+#Short read timeout so a cancelled task releases its port quickly
+READ_TIMEOUT = 0.5
+
+class DeviceStream:
+    def __init__(self, device, port, output_path, output_type='.csv', make_sinks=None):
+        self.device = device
+        self.port = port
+        self.output_path = output_path
+        self.output_type = output_type
+        self.make_sinks = make_sinks
+        self.connection = None
+        self.pipeline = None
+        self.failures = 0
+        self.restarts = 0
+        self.last_error = None
+
+    #Keep the device streaming until the task is cancelled
+    async def run(self, loop, executor):
+        while True:
+            try:
+                await self.stream(loop, executor)
+                self.last_error = "stream stopped"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = "{}: {}".format(type(e).__name__, e)
+            delay = RETRY_DELAYS[min(self.failures, len(RETRY_DELAYS) - 1)]
+            self.failures += 1
+            self.restarts += 1
+            logging.error("{} ({}): {}, reconnecting in {} s".format(self.device, self.port, self.last_error, delay))
+            await asyncio.sleep(delay)
+
+    async def stream(self, loop, executor):
+        logging.info("{}: connecting to port='{}' baud='{}'".format(self.device, self.port, BAUD))
+        #the open or read running on the executor; cancelling the task does not stop it
+        pending = None
+        try:
+            pending = executor.submit(self.open)
+            await asyncio.wrap_future(pending, loop=loop)
+            self.pipeline = StreamPipeline(HourlyWriter(self.output_path, self.device, self.output_type), name=self.device,
+                                           sinks=self.make_sinks(self.device) if self.make_sinks != None else (),
+                                           on_banner=lambda banner: reenableLogging(self.connection, banner))
+            self.pipeline.start()
+            while not self.pipeline.aborted:
+                pending = executor.submit(self.read)
+                chunk = await asyncio.wrap_future(pending, loop=loop)
+                if chunk:
+                    self.pipeline.putChunk(chunk, datetime.datetime.now())
+                    if self.failures and self.pipeline.decoder.sample_count:
+                        #streaming again, next failure starts the backoff from the beginning
+                        self.failures = 0
+        finally:
+            await asyncio.shield(loop.run_in_executor(executor, self.shutdown, pending))
+
+    #The port is kept in self.connection as soon as it is open, so shutdown() closes it whatever fails after that
+    def open(self):
+        self.connection = serial.Serial(self.port, BAUD, timeout=READ_TIMEOUT)
+        startLogging(self.connection)
+
+    def read(self):
+        return self.connection.read(max(1, min(READ_CHUNK, self.connection.in_waiting)))
+
+    #pending: the future of the last open() / read(). An open that is still running is waited for, a read still blocked
+    #on the port is cancelled and waited for (at most READ_TIMEOUT when the port cannot cancel reads) before the port is
+    #closed under it.
+    def shutdown(self, pending=None):
+        if pending != None and not pending.done():
+            if self.connection != None:
+                try:
+                    self.connection.cancel_read()
+                except (AttributeError, serial.SerialException):
+                    pass
+            concurrent.futures.wait([pending])
+        if self.pipeline != None:
+            self.pipeline.stop()
+            self.pipeline = None
+        if self.connection != None:
+            stopLogging(self.connection)
+            try:
+                self.connection.close()
+            except serial.SerialException:
+                pass
+            self.connection = None
+
+    def status(self) -> str:
+        state = self.pipeline.statsLine() if self.pipeline != None else "{}: not connected".format(self.device)
+        return "{} [{} restarts{}]".format(state, self.restarts, ", last error " + self.last_error if self.last_error else "")
+
+#Stream every (device, port) pair concurrently until cancelled (Ctrl+C). make_sinks(device) returns the extra
+#per-sample sinks (raw/trigger) for one device.
+async def superviseDevices(devices, output_path, output_type='.csv', make_sinks=None, status_interval=60.0):
+    loop = asyncio.get_running_loop()
+    #two workers per device: one blocked in read(), one free for open/shutdown
+    executor = ThreadPoolExecutor(max_workers=2 * max(1, len(devices)), thread_name_prefix="CR serial")
+    streams = [DeviceStream(device, port, output_path, output_type, make_sinks) for device, port in devices]
+    tasks = [asyncio.create_task(stream.run(loop, executor), name=stream.device) for stream in streams]
+    logging.info("Supervising {} CurrentRanger(s): {}".format(len(streams), ", ".join("{}={}".format(device, port) for device, port in devices)))
+    try:
+        while True:
+            await asyncio.sleep(status_interval)
+            for stream in streams:
+                logging.info(stream.status())
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        executor.shutdown(wait=True)
@@ -0,0 +1,232 @@
+#Host side trigger engine for the CurrentRanger logger.
+#Keeps the last PRE_SAMPLES samples in a rolling buffer and, on every rising edge through the solenoid threshold,
+#stores a fixed window of PRE_SAMPLES + POST_SAMPLES full rate samples together with the pulse width, peak and charge.
+#Events go to hourly binary files "<device> - YYYYMMDDHH.crtrg" that can be memory mapped with readEvents(); like the
+#raw samples they are written on their own thread, so the aggregator never waits for the disk.
+
+import os
+import queue
+import time
+import logging
+from threading import Thread
+import numpy as np
+from CurrentRangerStream import SOLENOID_THRESHOLD
+
+PRE_SAMPLES = 250
+POST_SAMPLES = 750
+EVENT_MAGIC = b'CRTRG001'
+EVENT_HEADER_SIZE = 64
+EVENT_HEADER = np.dtype([('magic', 'S8'), ('pre', '<i4'), ('post', '<i4'), ('threshold', '<f8'), ('reserved', 'V40')])
+event_type = '.crtrg'
+#Bits of the truncated field of an event: the pulse is longer than the window / samples were dropped (the pipeline
+#resynchronized) somewhere in the window, so it does not hold consecutive samples
+EVENT_TRUNCATED = 1
+EVENT_GAP = 2
+
+#One record per event. t_us is relative to the trigger sample, width_s/charge_c cover the samples from the trigger
+#to the first sample back below the threshold (or the end of the window when the pulse is longer than the window).
+#truncated holds the EVENT_TRUNCATED and EVENT_GAP bits.
+def eventRecord(pre, post):
+    window = pre + post
+    return np.dtype([('trigger_epoch_ns', '<i8'), ('width_s', '<f4'), ('peak_a', '<f4'), ('charge_c', '<f4'), ('truncated', '<u4'),
+                     ('t_us', '<i4', (window,)), ('amps', '<f4', (window,))])
+
+#Pulse metrics of one window: trigger at index pre
+def pulseMetrics(values, times_ns, pre, threshold):
+    below = np.flatnonzero(values[pre:] < threshold)
+    truncated = len(below) == 0
+    stop = len(values) - 1 if truncated else pre + int(below[0])
+    pulse = values[pre:stop + 1]
+    seconds = (times_ns[pre:stop + 1] - times_ns[pre]) / 1e9
+    width = float(seconds[-1])
+    charge = float(np.sum((pulse[1:] + pulse[:-1]) * np.diff(seconds)) / 2) if len(pulse) > 1 else 0.0
+    return width, float(np.max(pulse)), charge, truncated
+
+class EventWriter:
+    def __init__(self, output_path, device, pre=PRE_SAMPLES, post=POST_SAMPLES, threshold=SOLENOID_THRESHOLD):
+        self.output_path = output_path
+        self.device = device
+        self.pre = pre
+        self.post = post
+        self.threshold = threshold
+        self.record = eventRecord(pre, post)
+        self.hour = None
+        self.name = None
+        self.file = None
+
+    def open(self, now):
+        self.close()
+        try:
+            os.makedirs(self.output_path, exist_ok=True)
+        except OSError:
+            pass
+        hour = now.strftime("%Y%m%d%H")
+        name = self.output_path + self.device + " - " + hour + event_type
+        part = 1
+        #an existing file may have been written with a different window size
+        while os.path.exists(name):
+            part += 1
+            name = self.output_path + self.device + " - " + hour + "_{}".format(part) + event_type
+        header = np.zeros(1, dtype=EVENT_HEADER)
+        header['magic'] = EVENT_MAGIC
+        header['pre'] = self.pre
+        header['post'] = self.post
+        header['threshold'] = self.threshold
+        self.file = open(name, 'ab')
+        self.file.write(header.tobytes())
+        self.name = name
+        self.hour = hour
+
+    def write(self, event, now):
+        if self.file == None or now.strftime("%Y%m%d%H") != self.hour:
+            self.open(now)
+        self.file.write(event.tobytes())
+
+    def flush(self):
+        if self.file != None:
+            self.file.flush()
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+        self.file = None
+        self.hour = None
+
+#Pipeline sink (see StreamPipeline): add() gets every sample of every chunk with its monotonic timestamp.
+#A new trigger is only accepted once the previous window is complete. A window that spans samples dropped by the
+#pipeline gets the EVENT_GAP flag. Finished events are queued to the writer thread; when the queue is full the event is
+#dropped and counted.
+class TriggerRecorder:
+    def __init__(self, writer, queue_depth=256, flush_interval=1.0):
+        self.writer = writer
+        self.pre = writer.pre
+        self.post = writer.post
+        self.threshold = writer.threshold
+        self.history_values = np.zeros(0, dtype=np.float64)
+        self.history_times = np.zeros(0, dtype=np.int64)
+        self.last_value = 0.0
+        self.capture = None
+        #samples seen before the current chunk, and the number of the first sample after the latest gap
+        self.samples = 0
+        self.gap_at = None
+        self.events = 0
+        self.gap_events = 0
+        self.skipped = 0
+        self.dropped_events = 0
+        self.write_errors = 0
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.flush_interval = flush_interval
+        self.thread = Thread(target=self.run, name="CR trigger writer")
+        self.thread.start()
+
+    #gap: samples were dropped right before this chunk
+    def add(self, values, times_ns, now, gap=False):
+        if gap:
+            self.gap_at = self.samples
+            if self.capture != None:
+                self.capture[3] = True
+        if len(values) == 0:
+            return
+        #epoch ns = monotonic ns + offset; the last sample of the chunk arrived at now
+        offset = int(now.timestamp() * 1e9) - int(times_ns[-1])
+        base = len(self.history_values)
+        all_values = np.concatenate((self.history_values, values))
+        all_times = np.concatenate((self.history_times, times_ns))
+        previous = np.concatenate(([self.last_value], values[:-1]))
+        edges = np.flatnonzero((values >= self.threshold) & (previous < self.threshold))
+
+        position = 0
+        if self.capture != None:
+            position = self.continueCapture(values, times_ns, 0, offset, now)
+        for edge in edges.tolist():
+            if edge < position:
+                #inside the window that is already being captured
+                continue
+            start = base + edge - self.pre
+            if start < 0:
+                #not enough history yet (start of the stream)
+                self.skipped += 1
+                continue
+            gap = self.gap_at != None and self.samples + edge - self.pre < self.gap_at
+            self.capture = [[all_values[start:base + edge]], [all_times[start:base + edge]], self.pre, gap]
+            position = self.continueCapture(values, times_ns, edge, offset, now)
+
+        self.samples += len(values)
+        self.last_value = float(values[-1])
+        self.history_values = all_values[-self.pre:] if self.pre else all_values[:0]
+        self.history_times = all_times[-self.pre:] if self.pre else all_times[:0]
+
+    #Append samples from index start to the open window; returns the index after the last sample used
+    def continueCapture(self, values, times_ns, start, offset, now):
+        parts_values, parts_times, filled, gap = self.capture
+        take = min(self.pre + self.post - filled, len(values) - start)
+        parts_values.append(values[start:start + take])
+        parts_times.append(times_ns[start:start + take])
+        filled += take
+        if filled < self.pre + self.post:
+            self.capture[2] = filled
+        else:
+            self.capture = None
+            self.finish(np.concatenate(parts_values), np.concatenate(parts_times), offset, now, gap)
+        return start + take
+
+    def finish(self, values, times_ns, offset, now, gap=False):
+        width, peak, charge, truncated = pulseMetrics(values, times_ns, self.pre, self.threshold)
+        event = np.zeros(1, dtype=self.writer.record)
+        event['trigger_epoch_ns'] = int(times_ns[self.pre]) + offset
+        event['width_s'] = width
+        event['peak_a'] = peak
+        event['charge_c'] = charge
+        event['truncated'] = (EVENT_TRUNCATED if truncated else 0) | (EVENT_GAP if gap else 0)
+        event['t_us'] = (times_ns - times_ns[self.pre]) // 1000
+        event['amps'] = values
+        try:
+            self.queue.put_nowait((event, now))
+        except queue.Full:
+            self.dropped_events += 1
+            return
+        self.events += 1
+        self.gap_events += gap
+
+    #Writer thread: writes the queued events and flushes the file every flush_interval seconds
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                try:
+                    self.writer.write(*item)
+                except OSError as e:
+                    self.write_errors += 1
+                    logging.error("ERROR writing trigger event to {}: {}".format(self.writer.name, e))
+                    self.writer.close()
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.writer.flush()
+                last_flush = time.monotonic()
+        self.writer.close()
+
+    def stats(self) -> dict:
+        return {'trigger_events': self.events, 'trigger_gap_events': self.gap_events, 'trigger_skipped': self.skipped,
+                'trigger_dropped': self.dropped_events, 'trigger_write_errors': self.write_errors}
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+#Memory map an event file. Returns the header (dict) and a read-only structured array with one record per event.
+def readEvents(path):
+    header = np.fromfile(path, dtype=EVENT_HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] != EVENT_MAGIC:
+        raise ValueError("{} is not a CurrentRanger event file".format(path))
+    info = {'pre': int(header['pre'][0]), 'post': int(header['post'][0]), 'threshold': float(header['threshold'][0])}
+    record = eventRecord(info['pre'], info['post'])
+    count = (os.path.getsize(path) - EVENT_HEADER_SIZE) // record.itemsize
+    info['events'] = count
+    if count == 0:
+        return info, np.empty(0, dtype=record)
+    return info, np.memmap(path, dtype=record, mode='r', offset=EVENT_HEADER_SIZE, shape=(count,))
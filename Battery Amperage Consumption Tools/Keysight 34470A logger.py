@@ -3,56 +3,90 @@
 #Revision 2.0 (12/11/2022) - Removed hard coding of Keysight instrument, output file path, device naming. 
 ####Added command line arguments for improved overall system functionality when being paired with the automated test station.
 ###Solenoid activations per every second are now counted, solenoid pulse must exceed 200mA to be valid.
+#Usage: python "Keysight 34470A logger.py" <device> <output path> [continuous|pipelined] [simulated] [VISA address or serial number]
 
 # import python modules
-import pyvisa as visa
 import numpy as np
 import time
 import sys
-from datetime import datetime
+import queue
+from threading import Thread
+from datetime import datetime, timedelta
 import os
+from VisaSession import openSession
 
 device = sys.argv[1]
 output_type = '.csv'
 output_path = sys.argv[2] + '\\Keysight34470A\\'
+options = sys.argv[3:]
+#Optional 'continuous': gapless acquisition, the meter triggers forever and R? drains its memory
+continuous_mode = 'continuous' in options
+#'pipelined': same blocks as the default mode, but the next block is started as soon as the previous one is in host
+#memory and statistics/file output run on a worker thread
+pipelined_mode = 'pipelined' in options
+#'simulated': talk to the simulated meter of KeysightSimulator.py instead of the VISA library
+simulated_mode = 'simulated' in options
+#Any other option picks the meter by VISA address or serial number, e.g. MY60043129. Default: first instrument found
+resource = next((option for option in options if option not in ('continuous', 'pipelined', 'simulated')), None)
+
+#Readings averaged into one row of the output file
+BLOCK_SIZE = 1000
+#Largest number of readings taken out of the meter by one R? query
+MAX_READINGS_PER_QUERY = 50000
+#Seconds to wait when R? returned nothing yet
+DRAIN_POLL = 0.05
+#Seconds between reading memory overflow / lost sample checks
+OVERFLOW_CHECK_INTERVAL = 10
+#Seconds the growth of reading memory is watched after INIT to measure the real reading period
+PERIOD_MEASUREMENT = 0.5
+#Reading above this amperage means the solenoid was activated during the block
+SOLENOID_THRESHOLD = .200
+#Blocks that may wait for the worker thread before the acquisition loop blocks
+PIPELINE_DEPTH = 8
+#Seconds between stage timing reports in pipelined mode
+TIMING_REPORT_INTERVAL = 60
+#STATus:QUEStionable bit 14: reading memory overflowed, readings have been lost
+QUES_MEMORY_OVERFLOW = 1 << 14
+#Meter setup after *RST, cached by the session and re-sent when recovering from an error
+METER_CONFIGURATION = (
+    #Configure DCV Measurement
+    "CONF:CURRent:DC",
+    "SENSe:CURRent:DC:NPLC .006",
+    "TRIGger:DELay MIN", #Remove to slow down sampling rate to 500 samples in 1.8 seconds
+    "SENSe:CURRent:DC:TERMinals 3",
+    "SENSe:CURRent:DC:RANGe 1",
+    #Readings are transferred as little endian 64 bit floats instead of ASCII
+    "FORMat:DATA REAL,64",
+    "FORMat:BORDer SWAPped",
+)
 
 
 class keysightMultimeter:
-    #Open Connection
-    rm = visa.ResourceManager('C:\\Windows\\System32\\visa32.dll')
-    instrument_available = rm.list_resources()
-    #Change the following line to connect to VISA Address. Here are some examples of VISA addresses
-    #USB Connection: 'USB0::xxxxxx::xxxxxx::xxxxxxxxxx::0::INSTR'
-    myinst = rm.open_resource(instrument_available[0])
-    #myinst = rm.open_resource("USB0::0x2A8D::0x0201::MY60043129::0::INSTR")
-
-    def __init__(self):
+    #The connection is opened on the first command. Examples of VISA addresses:
+    #USB Connection: 'USB0::xxxxxx::xxxxxx::xxxxxxxxxx::0::INSTR', e.g. "USB0::0x2A8D::0x0201::MY60043129::0::INSTR"
+    def __init__(self, resource=None, resource_manager=None):
+        self.myinst = openSession(resource, resource_manager)
         self.datastream = True
+        #Continuous mode bookkeeping, kept across restarts of logcontinuous()
+        self.readings_received = 0
+        self.readings_lost = 0
+        self.run_lost = 0
+        self.overflow_events = 0
+        self.run_overflowed = False
+        #statistics of the last block written
+        self.block_stats = blockStatistics(np.empty(0))
         try:
             os.chdir(output_path)
         except IOError:
                 os.makedirs(output_path)
 
+    #Back to the measurement configuration without *RST: device clear, reconnect if needed and re-send the setup
     def reset(self):
-        self.myinst.write("*RST")
-        self.myinst.write("*CLS")
-        #Configure DCV Measurement
-        self.myinst.write("CONF:CURRent:DC")
-        self.myinst.write("SENSe:CURRent:DC:NPLC .006")
-        self.myinst.write("TRIGger:DELay MIN") #Remove to slow down sampling rate to 500 samples in 1.8 seconds
-        self.myinst.write("SENSe:CURRent:DC:TERMinals 3")
-        self.myinst.write("SENSe:CURRent:DC:RANGe 1")
-
+        self.myinst.restore()
 
+    #Full *RST and measurement configuration
     def initialize(self):
-        self.myinst.write("*RST")
-        self.myinst.write("*CLS")
-        #Configure DCV Measurement
-        self.myinst.write("CONF:CURRent:DC")
-        self.myinst.write("SENSe:CURRent:DC:NPLC .006")
-        self.myinst.write("TRIGger:DELay MIN") #Remove to slow down sampling rate to 500 samples in 1.8 seconds
-        self.myinst.write("SENSe:CURRent:DC:TERMinals 3")
-        self.myinst.write("SENSe:CURRent:DC:RANGe 1")
+        self.myinst.configure(METER_CONFIGURATION)
 
     def run_KeysightMultimeter(self)-> bool:
         return self.datastream
@@ -65,46 +99,247 @@ class keysightMultimeter:
                 self.myinst.write("TRIG:COUN 1")
                 self.myinst.write("TRIG:SOUR IMM")
                 self.myinst.write("INIT")
-                average_amperage_consumption = np.sum(self.myinst.query_ascii_values('FETC?'))
-                if (np.max(self.myinst.query_ascii_values('FETC?')) > .200):
-                    solenoid_activated = True
-                else:
-                    solenoid_activated = False
+                #one binary transfer, every statistic comes from the same buffer
+                self.block_stats = blockStatistics(self.queryReadings('FETC?'))
                 ts_stop = datetime.now()
                 self.myinst.write("CALCulate:CLEar")
             except KeyboardInterrupt:
                 self.datastream = False
+                continue
             except:
-                try:
-                    #attempt to reset the meter otherwise close the thread and start a new connection
-                    #This print statement seems to causes issues with hanging.
-                    #print("ERROR grabbing data points")
-                    self.reset()
-                except:
-                    self.datastream = False
-                    self.myinst.close()
+                #This print statement seems to causes issues with hanging.
+                #print("ERROR grabbing data points")
+                self.recover()
                 return
 
+            self.writeRow(ts_start, ts_stop, self.block_stats['mean'], self.block_stats['pulses'] > 0)
+
+    def writeRow(self, ts_start, ts_stop, average_amperage, solenoid_activated):
+        try:
+            now = datetime.now()
+            name = output_path + device + " - {date}".format(date = now.strftime("%Y%m%d%H")) + output_type
+            f = open(name, 'a')
+            data = "{ts_start},{ts_stop},{avgAmerage},{solenoid_bool}\n".format(ts_start = ts_start, ts_stop = ts_stop,avgAmerage = average_amperage, solenoid_bool = solenoid_activated)
+            f.write(data)
+            f.close()
+        except KeyboardInterrupt:
+            self.datastream = False
+        except:
+            print("ERROR writing to file")
+            pass
+
+    #Gapless acquisition. The meter samples on its own timer with an infinite trigger count and the host takes the
+    #readings out of reading memory with R?, so the meter never waits for the host between blocks.
+    #Every BLOCK_SIZE readings become one row, timed from the INIT time and the reading period. That is the sample
+    #timer only when a measurement fits in it (SAMP:TIM MIN is shorter than NPLC .006 takes), so the period is measured:
+    #from the growth of reading memory right after INIT, then from every reading of the run as long as memory has
+    #not overflowed (until then nothing was lost). A changed period only applies to the rows after it.
+    #Readings lost to a reading memory overflow are counted from the Questionable Data register and from the number
+    #of readings the meter should have produced in that period.
+    def logcontinuous(self):
+        try:
+            self.myinst.write("ABORt")
+            self.myinst.write("*CLS")
+            self.myinst.write("TRIG:SOUR IMM")
+            self.myinst.write("TRIG:COUN INF")
+            self.myinst.write("SAMPle:SOURce TIMer")
+            self.myinst.write("SAMPle:TIMer MIN")
+            self.myinst.write("SAMPle:COUNt MAX")
+            interval = float(self.myinst.query("SAMPle:TIMer?"))
+            started = datetime.now()
+            started_counter = time.perf_counter()
+            self.myinst.write("INIT")
+            period = self.measurePeriod(interval)
+        except KeyboardInterrupt:
+            self.datastream = False
+            return
+        except:
+            self.recover()
+            return
+        #readings missed by an earlier run are final, the gap while restarting cannot be counted
+        self.readings_lost += self.run_lost
+        self.run_lost = 0
+        self.run_overflowed = False
+        #rows are timed as anchor + (readings - anchor_readings) * period
+        anchor = started
+        anchor_readings = 0
+        last_check = time.perf_counter()
+        readings = 0
+        pending = np.empty(0)
+        while self.datastream == True:
             try:
-                now = datetime.now()
-                name = output_path + device + " - {date}".format(date = now.strftime("%Y%m%d%H")) + output_type
-                f = open(name, 'a')
-                average_amperage_consumption = average_amperage_consumption / 1000
-                data = "{ts_start},{ts_stop},{avgAmerage},{solenoid_bool}\n".format(ts_start = ts_start, ts_stop = ts_stop,avgAmerage = average_amperage_consumption, solenoid_bool = solenoid_activated)
-                f.write(data)
-                f.close()
+                values = self.queryReadings("R? {}".format(MAX_READINGS_PER_QUERY))
+                if len(values) == 0:
+                    time.sleep(DRAIN_POLL)
+                pending = np.concatenate((pending, values)) if len(pending) else values
+                while len(pending) >= BLOCK_SIZE:
+                    block = pending[:BLOCK_SIZE]
+                    pending = pending[BLOCK_SIZE:]
+                    ts_start = anchor + timedelta(seconds=(readings - anchor_readings) * period)
+                    readings += BLOCK_SIZE
+                    ts_stop = anchor + timedelta(seconds=(readings - anchor_readings) * period)
+                    self.block_stats = blockStatistics(block)
+                    self.writeRow(ts_start, ts_stop, self.block_stats['mean'], self.block_stats['pulses'] > 0)
+                self.readings_received += len(values)
+                if time.perf_counter() - last_check >= OVERFLOW_CHECK_INTERVAL:
+                    last_check = time.perf_counter()
+                    measured = self.checkOverflow(interval, period, started_counter, readings + len(pending))
+                    if measured != period:
+                        anchor += timedelta(seconds=(readings - anchor_readings) * period)
+                        anchor_readings = readings
+                        period = measured
             except KeyboardInterrupt:
                 self.datastream = False
             except:
-                print("ERROR writing to file")
-                pass
+                self.recover()
+                return
+        try:
+            self.myinst.write("ABORt")
+        except:
+            pass
+
+    #Seconds per reading the meter really achieves: the sample timer interval, or longer when one measurement (NPLC,
+    #autozero) takes more than the timer. Measured from the growth of reading memory over PERIOD_MEASUREMENT.
+    def measurePeriod(self, interval):
+        first = int(self.myinst.query("DATA:POINts?"))
+        first_time = time.perf_counter()
+        time.sleep(PERIOD_MEASUREMENT)
+        count = int(self.myinst.query("DATA:POINts?")) - first
+        elapsed = time.perf_counter() - first_time
+        return max(interval, elapsed / count) if count > 0 else interval
+
+    #Compare what the meter should have produced in the reading period with what was read plus what is still in
+    #memory. Until reading memory overflows nothing can be lost, so the readings so far measure the period over the
+    #whole run instead. Returns the reading period.
+    def checkOverflow(self, interval, period, started_counter, readings):
+        if int(self.myinst.query("STATus:QUEStionable:EVENt?")) & QUES_MEMORY_OVERFLOW:
+            self.overflow_events += 1
+            self.run_overflowed = True
+        in_memory = int(self.myinst.query("DATA:POINts?"))
+        elapsed = time.perf_counter() - started_counter
+        if not self.run_overflowed and readings + in_memory > 0:
+            period = max(interval, elapsed / (readings + in_memory))
+        expected = int(elapsed / period)
+        #host timing and the meter timebase are not exact, differences below 0.1% are not counted as lost
+        missing = expected - readings - in_memory
+        if missing > max(10, expected // 1000):
+            self.run_lost = max(self.run_lost, missing)
+        print("{} readings, {} in memory, {} lost, {} overflow events, duty cycle {:.3f}%, reading period {:.1f} us (timer {:.1f} us)".format(
+            self.readings_received, in_memory, self.readings_lost + self.run_lost, self.overflow_events,
+            min(100.0, 100.0 * (readings + in_memory) / max(1, expected)), period * 1e6, interval * 1e6))
+        return period
+
+    #Double buffered acquisition: as soon as FETC? has returned a block the next INIT is sent, then the block is handed
+    #to a worker thread for statistics and file output, so the meter measures while the host processes.
+    #Stage timing (seconds per block) is printed every TIMING_REPORT_INTERVAL. fetch is how long FETC? waited for the
+    #meter plus the transfer, host_gap the time between INIT and the next FETC?. While fetch stays well above the pure
+    #transfer time and handoff near zero, the meter is never waiting on the host.
+    def logpipelined(self):
+        self.stage_times = dict.fromkeys(('init', 'fetch', 'host_gap', 'handoff', 'stats', 'write'), 0.0)
+        self.stage_blocks = 0
+        self.processed_blocks = 0
+        self.max_queue_depth = 0
+        blocks = queue.Queue(maxsize=PIPELINE_DEPTH)
+        worker = Thread(target=self.processBlocks, args=(blocks,))
+        worker.start()
+        last_report = time.perf_counter()
+        try:
+            self.myinst.write("SAMPle:COUNt {}".format(BLOCK_SIZE))
+            self.myinst.write("TRIG:COUN 1")
+            self.myinst.write("TRIG:SOUR IMM")
+            ts_start = datetime.now()
+            self.myinst.write("INIT")
+            initiated = time.perf_counter()
+            while self.datastream == True:
+                fetch_started = time.perf_counter()
+                readings = self.queryReadings('FETC?')
+                ts_stop = datetime.now()
+                fetched = time.perf_counter()
+                next_start = datetime.now()
+                self.myinst.write("INIT")
+                next_initiated = time.perf_counter()
+                blocks.put((ts_start, ts_stop, readings))
+                handed_off = time.perf_counter()
+
+                self.stage_times['host_gap'] += fetch_started - initiated
+                self.stage_times['fetch'] += fetched - fetch_started
+                self.stage_times['init'] += next_initiated - fetched
+                self.stage_times['handoff'] += handed_off - next_initiated
+                self.stage_blocks += 1
+                self.max_queue_depth = max(self.max_queue_depth, blocks.qsize())
+                ts_start = next_start
+                initiated = next_initiated
+                if handed_off - last_report >= TIMING_REPORT_INTERVAL:
+                    last_report = handed_off
+                    print(self.stageTiming())
+        except KeyboardInterrupt:
+            self.datastream = False
+        except:
+            self.recover()
+        finally:
+            blocks.put(None)
+            worker.join()
+            print(self.stageTiming())
+
+    def processBlocks(self, blocks):
+        while True:
+            item = blocks.get()
+            if item is None:
+                break
+            ts_start, ts_stop, readings = item
+            started = time.perf_counter()
+            stats = blockStatistics(readings)
+            computed = time.perf_counter()
+            self.writeRow(ts_start, ts_stop, stats['mean'], stats['pulses'] > 0)
+            self.stage_times['stats'] += computed - started
+            self.stage_times['write'] += time.perf_counter() - computed
+            self.block_stats = stats
+            self.processed_blocks += 1
+
+    def stageTiming(self) -> str:
+        acquired = max(1, self.stage_blocks)
+        processed = max(1, self.processed_blocks)
+        return ("{} blocks: fetch {:.4f} s, init {:.4f} s, host_gap {:.4f} s, handoff {:.4f} s | worker: stats {:.4f} s, write {:.4f} s, "
+                "queue max {}/{}").format(self.stage_blocks, self.stage_times['fetch'] / acquired, self.stage_times['init'] / acquired,
+                self.stage_times['host_gap'] / acquired, self.stage_times['handoff'] / acquired, self.stage_times['stats'] / processed,
+                self.stage_times['write'] / processed, self.max_queue_depth, PIPELINE_DEPTH)
+
+    #FETC? / R? as one IEEE 488.2 binary block of REAL,64 readings straight into a numpy array
+    def queryReadings(self, command):
+        return self.myinst.query_binary_values(command, datatype='d', is_big_endian=False, container=np.array)
+
+    #attempt to restore the meter (reconnecting with backoff), otherwise close the connection and stop
+    def recover(self):
+        try:
+            self.reset()
+        except:
+            self.datastream = False
+            self.myinst.close()
+
+#Mean, max, min and number of solenoid pulses (rising edges through SOLENOID_THRESHOLD) of one block of readings.
+#A block that starts above the threshold counts that pulse too, so pulses > 0 whenever max > SOLENOID_THRESHOLD.
+def blockStatistics(readings):
+    if len(readings) == 0:
+        return {'mean': float('nan'), 'max': float('nan'), 'min': float('nan'), 'pulses': 0}
+    above = readings > SOLENOID_THRESHOLD
+    pulses = int(above[0]) + int(np.count_nonzero(above[1:] & ~above[:-1]))
+    return {'mean': float(np.mean(readings)), 'max': float(np.max(readings)), 'min': float(np.min(readings)), 'pulses': pulses}
 
 def main():
-    multimeter = keysightMultimeter()
+    resource_manager = None
+    if simulated_mode:
+        from KeysightSimulator import SimulatedResourceManager
+        resource_manager = SimulatedResourceManager()
+    multimeter = keysightMultimeter(resource, resource_manager)
     multimeter.initialize()
     try:
-        while multimeter.run_KeysightMultimeter:
-            multimeter.logdata()
+        while multimeter.run_KeysightMultimeter():
+            if continuous_mode:
+                multimeter.logcontinuous()
+            elif pipelined_mode:
+                multimeter.logpipelined()
+            else:
+                multimeter.logdata()
             time.sleep(.000001)   
     except KeyboardInterrupt:
         print("Program terminated due to Keyboard Interrupt")
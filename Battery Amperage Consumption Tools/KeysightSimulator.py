@@ -0,0 +1,192 @@
+#Simulated Keysight 34470A behind a pyvisa style ResourceManager, for running the 34470A logger without an instrument.
+#Readings are produced on the meter's own clock (sample interval from NPLC or SAMPle:TIMer) with synthetic solenoid
+#pulses, into a reading memory that FETC? reads and R? drains, so gaps and overflows behave like on the real meter.
+#Every transfer costs latency + bytes / bandwidth (+ chunk overhead per chunk_size bytes) of real time.
+#Usage: python "Keysight 34470A logger.py" <device> <output path> [continuous|pipelined] simulated
+
+import time
+import numpy as np
+import SimulatedVisa
+from SimulatedVisa import SimulatedLink, SimulatedResource, ieeeBlock
+
+SIM_ADDRESS = 'USB0::0x2A8D::0x0201::MY60043129::0::INSTR'
+SIM_IDN = 'Keysight Technologies,34470A,MY60043129,A.03.01-02.40-03.01-00.52-01-01'
+#Standard reading memory of the 34470A
+MEMORY_READINGS = 1000000
+#Fastest sample interval (SAMPle:TIMer MIN / TRIGger:DELay MIN)
+MIN_INTERVAL = 20e-6
+QUES_MEMORY_OVERFLOW = 1 << 14
+#Long forms of the keywords used by the logger (SCPI is case insensitive, a keyword is its short or long form)
+LONG_FORMS = {'SENSE': 'SENS', 'CURRENT': 'CURR', 'CONFIGURE': 'CONF', 'TRIGGER': 'TRIG', 'SAMPLE': 'SAMP', 'COUNT': 'COUN',
+              'SOURCE': 'SOUR', 'TIMER': 'TIM', 'DELAY': 'DEL', 'TERMINALS': 'TERM', 'RANGE': 'RANG', 'FORMAT': 'FORM',
+              'BORDER': 'BORD', 'INITIATE': 'INIT', 'FETCH': 'FETC', 'POINTS': 'POIN', 'STATUS': 'STAT', 'QUESTIONABLE': 'QUES',
+              'EVENT': 'EVEN', 'CALCULATE': 'CALC', 'CLEAR': 'CLE', 'ABORT': 'ABOR', 'SYSTEM': 'SYST', 'ERROR': 'ERR',
+              'VOLTAGE': 'VOLT', 'DISPLAY': 'DISP'}
+
+class Simulated34470A(SimulatedResource):
+    LONG_FORMS = LONG_FORMS
+    #SENSe is optional in the measurement commands
+    OPTIONAL_NODES = ('SENS',)
+
+    def __init__(self, address=SIM_ADDRESS, link=None, line_frequency=60, memory=MEMORY_READINGS, pulse_interval=2.5,
+                 pulse_width=0.01, pulse_amps=0.35, idle_amps=0.0005, seed=1):
+        SimulatedResource.__init__(self, address, link if link != None else SimulatedLink(latency=0.002, bandwidth=1e6, chunk_overhead=50e-6))
+        self.line_frequency = line_frequency
+        self.memory = memory
+        self.pulse_interval = pulse_interval
+        self.pulse_width = pulse_width
+        self.pulse_amps = pulse_amps
+        self.idle_amps = idle_amps
+        self.rng = np.random.default_rng(seed)
+        #position in the synthetic current profile, continues across INITs
+        self.reading_index = 0
+        self.reading_base = 0
+        self.reset()
+
+    def reset(self):
+        self.nplc = 10.0
+        self.trigger_delay_min = False
+        self.sample_count = 1
+        self.trigger_count = 1
+        self.sample_source = 'IMM'
+        self.sample_timer = 1.0
+        self.real_format = False
+        self.swapped = False
+        self.questionable = 0
+        self.abort()
+        self.initiated = False
+        self.started = 0.0
+        self.stopped_at = None
+        #readings of this INIT (None = until ABORt), readings taken out by R? or lost to overflows
+        self.total_limit = 0
+        self.removed = 0
+        self.reading_base = self.reading_index
+
+    #Seconds between readings: the sample timer, or integration time plus the minimum delay. A timer shorter than the
+    #measurement takes does not make the meter any faster.
+    def interval(self):
+        integration = self.nplc / self.line_frequency
+        if self.sample_source == 'TIM':
+            return max(self.sample_timer, integration + MIN_INTERVAL)
+        return max(MIN_INTERVAL, integration + (MIN_INTERVAL if self.trigger_delay_min else 0.001))
+
+    #Readings taken since INIT; reading memory keeps the newest self.memory of them and flags the overflow
+    def generated(self):
+        if not self.initiated:
+            return 0
+        end = self.stopped_at if self.stopped_at is not None else time.monotonic()
+        produced = int((end - self.started) / self.interval())
+        if self.total_limit is not None:
+            produced = min(produced, self.total_limit)
+        if produced - self.removed > self.memory:
+            self.questionable |= QUES_MEMORY_OVERFLOW
+            self.removed = produced - self.memory
+        return produced
+
+    def current(self, first, count):
+        seconds = np.arange(first, first + count) * self.interval()
+        values = self.idle_amps + self.rng.normal(0, self.idle_amps * 0.2, count)
+        pulse = (seconds % self.pulse_interval) < self.pulse_width
+        values[pulse] = self.pulse_amps + self.rng.normal(0, 0.01, int(np.count_nonzero(pulse)))
+        return values
+
+    def encode(self, values):
+        if self.real_format:
+            return ieeeBlock(values.astype('<f8' if self.swapped else '>f8').tobytes())
+        return (','.join('{:+.9E}'.format(value) for value in values.tolist()) + '\n').encode()
+
+    def initiate(self):
+        self.reading_index = self.reading_base + self.generated()
+        self.reading_base = self.reading_index
+        self.initiated = True
+        self.started = time.monotonic()
+        self.stopped_at = None
+        self.removed = 0
+        infinite = self.trigger_count is None or self.sample_count is None
+        self.total_limit = None if infinite else self.sample_count * self.trigger_count
+
+    def abort(self):
+        if getattr(self, 'initiated', False) and self.stopped_at is None:
+            self.stopped_at = time.monotonic()
+
+    #FETC? waits for a counted measurement to complete and does not take the readings out of memory
+    def fetch(self):
+        if not self.initiated:
+            self.errors.append('-230,"Data corrupt or stale"')
+            return self.encode(np.empty(0))
+        if self.total_limit is not None and self.stopped_at is None:
+            self.busy_until = self.started + self.total_limit * self.interval()
+            count = self.total_limit - self.removed
+        else:
+            count = self.generated() - self.removed
+        return self.encode(self.current(self.reading_base + self.removed, count))
+
+    #R?: up to count readings taken out of memory
+    def remove(self, count):
+        count = min(count, self.generated() - self.removed)
+        values = self.current(self.reading_base + self.removed, count)
+        self.removed += count
+        return self.encode(values)
+
+    def execute(self, header, arguments):
+        value = arguments.upper()
+        if header == '*RST':
+            self.reset()
+        elif header == '*CLS':
+            self.questionable = 0
+            self.errors = []
+        elif header == '*IDN?':
+            return SIM_IDN.encode() + b'\n'
+        elif header == '*OPC?':
+            return b'1\n'
+        elif header in ('CONF:CURR:DC', 'CONF:CURR'):
+            self.reset()
+        elif header == 'CURR:DC:NPLC':
+            self.nplc = 0.001 if value == 'MIN' else 100.0 if value == 'MAX' else float(arguments)
+        elif header == 'TRIG:DEL':
+            self.trigger_delay_min = value == 'MIN' or float(value) == 0
+        elif header in ('CURR:DC:TERM', 'CURR:DC:RANG', 'CALC:CLE', 'TRIG:SOUR', 'DISP', 'DISP:TEXT'):
+            pass
+        elif header == 'FORM:DATA':
+            self.real_format = value.startswith('REAL')
+        elif header == 'FORM:BORD':
+            self.swapped = value.startswith('SWAP')
+        elif header == 'SAMP:COUN':
+            self.sample_count = None if value in ('MAX', 'INF') else int(float(arguments))
+        elif header == 'SAMP:COUN?':
+            return '{:+d}\n'.format(self.sample_count if self.sample_count != None else 1000000000).encode()
+        elif header == 'TRIG:COUN':
+            self.trigger_count = None if value in ('INF', 'MAX') else int(float(arguments))
+        elif header == 'SAMP:SOUR':
+            self.sample_source = 'TIM' if value.startswith('TIM') else 'IMM'
+        elif header == 'SAMP:TIM':
+            self.sample_timer = MIN_INTERVAL if value == 'MIN' else float(arguments)
+        elif header == 'SAMP:TIM?':
+            return '{:+.9E}\n'.format(self.sample_timer).encode()
+        elif header == 'INIT':
+            self.initiate()
+        elif header == 'ABOR':
+            self.abort()
+        elif header == 'FETC?':
+            return self.fetch()
+        elif header == 'READ?':
+            self.initiate()
+            return self.fetch()
+        elif header == 'R?':
+            return self.remove(int(float(arguments)) if arguments else self.memory)
+        elif header == 'DATA:POIN?':
+            return '{:+d}\n'.format(self.generated() - self.removed).encode()
+        elif header == 'STAT:QUES:EVEN?':
+            self.generated()
+            event, self.questionable = self.questionable, 0
+            return '{:+d}\n'.format(event).encode()
+        elif header == 'SYST:ERR?':
+            return self.systemError()
+        else:
+            return self.undefined(header)
+        return None
+
+#ResourceManager with the simulated meter at SIM_ADDRESS unless other instruments are given
+class SimulatedResourceManager(SimulatedVisa.SimulatedResourceManager):
+    def __init__(self, instruments=None):
+        SimulatedVisa.SimulatedResourceManager.__init__(self, instruments if instruments != None else {SIM_ADDRESS: Simulated34470A})
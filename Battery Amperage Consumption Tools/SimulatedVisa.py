@@ -0,0 +1,232 @@
+#Instrument independent parts of the simulated VISA instruments (KeysightSimulator.py, InfiniiVisionSimulator.py):
+#SCPI command parsing, IEEE 488.2 blocks, the time cost of the bus, a pyvisa Resource look-alike for the instruments to
+#subclass and a ResourceManager look-alike that hands them out by address.
+#The file is in both tool directories so each of them runs on its own, the two copies are kept identical.
+
+import time
+import types
+import ctypes
+import logging
+import pyvisa as visa
+from pyvisa.util import from_ieee_block
+
+#SCPI keyword to its upper case short form using long_forms (long form -> short form): WAVeform -> WAV, CHANnel1 -> CHAN1
+def shortForm(node, long_forms):
+    query = node.endswith('?')
+    node = node.rstrip('?').upper()
+    suffix = node[len(node.rstrip('0123456789')):]
+    node = node[:len(node) - len(suffix)]
+    return long_forms.get(node, node) + suffix + ('?' if query else '')
+
+#Split a program message into (header, arguments) pairs. Commands after a ';' without a leading ':' are relative to
+#the subsystem of the previous command (":WAVeform:SOURce CHANnel1;DATA?"). A leading node in optional (short forms,
+#e.g. the SENSe of a meter) is dropped.
+def parseCommands(message, long_forms, optional=()):
+    commands = []
+    parent = []
+    for part in message.strip().split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        header, _, arguments = part.partition(' ')
+        if header.startswith('*'):
+            commands.append((header.upper(), arguments.strip()))
+            continue
+        nodes = [shortForm(node, long_forms) for node in header.split(':') if node]
+        if not header.startswith(':'):
+            nodes = parent + nodes
+        parent = nodes[:-1]
+        if nodes and nodes[0] in optional:
+            nodes = nodes[1:]
+        commands.append((':'.join(nodes), arguments.strip()))
+    return commands
+
+def ieeeBlock(payload):
+    length = str(len(payload))
+    return b'#' + str(len(length)).encode() + length.encode() + payload + b'\n'
+
+#Time cost of the bus: a write and the first read of its response cost latency / 2 each, every read costs
+#bytes / bandwidth plus overhead per chunk_size piece
+class SimulatedLink:
+    def __init__(self, latency=0.001, bandwidth=8e6, chunk_overhead=100e-6):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_overhead = chunk_overhead
+        self.bytes_read = 0
+        self.transactions = 0
+
+    def cost(self, nbytes, chunk_size, first=True):
+        self.transactions += first
+        self.bytes_read += nbytes
+        chunks = -(-nbytes // chunk_size) if nbytes else 0
+        return self.latency / 2 * first + nbytes / self.bandwidth + chunks * self.chunk_overhead
+
+#viRead status when count bytes were read before the end of the message
+VI_SUCCESS_MAX_CNT = 0x3FFF0006
+VI_READ = ctypes.CFUNCTYPE(ctypes.c_int32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_ubyte), ctypes.c_uint32,
+                           ctypes.POINTER(ctypes.c_uint32))
+
+#Stand-in for the ctypes VISA library of pyvisa's default backend (resource.visalib.lib), for readers that call viRead
+#themselves. viRead goes through ctypes like the DLL and returns at most read_limit bytes per call, like a device that
+#ends a transfer early, so a reader has to handle partial reads.
+class SimulatedVisaLibrary:
+    def __init__(self, resource, read_limit=None):
+        self.resource = resource
+        self.read_limit = read_limit
+        self.calls = 0
+        #calls that returned fewer bytes than asked for
+        self.partial = 0
+        self.lib = types.SimpleNamespace(viRead=VI_READ(self.viRead))
+
+    def viRead(self, session, buffer, count, returned):
+        self.calls += 1
+        ## an exception cannot get through ctypes, it becomes the status like in the DLL
+        try:
+            data = self.resource.read_bytes(min(count, self.read_limit or count))
+        except visa.errors.VisaIOError as e:
+            return e.error_code
+        ctypes.memmove(buffer, data, len(data))
+        returned[0] = len(data)
+        self.partial += len(data) < count
+        return VI_SUCCESS_MAX_CNT if self.resource.output else 0
+
+#pyvisa Resource look-alike. Subclasses set LONG_FORMS (and OPTIONAL_NODES) for the command parser and implement
+#execute(header, arguments) returning response bytes for queries.
+class SimulatedResource:
+    LONG_FORMS = {}
+    OPTIONAL_NODES = ()
+
+    def __init__(self, address, link):
+        self.resource_name = address
+        self.link = link
+        self.timeout = 2000
+        self.chunk_size = 20480
+        self.read_termination = None
+        self.write_termination = None
+        self.output = bytearray()
+        self.busy_until = 0.0
+        #nothing of the pending response has been read yet
+        self.fresh = False
+        self.errors = []
+        self.closed = False
+
+    #Serve reads through a SimulatedVisaLibrary viRead as well (inst.visalib.lib.viRead on inst.session). Returns self.
+    def attachLibrary(self, read_limit=None):
+        self.visalib = SimulatedVisaLibrary(self, read_limit)
+        self.session = 1
+        return self
+
+    def checkOpen(self):
+        if self.closed:
+            raise visa.errors.InvalidSession()
+
+    #Block like the bus would; an instrument that is still busy past the timeout raises VisaIOError
+    def wait(self, seconds, deadline_ms=None):
+        deadline_ms = self.timeout if deadline_ms is None else deadline_ms
+        if deadline_ms is not None and seconds > deadline_ms / 1000.0:
+            time.sleep(deadline_ms / 1000.0)
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def write(self, message, termination=None, encoding=None):
+        self.checkOpen()
+        self.wait(self.link.latency / 2)
+        responses = []
+        for header, arguments in parseCommands(message, self.LONG_FORMS, self.OPTIONAL_NODES):
+            try:
+                response = self.execute(header, arguments)
+            except (ValueError, IndexError, KeyError):
+                self.errors.append('-224,"Illegal parameter value"')
+                continue
+            if response is not None:
+                responses.append(response)
+        #responses to a compound query come back as one message separated by ';'
+        if len(responses) > 1:
+            responses = [b';'.join(response.rstrip(b'\n') for response in responses) + b'\n']
+        for response in responses:
+            self.output.extend(response)
+            self.fresh = True
+        return len(message)
+
+    def read_raw(self, size=None):
+        self.checkOpen()
+        if not self.output:
+            self.wait(float('inf'))
+        #the instrument answers once it has finished what it was doing
+        self.wait(max(0.0, self.busy_until - time.monotonic()) + self.link.cost(len(self.output), self.chunk_size, self.fresh))
+        self.fresh = False
+        data = bytes(self.output)
+        self.output.clear()
+        return data
+
+    #Up to count bytes of the pending response, for chunked readers
+    def read_bytes(self, count, chunk_size=None, break_on_termchar=False):
+        self.checkOpen()
+        if not self.output:
+            self.wait(float('inf'))
+        data = bytes(self.output[:count])
+        self.wait(max(0.0, self.busy_until - time.monotonic()) + self.link.cost(len(data), chunk_size or self.chunk_size, self.fresh))
+        self.fresh = False
+        del self.output[:count]
+        return data
+
+    def read(self):
+        return self.read_raw().decode('ascii')
+
+    def query(self, message, delay=None):
+        self.write(message)
+        return self.read()
+
+    def query_ascii_values(self, message, converter='f', separator=',', container=list, delay=None):
+        values = self.query(message).strip()
+        return container([float(value) for value in values.split(separator)] if values else [])
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list, delay=None,
+                            header_fmt='ieee', expect_termination=True, data_points=None, chunk_size=None):
+        self.write(message)
+        return from_ieee_block(self.read_raw(), datatype, is_big_endian, container)
+
+    #Device clear: drop pending output and whatever is in progress
+    def clear(self):
+        self.checkOpen()
+        self.output.clear()
+        self.busy_until = 0.0
+
+    def close(self):
+        self.closed = True
+
+    def systemError(self):
+        return (self.errors.pop(0) if self.errors else '+0,"No error"').encode() + b'\n'
+
+    def undefined(self, header):
+        self.errors.append('-113,"Undefined header";{}'.format(header))
+        logging.debug("Simulated instrument: undefined header {}".format(header))
+        return None
+
+#pyvisa ResourceManager look-alike holding simulated instruments by address. instruments maps an address to an
+#instrument or to a factory called with the address on the first open.
+class SimulatedResourceManager:
+    def __init__(self, instruments):
+        self.instruments = instruments
+        self.opened = {}
+
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.instruments)
+
+    def open_resource(self, resource_name, **kwargs):
+        if resource_name not in self.instruments:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_resource_not_found)
+        factory = self.instruments[resource_name]
+        #one instrument per address, a reconnect gets the same (possibly busy) instrument back
+        if resource_name not in self.opened:
+            self.opened[resource_name] = factory(resource_name) if callable(factory) else factory
+        inst = self.opened[resource_name]
+        inst.closed = False
+        for name, value in kwargs.items():
+            setattr(inst, name, value)
+        return inst
+
+    def close(self):
+        for inst in self.opened.values():
+            inst.close()
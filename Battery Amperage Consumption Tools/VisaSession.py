@@ -0,0 +1,141 @@
+#Lazily connected, self-healing VISA session for the Keysight loggers.
+#Nothing touches the VISA library until the first command. Resources are picked by full address or serial number,
+#a session is shared by everyone asking for the same instrument, and after an I/O error restore() reconnects with
+#backoff and re-sends the cached configuration instead of a full *RST.
+
+import time
+import logging
+import pyvisa as visa
+
+VISA_LIBRARY = 'C:\\Windows\\System32\\visa32.dll'
+#Seconds to wait before each reconnect attempt
+RETRY_DELAYS = (0, 0.05, 0.2, 1, 2, 5)
+
+#One ResourceManager per VISA library and one session per instrument, shared by the whole process
+resource_managers = {}
+open_sessions = {}
+
+def getResourceManager(library=VISA_LIBRARY):
+    if library not in resource_managers:
+        resource_managers[library] = visa.ResourceManager(library)
+    return resource_managers[library]
+
+#Session for the instrument matching selector (address, alias or serial number; None = first instrument found).
+#resource_manager is only needed for a non-default backend, e.g. the simulated instruments.
+def openSession(selector=None, resource_manager=None):
+    key = (selector, id(resource_manager))
+    if key not in open_sessions:
+        open_sessions[key] = VisaSession(selector, resource_manager)
+    return open_sessions[key]
+
+#Address of the resource matching selector: exact address, then address containing it (USB addresses carry the
+#serial number, e.g. USB0::0x2A8D::0x0201::MY60043129::0::INSTR), then the serial number field of *IDN?
+def findResource(rm, selector=None):
+    available = rm.list_resources()
+    if not available:
+        raise visa.errors.VisaIOError(visa.constants.StatusCode.error_resource_not_found)
+    if selector is None:
+        return available[0]
+    if selector in available:
+        return selector
+    for address in available:
+        if selector.upper() in address.upper():
+            return address
+    for address in available:
+        try:
+            inst = rm.open_resource(address)
+            try:
+                idn = inst.query('*IDN?').split(',')
+            finally:
+                inst.close()
+        except visa.errors.Error:
+            continue
+        if len(idn) > 2 and idn[2].strip().upper() == selector.upper():
+            return address
+    raise ValueError("No VISA instrument matches '{}', found: {}".format(selector, ", ".join(available)))
+
+class VisaSession:
+    def __init__(self, selector=None, resource_manager=None, timeout=5000):
+        self.selector = selector
+        self.resource_manager = resource_manager
+        self.timeout = timeout
+        self.address = None
+        self.inst = None
+        #commands that bring the instrument from *RST to the state the logger needs, re-sent by restore()
+        self.configuration = []
+        self.reconnects = 0
+
+    def connect(self):
+        rm = self.resource_manager if self.resource_manager != None else getResourceManager()
+        if self.address is None:
+            self.address = findResource(rm, self.selector)
+        self.inst = rm.open_resource(self.address)
+        self.inst.timeout = self.timeout
+        logging.info("Connected to {}".format(self.address))
+
+    @property
+    def connected(self) -> bool:
+        return self.inst != None
+
+    def instrument(self):
+        if self.inst == None:
+            self.connect()
+        return self.inst
+
+    def write(self, command):
+        return self.instrument().write(command)
+
+    def query(self, command):
+        return self.instrument().query(command)
+
+    def query_ascii_values(self, command, **kwargs):
+        return self.instrument().query_ascii_values(command, **kwargs)
+
+    def query_binary_values(self, command, **kwargs):
+        return self.instrument().query_binary_values(command, **kwargs)
+
+    def read_raw(self, size=None):
+        return self.instrument().read_raw(size)
+
+    #Store the configuration and apply it after a full *RST / *CLS
+    def configure(self, commands):
+        self.configuration = list(commands)
+        self.write("*RST")
+        self.write("*CLS")
+        for command in self.configuration:
+            self.write(command)
+
+    #Recover after an error: device clear and re-send the cached configuration. If the instrument does not answer,
+    #drop the connection and reconnect with backoff. Raises the last error when every attempt failed.
+    def restore(self):
+        error = None
+        for delay in RETRY_DELAYS:
+            time.sleep(delay)
+            try:
+                inst = self.instrument()
+                inst.clear()
+                inst.write("ABORt")
+                inst.write("*CLS")
+                for command in self.configuration:
+                    inst.write(command)
+                #make sure the instrument really took it before going back to measuring
+                inst.query("*OPC?")
+                return
+            except (visa.errors.Error, OSError, ValueError) as e:
+                error = e
+                logging.warning("Restoring {} failed: {}".format(self.address or self.selector, e))
+                self.drop()
+                self.reconnects += 1
+        raise error
+
+    #Forget the (probably dead) connection, the next command reconnects
+    def drop(self):
+        if self.inst != None:
+            try:
+                self.inst.close()
+            except Exception:
+                pass
+        self.inst = None
+
+    def close(self):
+        self.drop()
@@ -0,0 +1,195 @@
+#Capture loop that keeps the scope busy: the bus thread only digitizes and transfers, everything that touches the disk
+#(binary save, optional CSV conversion, PNG file) runs on a background writer so the scope is re-armed right away.
+#The screenshot has to come over the same bus as the data, so it is taken only every screenshot_every captures
+#(0 = never) instead of after every one. Every capture gets a timing record of its stages.
+#captureScopes() runs one pipeline per scope on a thread pool, optionally lined up on a shared barrier before every
+#:DIGitize, so several scopes take about as long as the slowest one.
+#With analyze=True the echo and time of flight metrics (WaveformCalculations) are computed from the scaled data right
+#after the capture was handed to the writer, without a file in between; save=False then skips the files altogether.
+#A capture the analysis fails on is still saved, its record gets the error instead of metrics.
+#A WaveformEnsemble passed as ensemble gets channels 1 to 3 of every analyzed capture (segment), one the analysis fails
+#on counts as failed there.
+
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from WaveformStore import capture_type, writeCapture, exportCsv
+from WaveformCalculations import try_capture_metrics, segment_metrics
+
+#Captures waiting for the writer; the bus thread waits (handoff) when the disk falls this far behind
+PIPELINE_DEPTH = 4
+
+class CapturePipeline:
+    #session: connected ScopeSession. Files are base_directory + base_name + " - <capture number>" + .wfb / .csv / .png
+    def __init__(self, session, base_directory, base_name, screenshot_every=0, csv=False, depth=PIPELINE_DEPTH, save=True,
+                 analyze=False, ensemble=None):
+        self.session = session
+        self.base_directory = base_directory
+        self.base_name = base_name
+        self.screenshot_every = screenshot_every
+        self.csv = csv
+        self.save = save
+        self.analyze = analyze or ensemble is not None
+        self.ensemble = ensemble
+        #scaled channels for the analysis, reused between captures
+        self.volts = None
+        self.captures = queue.Queue(maxsize=depth)
+        self.depth = depth
+        self.count = 0
+        self.saved = 0
+        #one record per capture: number, file and seconds spent in every stage
+        self.timings = []
+        self.error = None
+        self.started = time.perf_counter()
+        self.writer = threading.Thread(target=self.writeCaptures, daemon=True)
+        self.writer.start()
+
+    def fileName(self, number) -> str:
+        return "{}{} - {:05d}".format(self.base_directory, self.base_name, number)
+
+    #Take one capture (segments=N for a segmented one) and hand it to the writer. Returns the timing record, the
+    #writer stages are filled in once it is saved. With analyze the record holds the metrics of the capture (a list with
+    #the metrics of every segment for a segmented capture).
+    #barrier: threading.Barrier shared with the other scopes, waited on right before the acquisition starts
+    def capture(self, digitize=True, segments=0, barrier=None):
+        if self.error is not None:
+            raise self.error
+        number = self.count
+        self.count += 1
+        record = {'capture': number, 'file': self.fileName(number) + capture_type}
+        started = time.perf_counter()
+        check_settings = True
+        if barrier is not None:
+            ## the settings check goes before the barrier so the scopes start digitizing together
+            if not segments:
+                self.session.refresh()
+                check_settings = False
+            barrier.wait()
+        synced = time.perf_counter()
+        record['sync'] = synced - started
+        time_tags = None
+        #a new buffer per capture when saving: the previous one may still be waiting for the writer
+        if segments:
+            codes, time_tags = self.session.captureSegments(segments, check_settings, reuse=not self.save)
+        else:
+            codes = self.session.captureCodes(digitize, check_settings, reuse=not self.save)
+        transferred = time.perf_counter()
+        record['transfer'] = transferred - synced
+        if self.save:
+            image = None
+            if self.screenshot_every and number % self.screenshot_every == 0:
+                image = self.session.screenshot()
+            shot = time.perf_counter()
+            record['screenshot'] = shot - transferred
+            self.captures.put((record, codes, time_tags, self.session.metadata(), image))
+            handed = time.perf_counter()
+            record['handoff'] = handed - shot
+        else:
+            handed = transferred
+        if self.analyze:
+            record['metrics'] = self.metrics(codes, segments)
+        record['analyze'] = time.perf_counter() - handed
+        self.timings.append(record)
+        return record
+
+    #Scale the first three channels and compute their metrics, per segment for a segmented capture. A capture (segment)
+    #the analysis fails on gets {'error': ...} instead of metrics.
+    def metrics(self, codes, segments=0):
+        rows = min(3, len(self.session.chs_on))
+        if self.volts is None or self.volts.shape != (rows, codes.shape[1]):
+            self.volts = np.empty((rows, codes.shape[1]))
+        self.session.scaleCodes(codes, rows, out=self.volts)
+        if not segments:
+            metrics = try_capture_metrics(self.session.time_axis, self.volts)
+            if self.ensemble is not None:
+                self.ensemble.addCapture(self.session.time_axis, self.volts, metrics)
+            return metrics
+        metrics = segment_metrics(self.session.time_axis, self.volts)
+        if self.ensemble is not None:
+            self.ensemble.addSegments(self.session.time_axis, self.volts, metrics)
+        return metrics
+
+    def writeCaptures(self):
+        while True:
+            item = self.captures.get()
+            if item is None:
+                break
+            record, codes, time_tags, metadata, image = item
+            if self.error is not None:
+                continue
+            try:
+                started = time.perf_counter()
+                writeCapture(record['file'], codes, time_tags=time_tags, **metadata)
+                saved = time.perf_counter()
+                #scaling to volts only happens for the CSV, the binary file keeps the raw codes
+                if self.csv:
+                    exportCsv(record['file'])
+                exported = time.perf_counter()
+                if image is not None:
+                    with open(self.fileName(record['capture']) + ".png", "wb") as file:
+                        file.write(image)
+                record['save'] = saved - started
+                record['csv'] = exported - saved
+                record['png'] = time.perf_counter() - exported
+                self.saved += 1
+            except Exception as e:
+                self.error = e
+
+    #Wait for the writer to finish every capture handed to it; raises the writer's error if a save failed
+    def close(self):
+        if self.writer.is_alive():
+            self.captures.put(None)
+            self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+    #Average seconds per capture of every stage and the capture rate over the whole run
+    def stageTiming(self) -> str:
+        captured = max(1, len(self.timings))
+        saved = [record for record in self.timings if 'save' in record]
+        written = max(1, len(saved))
+        elapsed = time.perf_counter() - self.started
+        average = lambda records, stage, count: sum(record.get(stage, 0) for record in records) / count
+        return ("{} captures in {:.3f} s ({:.2f} captures/s): sync {:.4f} s, transfer {:.4f} s, analyze {:.4f} s, screenshot {:.4f} s, "
+                "handoff {:.4f} s | writer: save {:.4f} s, csv {:.4f} s, png {:.4f} s, {} saved").format(len(self.timings), elapsed,
+                len(self.timings) / elapsed, average(self.timings, 'sync', captured), average(self.timings, 'transfer', captured),
+                average(self.timings, 'analyze', captured), average(self.timings, 'screenshot', captured),
+                average(self.timings, 'handoff', captured),
+                average(saved, 'save', written), average(saved, 'csv', written), average(saved, 'png', written), self.saved)
+
+#count captures from every session at the same time, one thread (and one writer) per scope. Files are named
+#base_name + " - <scope serial number> - <capture number>". barrier=True lines the scopes up before every acquisition
+#(a software trigger, good to a few ms); a scope that fails releases the others from the barrier and its error is raised
+#once every scope has stopped. Returns the CapturePipeline of every scope, keyed by serial number.
+def captureScopes(sessions, base_directory, base_name, count, barrier=False, screenshot_every=0, csv=False, segments=0,
+                  save=True, analyze=False):
+    shared = threading.Barrier(len(sessions)) if barrier else None
+    pipelines = {}
+
+    def run(index, session):
+        try:
+            if session.inst is None:
+                session.connect()
+            name = session.serial or "scope {}".format(index + 1)
+            pipeline = pipelines[name] = CapturePipeline(session, base_directory, "{} - {}".format(base_name, name),
+                                                         screenshot_every, csv, save=save, analyze=analyze)
+            try:
+                for _ in range(count):
+                    pipeline.capture(segments=segments, barrier=shared)
+            finally:
+                pipeline.close()
+        except BaseException:
+            if shared is not None:
+                shared.abort()
+            raise
+
+    with ThreadPoolExecutor(max_workers=len(sessions)) as pool:
+        futures = [pool.submit(run, index, session) for index, session in enumerate(sessions)]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    ## a BrokenBarrierError is only the other scopes being stopped, report the error that caused it
+    errors.sort(key=lambda error: isinstance(error, threading.BrokenBarrierError))
+    if errors:
+        raise errors[0]
+    return pipelines
@@ -0,0 +1,332 @@
+#Simulated Keysight InfiniiVision X-series oscilloscope behind a pyvisa style ResourceManager, for running quickscan
+#and the waveform tools without a scope.
+#Channels 1-3 carry a TDC1000 style ultrasonic measurement: start pulse on channel 1, transducer signal with the noise
+#echo and the water level echo on channel 2, stop pulse on channel 3. :WAVeform:DATA? and :DISPlay:DATA? answer with
+#IEEE 488.2 definite length blocks, every transfer costs latency + bytes / bandwidth (+ overhead per chunk) of real time.
+#Usage: python InfiniiVisionSimulator.py [file name] [latency s] [bandwidth bytes/s]
+#       python InfiniiVisionSimulator.py check     (the viRead path of ScopeSession.readBlockInto, see checkBlockReads)
+
+import sys
+import time
+import zlib
+import struct
+import numpy as np
+import SimulatedVisa
+from SimulatedVisa import SimulatedLink, SimulatedResource, ieeeBlock, shortForm
+
+SIM_ADDRESS = 'USB0::0x0957::0x17A6::MY61410127::0::INSTR'
+SIM_IDN = 'KEYSIGHT TECHNOLOGIES,DSO-X 3024T,MY61410127,07.50.2021102830'
+#Acquisition memory (RAW points) and screen record (NORMal points)
+MEMORY_DEPTH = 1000000
+SCREEN_POINTS = 62500
+#Long forms of the keywords quickscan uses (SCPI is case insensitive, a keyword is its short or long form)
+LONG_FORMS = {'WAVEFORM': 'WAV', 'CHANNEL': 'CHAN', 'DISPLAY': 'DISP', 'PREAMBLE': 'PRE', 'POINTS': 'POIN', 'FORMAT': 'FORM',
+              'BYTEORDER': 'BYT', 'UNSIGNED': 'UNS', 'SOURCE': 'SOUR', 'ACQUIRE': 'ACQ', 'DIGITIZE': 'DIG', 'TIMEBASE': 'TIM',
+              'SCALE': 'SCAL', 'OFFSET': 'OFFS', 'POSITION': 'POS', 'UNITS': 'UNIT', 'HARDCOPY': 'HARD', 'INKSAVER': 'INKS',
+              'MESSAGE': 'MESS', 'CLEAR': 'CLE', 'SYSTEM': 'SYST', 'SETUP': 'SET', 'SINGLE': 'SING', 'ERROR': 'ERR',
+              'SEGMENTED': 'SEGM', 'COUNT': 'COUN', 'INDEX': 'IND', 'NORMAL': 'NORM', 'AVERAGE': 'AVER', 'HRESOLUTION': 'HRES',
+              'ASCII': 'ASC', 'LSBFIRST': 'LSBF', 'MSBFIRST': 'MSBF', 'MAXIMUM': 'MAX', 'XLIST': 'XLIS', 'RTIME': 'RTIM'}
+FORMATS = {'BYTE': 0, 'WORD': 1, 'ASC': 4}
+TYPES = {'NORM': 0, 'PEAK': 1, 'AVER': 2, 'HRES': 3}
+
+#Mnemonic argument (CHANnel2, NORMal, ...) to its upper case short form
+def argument(value):
+    return shortForm(value.strip().strip('"'), LONG_FORMS)
+
+#Small but real PNG (grey noise compresses to roughly the size of a scope screenshot)
+def screenshotPng(width=800, height=480, seed=1):
+    rng = np.random.default_rng(seed)
+    pixels = (rng.integers(0, 4, (height, width), dtype=np.uint8) * 64)
+    rows = np.concatenate((np.zeros((height, 1), dtype=np.uint8), pixels), axis=1).tobytes()
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows, 6)) + chunk(b'IEND', b''))
+
+class SimulatedInfiniiVision(SimulatedResource):
+    LONG_FORMS = LONG_FORMS
+
+    def __init__(self, address=SIM_ADDRESS, link=None, idn=SIM_IDN, memory_depth=MEMORY_DEPTH, channels=4,
+                 time_of_flight=250e-6, acquisition_overhead=0.02, screenshot_time=0.15, trigger_interval=1e-3, seed=1):
+        SimulatedResource.__init__(self, address, link if link != None else SimulatedLink())
+        self.idn = idn
+        self.memory_depth = memory_depth
+        self.channels = channels
+        self.time_of_flight = time_of_flight
+        self.acquisition_overhead = acquisition_overhead
+        self.screenshot_time = screenshot_time
+        #time between triggers, i.e. between the segments of a segmented acquisition
+        self.trigger_interval = trigger_interval
+        self.rng = np.random.default_rng(seed)
+        self.png = screenshotPng(seed=seed)
+        self.acquisitions = 1
+        self.blocks = {}
+        self.reset()
+        self.newAcquisition(1)
+        #left in the export format of a previous quickscan run; quickscan reads the preambles before setting it
+        self.format = 'WORD'
+        self.unsigned = False
+        self.byteorder_lsb = True
+
+    def reset(self):
+        self.display = [1, 1, 1, 0][:self.channels] + [0] * max(0, self.channels - 4)
+        self.scale = [2.0, 0.5, 2.0, 1.0][:self.channels] + [1.0] * max(0, self.channels - 4)
+        self.offset = [0.0, 1.65, 0.0, 0.0][:self.channels] + [0.0] * max(0, self.channels - 4)
+        self.timebase_scale = 50e-6
+        self.timebase_position = 0.0
+        self.acquire_type = 'NORM'
+        self.running = False
+        self.source = 1
+        self.format = 'BYTE'
+        self.unsigned = True
+        self.byteorder_lsb = False
+        self.points_mode = 'NORM'
+        self.points_requested = None
+        self.acquire_mode = 'RTIM'
+        self.segment_count = 2
+        self.segment_index = 1
+        self.segments_all = False
+        self.blocks = {}
+
+    #Points per segment: acquisition memory is shared by the segments
+    def available(self):
+        memory = self.memory_depth // self.segment_count if self.acquire_mode == 'SEGM' else self.memory_depth
+        return min(SCREEN_POINTS, memory) if self.points_mode == 'NORM' else memory
+
+    #Echo arrival and trigger time tag of every segment (one segment outside segmented mode)
+    def newAcquisition(self, segments):
+        self.acquisitions += 1
+        self.segments_acquired = segments
+        self.arrivals = self.time_of_flight * (1 + self.rng.normal(0, 0.002, segments))
+        self.time_tags = np.arange(segments) * self.trigger_interval + self.rng.normal(0, 1e-9, segments)
+        self.time_tags[0] = 0.0
+
+    def points(self):
+        available = self.available()
+        return available if self.points_requested is None else max(100, min(self.points_requested, available))
+
+    def preamble(self, channel):
+        points = self.points()
+        span = 10 * self.timebase_scale
+        if self.format == 'BYTE':
+            yinc, yref = 10 * self.scale[channel - 1] / 256, 128 if self.unsigned else 0
+        else:
+            yinc, yref = 10 * self.scale[channel - 1] / 65536, 32768 if self.unsigned else 0
+        return (FORMATS[self.format], TYPES[self.acquire_type], points, 1, span / points,
+                self.timebase_position - span / 2, 0, yinc, self.offset[channel - 1], yref)
+
+    #Volts of one channel for one acquisition (segment)
+    def signal(self, channel, t, start, time_of_flight):
+        noise = self.rng.normal(0, 0.002, len(t))
+        arrival = start + time_of_flight
+        if channel == 1:
+            return noise + np.where((t >= start) & (t < start + 10e-6), 5.0, 0.0)
+        if channel == 3:
+            return noise + np.where((t >= arrival) & (t < arrival + 5e-6), 5.0, 0.0)
+        if channel == 2:
+            after = np.clip(t - start, 0, None)
+            ringing = np.where(t >= start, np.sin(2 * np.pi * 1e6 * after) * np.exp(-after / 30e-6), 0.0)
+            echo = 0.5 * np.sin(2 * np.pi * 1e6 * (t - arrival)) * np.exp(-((t - arrival - 10e-6) / 8e-6) ** 2)
+            return 1.65 + noise + ringing + echo
+        return noise
+
+    #IEEE block of the current source, built once per acquisition and settings
+    def waveformData(self):
+        channel = self.source
+        #every segment in one block with :WAVeform:SEGMented:ALL ON, otherwise the one selected by :ACQuire:SEGMented:INDex
+        segments = range(self.segments_acquired) if self.segments_all else [min(self.segment_index, self.segments_acquired) - 1]
+        key = (self.acquisitions, channel, self.points(), self.format, self.unsigned, self.byteorder_lsb, self.acquire_type,
+               self.scale[channel - 1], self.offset[channel - 1], self.timebase_scale, self.timebase_position, tuple(segments))
+        if key not in self.blocks:
+            pre = self.preamble(channel)
+            points = pre[2]
+            t = pre[5] + np.arange(points) * pre[4]
+            start = pre[5] + 0.05 * 10 * self.timebase_scale
+            volts = np.concatenate([self.signal(channel, t, start, self.arrivals[segment]) for segment in segments])
+            codes = np.round((volts - pre[8]) / pre[7] + pre[9])
+            if self.format == 'ASC':
+                payload = ','.join('{:+.6E}'.format(value) for value in volts.tolist()).encode()
+            elif self.format == 'BYTE':
+                payload = np.clip(codes, 0, 255).astype(np.uint8) if self.unsigned else np.clip(codes, -128, 127).astype(np.int8)
+                payload = payload.tobytes()
+            else:
+                if self.unsigned:
+                    payload = np.clip(codes, 0, 65535).astype('<u2' if self.byteorder_lsb else '>u2')
+                else:
+                    payload = np.clip(codes, -32768, 32767).astype('<i2' if self.byteorder_lsb else '>i2')
+                payload = payload.tobytes()
+            #only the newest acquisition is kept
+            self.blocks = {k: v for k, v in self.blocks.items() if k[0] == self.acquisitions}
+            self.blocks[key] = ieeeBlock(payload)
+        return self.blocks[key]
+
+    #A segmented acquisition fills every segment, one per trigger
+    def digitize(self):
+        segments = self.segment_count if self.acquire_mode == 'SEGM' else 1
+        self.newAcquisition(segments)
+        self.running = False
+        self.segment_index = 1
+        self.busy_until = max(self.busy_until, time.monotonic()) + self.acquisition_overhead + 10 * self.timebase_scale
+        if segments > 1:
+            self.busy_until += (segments - 1) * max(self.trigger_interval, 10 * self.timebase_scale)
+
+    def channelCommand(self, channel, node, arguments):
+        value = argument(arguments) if arguments else ''
+        if node == 'DISP?':
+            return '{}\n'.format(self.display[channel - 1]).encode()
+        if node == 'DISP':
+            self.display[channel - 1] = 1 if value in ('ON', '1') else 0
+        elif node == 'UNIT?':
+            return b'VOLT\n'
+        elif node == 'SCAL?':
+            return '{:+.6E}\n'.format(self.scale[channel - 1]).encode()
+        elif node == 'SCAL':
+            self.scale[channel - 1] = float(arguments)
+        elif node == 'OFFS?':
+            return '{:+.6E}\n'.format(self.offset[channel - 1]).encode()
+        elif node == 'OFFS':
+            self.offset[channel - 1] = float(arguments)
+        else:
+            return self.undefined('CHAN{}:{}'.format(channel, node))
+        return None
+
+    def execute(self, header, arguments):
+        value = argument(arguments) if arguments else ''
+        if header == '*RST':
+            self.reset()
+        elif header == '*CLS':
+            self.errors = []
+        elif header == '*IDN?':
+            return self.idn.encode() + b'\n'
+        elif header == '*OPC?':
+            return b'1\n'
+        elif header == 'SYST:ERR?':
+            return self.systemError()
+        elif header.startswith('CHAN') and ':' in header:
+            channel, node = header.split(':', 1)
+            channel = int(channel[4:])
+            if not 1 <= channel <= self.channels:
+                return self.undefined(header)
+            return self.channelCommand(channel, node, arguments)
+        elif header == 'TIM:SCAL?':
+            return '{:+.6E}\n'.format(self.timebase_scale).encode()
+        elif header == 'TIM:SCAL':
+            self.timebase_scale = float(arguments)
+        elif header == 'TIM:POS?':
+            return '{:+.6E}\n'.format(self.timebase_position).encode()
+        elif header == 'TIM:POS':
+            self.timebase_position = float(arguments)
+        elif header == 'ACQ:TYPE?':
+            return self.acquire_type.encode() + b'\n'
+        elif header == 'ACQ:TYPE':
+            self.acquire_type = value
+        elif header == 'ACQ:MODE?':
+            return self.acquire_mode.encode() + b'\n'
+        elif header == 'ACQ:MODE':
+            self.acquire_mode = 'SEGM' if value.startswith('SEGM') else 'RTIM'
+        elif header == 'ACQ:SEGM:COUN?':
+            return '{:+d}\n'.format(self.segment_count).encode()
+        elif header == 'ACQ:SEGM:COUN':
+            self.segment_count = max(2, min(1000, int(float(arguments))))
+        elif header == 'ACQ:SEGM:IND?':
+            return '{:+d}\n'.format(self.segment_index).encode()
+        elif header == 'ACQ:SEGM:IND':
+            self.segment_index = max(1, min(self.segments_acquired, int(float(arguments))))
+        elif header == 'WAV:SEGM:ALL':
+            self.segments_all = value in ('1', 'ON')
+        elif header == 'WAV:SEGM:COUN?':
+            return '{:+d}\n'.format(self.segments_acquired if self.acquire_mode == 'SEGM' else 0).encode()
+        elif header == 'WAV:SEGM:TTAG?':
+            return '{:+.12E}\n'.format(self.time_tags[self.segment_index - 1]).encode()
+        elif header == 'WAV:SEGM:XLIS?':
+            if value != 'TTAG':
+                return self.undefined(header + ' ' + value)
+            return (','.join('{:+.12E}'.format(tag) for tag in self.time_tags.tolist()) + '\n').encode()
+        elif header == 'DIG':
+            self.digitize()
+        elif header == 'SING':
+            self.digitize()
+        elif header == 'RUN':
+            self.running = True
+            self.newAcquisition(1)
+        elif header == 'STOP':
+            self.running = False
+        elif header == 'WAV:SOUR':
+            self.source = int(value[4:])
+        elif header == 'WAV:SOUR?':
+            return 'CHAN{}\n'.format(self.source).encode()
+        elif header == 'WAV:FORM':
+            self.format = value
+        elif header == 'WAV:FORM?':
+            return self.format.encode() + b'\n'
+        elif header == 'WAV:BYT':
+            self.byteorder_lsb = value.startswith('LSBF')
+        elif header == 'WAV:UNS':
+            self.unsigned = value in ('1', 'ON')
+        elif header == 'WAV:POIN:MODE':
+            self.points_mode = 'NORM' if value.startswith('NORM') else 'RAW' if value == 'RAW' else 'MAX'
+        elif header == 'WAV:POIN':
+            self.points_requested = None if value.startswith('MAX') else int(float(arguments))
+        elif header == 'WAV:POIN?':
+            return '{}\n'.format(self.points()).encode()
+        elif header == 'WAV:PRE?':
+            pre = self.preamble(self.source)
+            return '{:+d},{:+d},{:+d},{:+d},{:+.6E},{:+.6E},{:+d},{:+.6E},{:+.6E},{:+d}\n'.format(*pre).encode()
+        elif header == 'WAV:DATA?':
+            if not self.display[self.source - 1]:
+                self.errors.append('-222,"Data out of range"')
+                return ieeeBlock(b'')
+            return self.waveformData()
+        elif header == 'DISP:DATA?':
+            self.busy_until = max(self.busy_until, time.monotonic()) + self.screenshot_time
+            return ieeeBlock(self.png)
+        elif header in ('SYST:DSP', 'HARD:INKS', 'DISP:MESS:CLE'):
+            pass
+        else:
+            return self.undefined(header)
+        return None
+
+#ResourceManager with the simulated scope at SIM_ADDRESS unless other instruments are given
+class SimulatedResourceManager(SimulatedVisa.SimulatedResourceManager):
+    def __init__(self, instruments=None):
+        SimulatedVisa.SimulatedResourceManager.__init__(self, instruments if instruments != None else {SIM_ADDRESS: SimulatedInfiniiVision})
+
+#Transfer the same capture through read_bytes and through the ctypes viRead path of ScopeSession.readBlockInto, the
+#one the VISA libraries of real scopes take, and check both give the same codes. The blocks are read in pieces of
+#chunk_bytes and every viRead returns at most read_limit bytes, so the pieces are split and the reads partial.
+def checkBlockReads(chunk_bytes=4096, read_limit=1000):
+    from ScopeSession import ScopeSession
+    captures = []
+    for library in (False, True):
+        scope = SimulatedInfiniiVision()
+        if library:
+            scope.attachLibrary(read_limit)
+        session = ScopeSession(SIM_ADDRESS, SimulatedResourceManager({SIM_ADDRESS: scope}), chunk_bytes=chunk_bytes, profile=False)
+        session.connect()
+        captures.append(session.captureCodes(digitize=False))
+        session.close()
+    if scope.visalib.partial == 0 or scope.visalib.calls <= captures[1].nbytes // chunk_bytes:
+        raise AssertionError("viRead was not called with split and partial reads ({} calls, {} partial)".format(
+            scope.visalib.calls, scope.visalib.partial))
+    if not np.array_equal(captures[0], captures[1]):
+        raise AssertionError("viRead and read_bytes transfers differ")
+    print("{} bytes read the same through viRead ({} calls, {} partial) and read_bytes".format(captures[1].nbytes,
+          scope.visalib.calls, scope.visalib.partial))
+
+#Run quickscan against the simulated scope
+def main():
+    if sys.argv[1:2] == ['check']:
+        checkBlockReads()
+        return
+    from oscilloscope_tile_testing import quickscan
+    file_name = sys.argv[1] if len(sys.argv) > 1 else "simulated"
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    bandwidth = float(sys.argv[3]) if len(sys.argv) > 3 else 8e6
+    link = SimulatedLink(latency, bandwidth)
+    rm = SimulatedResourceManager({SIM_ADDRESS: lambda address: SimulatedInfiniiVision(address, link)})
+    started = time.perf_counter()
+    quickscan(file_name, rm)
+    print("quickscan took {:.3f} s, {} transactions, {} bytes read".format(time.perf_counter() - started, link.transactions, link.bytes_read))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#Persistent connection to an InfiniiVision scope for repeated captures.
+#The scope is discovered once (IDN, channels that are on and have data, units, export format, points, preambles) and the
+#result is cached. Every capture first sends one compound query with the settings that affect the preambles and only
+#re-runs the discovery when the answer changed, so a repeated capture is that settings query, one :DIGitize and one data
+#query per channel. check_settings=False skips the settings query when nothing can have changed the scope in between.
+#Export format, points mode and read size come from the transfer profile TransferTuner measured for the scope model and
+#firmware (transfer_profiles.json) unless they are given explicitly.
+
+import os
+import json
+import time
+import ctypes
+import numpy as np
+import pyvisa as visa
+from WaveformStore import writeCapture
+
+VISA_ADDRESS = 'USB0::0x0957::0x17A6::MY61410127::0::INSTR'
+VISA_LIBRARY = 'C:\\Windows\\System32\\visa32.dll'
+## Number of Points to request
+USER_REQUESTED_POINTS = 50000
+## Waveform data is read in pieces of at most this many bytes straight into the capture buffer
+TRANSFER_CHUNK = 1 << 20
+## Best transfer settings per scope model and firmware, written by TransferTuner. They only hold for this machine and
+## its scopes, so the file is not versioned (.gitignore)
+PROFILE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transfer_profiles.json")
+
+#Saved transfer profile of a scope model and firmware, empty if it was never tuned
+def loadProfile(model, firmware, path=PROFILE_FILE) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get("{} {}".format(model, firmware), {})
+
+def saveProfile(model, firmware, profile, path=PROFILE_FILE):
+    profiles = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profiles = json.load(f)
+    profiles["{} {}".format(model, firmware)] = profile
+    with open(path, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+
+class ScopeSession:
+    #points, chunk_bytes, waveform_format ("WORD" / "BYTE") and points_mode ("RAW" / "NORMal"): None uses the transfer
+    #profile of the scope (profile=True) or the defaults (USER_REQUESTED_POINTS, TRANSFER_CHUNK, WORD, RAW)
+    def __init__(self, address=VISA_ADDRESS, rm=None, points=None, timeout=5000, chunk_bytes=None, waveform_format=None,
+                 points_mode=None, profile=True):
+        self.address = address
+        self.rm = rm
+        self.requested_points = points
+        self.timeout = timeout
+        self.chunk_bytes = chunk_bytes
+        self.waveform_format = waveform_format
+        self.requested_points_mode = points_mode
+        self.use_profile = profile
+        self.profile = {}
+        self.inst = None
+        #capture buffer reused by captureCodes()
+        self.codes = None
+        self.settings = None
+        self.discoveries = 0
+        self.captures = 0
+
+    #Open the connection and parse *IDN? (model, serial number, firmware, number of analog channels)
+    def connect(self):
+        if self.rm is None:
+            self.rm = visa.ResourceManager(VISA_LIBRARY)
+        print('\nConnecting to: {}'.format(self.address))
+        self.inst = self.rm.open_resource(self.address)
+        # Set I/O timeout
+        self.inst.timeout = self.timeout
+        # Clear the remote interface
+        self.inst.clear()
+        self.idn = str(self.inst.query('*IDN?')).strip()
+        print('Connected to: {}'.format(self.idn))
+        ## IDN parts are separated by commas
+        idn = self.idn.split(',')
+        self.model = idn[1].strip()
+        self.serial = idn[2].strip() if len(idn) > 2 else ""
+        ## Firmware revision, e.g. 07.50.2021102830 -> 7.5
+        self.firmware = idn[3].strip() if len(idn) > 3 else "0"
+        self.fw = float(self.firmware[:5])
+        ## The PXIe scopes (M942xA) have 2 channels, the others have the channel count as second last character: DSO-X 3024T
+        if self.model[1] == "9" or not self.model[-2].isdigit():
+            self.number_analog_chs = 2
+        else:
+            self.number_analog_chs = int(self.model[-2])
+        ## Only the 5000/6000/7000 series (DSO6104A, MSO7034B, ...) use the older screenshot command, every other model
+        ## (and any model that is not recognized) is treated as an X-Series
+        if self.model[:3] in ("DSO", "MSO") and self.model[3:4] in ("5", "6", "7") and self.model[4:7].isdigit():
+            self.generation = "Older_Series"
+        else:
+            self.generation = "X_Series"
+        self.profile = loadProfile(self.model, self.firmware) if self.use_profile else {}
+        self.settings = None
+
+    #Explicit setting, else the one from the transfer profile, else default
+    def transferSetting(self, name, value, default):
+        return value if value is not None else self.profile.get(name, default)
+
+    #Settings that change the channel list, units or preambles, read with one compound query
+    def settingsQuery(self) -> str:
+        query = ":TIMebase:SCALe?;POSition?;:ACQuire:TYPE?;MODE?;SEGMented:COUNt?"
+        for ch in range(1, self.number_analog_chs + 1):
+            query += ";:CHANnel{}:DISPlay?;SCALe?;OFFSet?;UNITs?".format(ch)
+        return query
+
+    def readSettings(self) -> str:
+        return str(self.inst.query(self.settingsQuery())).strip()
+
+    #Find which channels are on and have acquired data, set up the export and cache units and preambles
+    def discover(self):
+        inst = self.inst
+        ## MAX mode works for all acquisition types, adjusted below for the acquisition type
+        inst.write(":WAVeform:POINts:MODE MAX")
+        self.chs_on = []
+        self.ch_units = {}
+        for ch in range(1, self.number_analog_chs + 1):
+            on_off = int(inst.query(":CHANnel{}:DISPlay?".format(ch)))
+            acquired = int(inst.query(":WAVeform:SOURce CHANnel{};POINts?".format(ch))) if on_off == 1 else 0
+            if acquired == 0 or on_off == 0:
+                inst.write(":CHANnel{}:DISPlay OFF".format(ch))
+            else:
+                self.chs_on.append(ch)
+                self.ch_units[ch] = str(inst.query(":CHANnel{}:UNITs?".format(ch))).strip()
+        if not self.chs_on:
+            return
+
+        ## Setup data export. The ADC is 8 bits, so BYTE only loses resolution with averaging or high resolution
+        ## acquisitions, which always use WORD unless BYTE is asked for explicitly.
+        self.acq_type = str(inst.query(":ACQuire:TYPE?")).strip()
+        if self.waveform_format is not None:
+            self.format = self.waveform_format
+        else:
+            self.format = "WORD" if self.acq_type in ("AVER", "HRES") else self.profile.get('format', "WORD")
+        inst.write(":WAVeform:FORMat " + self.format)
+        inst.write(":WAVeform:BYTeorder LSBFirst")
+        inst.write(":WAVeform:UNSigned 0")
+        ## signed codes of 1 or 2 bytes
+        self.code_dtype = '<i1' if self.format == "BYTE" else '<i2'
+        self.read_chunk = self.transferSetting('chunk_bytes', self.chunk_bytes, TRANSFER_CHUNK)
+        inst.chunk_size = self.read_chunk
+
+        ## :WAVeform:POINts:MODE RAW is the full acquisition memory, NORMal the screen record (needed for AVER/HRES)
+        if self.acq_type in ("AVER", "HRES"):
+            self.points_mode = "NORMal"
+        else:
+            self.points_mode = self.transferSetting('points_mode', self.requested_points_mode, "RAW")
+        inst.write(":WAVeform:SOURce CHANnel{}".format(self.chs_on[0]))
+        inst.write(":WAVeform:POINts MAX")
+        inst.write(":WAVeform:POINts:MODE " + self.points_mode)
+        available = max(100, int(inst.query(":WAVeform:POINts?")))
+        requested = self.transferSetting('points', self.requested_points, USER_REQUESTED_POINTS)
+        ## NORMal from the transfer profile must not lower the point count: the screen record depends on the timebase and
+        ## can be shorter than what was requested, RAW is used then
+        if (self.points_mode != "RAW" and requested > available and self.requested_points_mode is None
+                and self.acq_type not in ("AVER", "HRES")):
+            self.points_mode = "RAW"
+            inst.write(":WAVeform:POINts:MODE RAW")
+            available = max(100, int(inst.query(":WAVeform:POINts?")))
+        points = available if requested > available or self.acq_type == "PEAK" else requested
+        inst.write(":WAVeform:POINts {}".format(points))
+        ## The scope may not give exactly what was asked for
+        self.points = int(inst.query(":WAVeform:POINts?"))
+
+        ## Preambles: format, type, points, count, X increment, X origin, X reference, Y increment, Y origin, Y reference
+        self.preambles = {}
+        for ch in self.chs_on:
+            pre = inst.query(":WAVeform:SOURce CHANnel{};PREamble?".format(ch)).split(',')
+            self.preambles[ch] = [float(value) for value in pre]
+        pre = self.preambles[self.chs_on[0]]
+        ## Peak detect returns two points (low and high) per time bucket
+        self.points_multiplier = 2 if self.acq_type == "PEAK" else 1
+        self.x_increment, self.x_origin, self.x_reference = pre[4], pre[5], pre[6]
+        self.time_axis = ((np.arange(self.points) - self.x_reference) * self.x_increment) + self.x_origin
+        if self.acq_type == "PEAK":
+            self.time_axis = np.repeat(self.time_axis, 2)
+        self.transfer_bytes = self.points_multiplier * self.points * np.dtype(self.code_dtype).itemsize
+        self.settings = self.readSettings()
+        self.discoveries += 1
+
+    #Discover on first use and again whenever the scope settings changed since the last discovery
+    def refresh(self):
+        if self.inst is None:
+            self.connect()
+        if self.settings is None or self.readSettings() != self.settings:
+            self.discover()
+
+    #Raw codes of one channel read straight into out (code_dtype array of the channel's points)
+    def channelCodes(self, ch, out):
+        self.inst.write(":WAVeform:SOURce CHANnel{};DATA?".format(ch))
+        received = readBlockInto(self.inst, memoryview(out).cast('B'), self.read_chunk)
+        if received != out.nbytes:
+            raise IOError("Channel {} sent {} bytes, expected {}".format(ch, received, out.nbytes))
+        return out
+
+    #Scaled_waveform_Data = [(Unscaled_Waveform_Data - Y_reference) * Y_increment] + Y_origin, computed into out
+    #without temporaries
+    def scale(self, ch, codes, out=None):
+        pre = self.preambles[ch]
+        out = np.subtract(codes, pre[9], out=out, dtype=np.float64)
+        np.multiply(out, pre[7], out=out)
+        np.add(out, pre[8], out=out)
+        return out
+
+    #Capture buffer: the session's own one (overwritten by the next capture) or, with reuse=False, a new one the caller keeps
+    def buffer(self, shape, reuse=True):
+        if not reuse:
+            return np.empty(shape, dtype=self.code_dtype)
+        if self.codes is None or self.codes.shape != shape or self.codes.dtype != self.code_dtype:
+            self.codes = np.empty(shape, dtype=self.code_dtype)
+        return self.codes
+
+    #Raw codes of one capture of every channel that is on, as a (channels, points) int16 (int8 for BYTE) array.
+    #The data goes from the bus into the buffer in pieces of read_chunk bytes, so memory use does not grow with the record
+    #length beyond the buffer itself. Without out the buffer comes from buffer(shape, reuse).
+    #digitize=False transfers what the scope already holds (stopped scope, like quickscan).
+    def captureCodes(self, digitize=True, check_settings=True, out=None, reuse=True):
+        if self.inst is None or self.settings is None or check_settings:
+            self.refresh()
+        if not self.chs_on:
+            raise IOError("No data has been acquired on any channel")
+        if digitize:
+            self.inst.write(":DIGitize")
+        if out is None:
+            out = self.buffer((len(self.chs_on), self.points_multiplier * self.points), reuse)
+        for i, ch in enumerate(self.chs_on):
+            self.channelCodes(ch, out[i])
+        self.captures += 1
+        return out
+
+    #Segmented acquisition: count triggers go into the segments of the acquisition memory with one :DIGitize, then each
+    #channel comes over in one transfer with every segment (:WAVeform:SEGMented:ALL) and the trigger time tags in one query.
+    #Returns the (channels, segments * points) codes and the time tag (s, relative to the first trigger) of every segment.
+    #restore=True puts the scope back in real time mode afterwards; leave it False for back to back segmented captures.
+    def captureSegments(self, count, check_settings=True, out=None, restore=True, reuse=True):
+        if self.inst is None:
+            self.connect()
+        self.inst.write(":ACQuire:MODE SEGMented")
+        self.inst.write(":ACQuire:SEGMented:COUNt {}".format(count))
+        ## points per segment and the preambles depend on the segment count, refresh() notices the change
+        if self.inst is None or self.settings is None or check_settings:
+            self.refresh()
+        if not self.chs_on:
+            raise IOError("No data has been acquired on any channel")
+        self.inst.write(":DIGitize")
+        acquired = int(self.inst.query(":WAVeform:SEGMented:COUNt?"))
+        self.inst.write(":WAVeform:SEGMented:ALL ON")
+        try:
+            if out is None:
+                out = self.buffer((len(self.chs_on), acquired * self.points_multiplier * self.points), reuse)
+            for i, ch in enumerate(self.chs_on):
+                self.channelCodes(ch, out[i])
+            time_tags = np.array(self.inst.query_ascii_values(":WAVeform:SEGMented:XLISt? TTAG"), dtype=np.float64)
+        finally:
+            self.inst.write(":WAVeform:SEGMented:ALL OFF")
+            if restore:
+                self.inst.write(":ACQuire:MODE RTIMe")
+        self.captures += 1
+        return out, time_tags
+
+    #Scaled data of the first rows channels of a capture (default all), into out if given
+    def scaleCodes(self, codes, rows=None, out=None):
+        rows = len(self.chs_on) if rows is None else min(rows, len(self.chs_on))
+        if out is None:
+            out = np.empty((rows, codes.shape[1]))
+        for i in range(rows):
+            self.scale(self.chs_on[i], codes[i], out=out[i])
+        return out
+
+    #One capture of every channel that is on: returns the time axis and a (channels, points) array of scaled data
+    def capture(self, digitize=True, check_settings=True):
+        return self.time_axis, self.scaleCodes(self.captureCodes(digitize, check_settings))
+
+    #What writeCapture needs besides the codes, as of the last discovery
+    def metadata(self) -> dict:
+        return {'channels': list(self.chs_on), 'units': dict(self.ch_units), 'preambles': dict(self.preambles),
+                'idn': self.idn, 'acq_type': self.acq_type}
+
+    #Write raw codes of a capture with the cached preambles and units (see WaveformStore)
+    def save(self, filename, codes, time_tags=None):
+        writeCapture(filename, codes, time_tags=time_tags, **self.metadata())
+
+    #PNG screenshot of the scope display, without the IEEE block header
+    def screenshot(self) -> bytes:
+        ## Turn off previously displayed (non-error) messages
+        self.inst.query(':SYSTEM:DSP "";*OPC?')
+        self.inst.write(":HARDCOPY:INKSAVER OFF")
+        if self.generation == "Older_Series":
+            ## The older InfiniiVisions have 3 parameters
+            self.inst.write(":DISPlay:DATA? PNG, SCREEN, COLOR")
+        else:
+            if self.fw >= 7.2:
+                ## Gets rid of the "Remote Operation Complete" system message
+                self.inst.write(":DISPlay:MESSage:CLEar")
+            self.inst.write(":DISPlay:DATA? PNG,COLor")
+        return binblock_raw(self.inst.read_raw())
+
+    def columnTitles(self) -> str:
+        return "Time (s)," + ",".join("Channel {} ({})".format(ch, self.ch_units[ch]) for ch in self.chs_on) + "\n"
+
+    def close(self):
+        if self.inst is not None:
+            self.inst.close()
+        self.inst = None
+        self.settings = None
+
+#Strip the IEEE 488.2 definite length header off a binary block (#<digits><length><data>)
+def binblock_raw(data_in):
+    startpos = data_in.find(b"#")
+    if startpos < 0:
+        raise IOError("No start of block found")
+    size_of_length = int(data_in[startpos + 1:startpos + 2])
+    image_size = int(data_in[startpos + 2:startpos + 2 + size_of_length])
+    offset = startpos + 2 + size_of_length
+    return data_in[offset:offset + image_size]
+
+#Read the IEEE 488.2 definite length block of the pending response into view (writable bytes memoryview) in pieces
+#of at most chunk_bytes, then the termination character. Returns the number of data bytes.
+#With a ctypes VISA library (NI / Keysight IO Libraries) viRead writes into the buffer directly, otherwise every piece
+#is read with read_bytes and copied in.
+def readBlockInto(inst, view, chunk_bytes=TRANSFER_CHUNK):
+    header = inst.read_bytes(2)
+    if header[:1] != b"#":
+        raise IOError("No start of block found")
+    length = int(inst.read_bytes(int(header[1:2])))
+    if length > len(view):
+        raise IOError("Block of {} bytes does not fit the {} byte buffer".format(length, len(view)))
+    lib = getattr(getattr(inst, 'visalib', None), 'lib', None)
+    vi_read = getattr(lib, 'viRead', None)
+    received = 0
+    while received < length:
+        count = min(chunk_bytes, length - received)
+        if vi_read is not None:
+            target = (ctypes.c_ubyte * count).from_buffer(view[received:received + count])
+            returned = ctypes.c_uint32()
+            status = vi_read(inst.session, target, count, ctypes.byref(returned))
+            if status < 0:
+                raise visa.errors.VisaIOError(status)
+            count = returned.value
+        else:
+            data = inst.read_bytes(count)
+            count = len(data)
+            view[received:received + count] = data
+        if count == 0:
+            raise IOError("Block ended after {} of {} bytes".format(received, length))
+        received += count
+    ## Termination character after the block
+    inst.read_bytes(1)
+    return received
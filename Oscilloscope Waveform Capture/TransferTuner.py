@@ -0,0 +1,93 @@
+#Transfer benchmark for an InfiniiVision scope: sweeps the export format (BYTE / WORD), points mode (RAW / NORMal),
+#point count and read size over the acquisition already on the scope and records MB/s, points/s and the round trip of
+#a short query. The fastest format, points mode and read size at the normal point count are saved as the transfer
+#profile of the scope model and firmware, which ScopeSession loads on connect.
+#The point count is a measurement choice, so it is swept for the numbers only and not put in the profile; a points mode
+#that delivers fewer points (NORMal at this timebase) is not chosen, and ScopeSession falls back to RAW whenever the
+#profile's NORMal cannot deliver the requested points at the timebase of the moment.
+#usage: python TransferTuner.py [VISA address | simulated]
+
+import sys
+import time
+import itertools
+from ScopeSession import ScopeSession, VISA_ADDRESS, USER_REQUESTED_POINTS, saveProfile
+
+FORMATS = ("WORD", "BYTE")
+POINTS_MODES = ("RAW", "NORMal")
+POINTS = (1000, 10000, USER_REQUESTED_POINTS, 250000, 1000000)
+CHUNK_SIZES = (20480, 65536, 262144, 1 << 20, 4 << 20)
+
+#Time repeats transfers of every combination. Returns one record per combination the scope really ran: a combination
+#the scope changes (e.g. RAW with averaging, more points than available) is measured once under its actual settings.
+def benchmark(session, formats=FORMATS, points_modes=POINTS_MODES, points=POINTS, chunk_sizes=CHUNK_SIZES, repeats=3):
+    session.refresh()
+    saved = (session.waveform_format, session.requested_points_mode, session.requested_points, session.chunk_bytes)
+    results = []
+    measured = set()
+    try:
+        for fmt, mode, count, chunk in itertools.product(formats, points_modes, points, chunk_sizes):
+            session.waveform_format, session.requested_points_mode = fmt, mode
+            session.requested_points, session.chunk_bytes = count, chunk
+            session.settings = None
+            session.refresh()
+            key = (session.format, session.points_mode, session.points, session.read_chunk)
+            if key in measured:
+                continue
+            measured.add(key)
+            ## first transfer only fills the buffer
+            session.captureCodes(digitize=False, check_settings=False)
+            started = time.perf_counter()
+            for _ in range(repeats):
+                session.captureCodes(digitize=False, check_settings=False)
+            seconds = (time.perf_counter() - started) / repeats
+            started = time.perf_counter()
+            for _ in range(repeats):
+                session.inst.query(":WAVeform:POINts?")
+            latency = (time.perf_counter() - started) / repeats
+            nbytes = session.transfer_bytes * len(session.chs_on)
+            results.append({'format': session.format, 'points_mode': session.points_mode, 'points': session.points,
+                            'requested_points': count, 'chunk_bytes': session.read_chunk, 'bytes': nbytes, 'seconds': seconds,
+                            'mb_per_s': nbytes / seconds / 1e6, 'points_per_s': session.points * len(session.chs_on) / seconds,
+                            'latency': latency})
+    finally:
+        session.waveform_format, session.requested_points_mode, session.requested_points, session.chunk_bytes = saved
+        session.settings = None
+    return results
+
+#Fastest (points/s) settings among the runs at the point count normal captures use. Runs that got fewer points than
+#the others (NORMal limited to the screen record) do not count, the profile never lowers the point count.
+def bestProfile(results, points=USER_REQUESTED_POINTS) -> dict:
+    requested = min(set(result['requested_points'] for result in results), key=lambda count: abs(count - points))
+    candidates = [result for result in results if result['requested_points'] == requested]
+    full = max(result['points'] for result in candidates)
+    best = max((result for result in candidates if result['points'] == full), key=lambda result: result['points_per_s'])
+    return {'format': best['format'], 'points_mode': best['points_mode'], 'chunk_bytes': best['chunk_bytes'],
+            'mb_per_s': round(best['mb_per_s'], 3), 'latency': round(best['latency'], 6), 'tuned': time.strftime("%Y-%m-%d %H:%M:%S")}
+
+#Benchmark the scope and store its profile
+def tune(session, **sweep):
+    results = benchmark(session, **sweep)
+    profile = bestProfile(results)
+    saveProfile(session.model, session.firmware, profile)
+    return results, profile
+
+def main():
+    target = sys.argv[1] if len(sys.argv) > 1 else VISA_ADDRESS
+    if target == "simulated":
+        import InfiniiVisionSimulator
+        rm = InfiniiVisionSimulator.SimulatedResourceManager({InfiniiVisionSimulator.SIM_ADDRESS: InfiniiVisionSimulator.SimulatedInfiniiVision})
+        session = ScopeSession(InfiniiVisionSimulator.SIM_ADDRESS, rm, profile=False)
+    else:
+        session = ScopeSession(target, profile=False)
+    try:
+        results, profile = tune(session)
+    finally:
+        session.close()
+    print("format points_mode   points  chunk_bytes      MB/s     points/s  latency (ms)")
+    for result in results:
+        print("{format:6} {points_mode:11} {points:8d} {chunk_bytes:12d} {mb_per_s:9.3f} {points_per_s:12.0f} {:13.3f}".format(
+            result['latency'] * 1000, **result))
+    print("Profile for {} {}: {}".format(session.model, session.firmware, profile))
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,91 @@
+import os
+import sys
+import glob
+import time
+import hashlib
+import logging
+import tempfile
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from WaveformStore import capture_type, readCapture, splitSegments
+
+#Batch results are a parquet table when pyarrow (optional, not installed with the scope tools) is there, CSV otherwise
+try:
+    import pyarrow
+    results_type = ".parquet"
+except ImportError:
+    results_type = ".csv"
+#Default names of the results tables, never read as captures
+RESULT_NAMES = ("waveform_results", "matched_filter_results")
+#One row per capture, or per segment of a segmented capture (segment 0 otherwise)
+RESULT_COLUMNS = ['file', 'segment', 'mtime', 'size', 'hash', 'start_pulse', 'stop_pulse', 'time_of_flight', 'noise_echo_amplitude',
+                  'noise_echo_length', 'noise_echo_steady_state', 'waterlevel_echo_amplitude', 'error']
 
 #FILE_NAME = "file"
 FILE_NAME= "C:\\Data\\sensor_six 120mm 07-18-2022-20-28-35" + ".csv"
 
+#Indices of every rising edge of values: the sample where the level (|value| - reference) first goes above threshold.
+#reference defaults to the steady state |values[2]|. With hysteresis the level has to fall to threshold - hysteresis
+#before the next edge counts, so noise around the threshold does not give extra edges. The first edge does not depend
+#on the hysteresis.
+def rising_edges(values, threshold=3, hysteresis=0, reference=None):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return np.empty(0, dtype=np.intp)
+    if reference is None:
+        reference = abs(values[2])
+    level = np.abs(values) - reference
+    above = level > threshold
+    below = level <= threshold - hysteresis
+    #Schmitt trigger: every sample holds the state of the last sample that was above or below
+    last = np.where(above | below, np.arange(len(level)), -1)
+    np.maximum.accumulate(last, out=last)
+    high = above[last] & (last >= 0)
+    return np.flatnonzero(high & ~np.concatenate(([False], high[:-1])))
+
+#Index of the first rising edge of values (see rising_edges), -1 if there is none. Searches blocks of growing size so
+#an early edge does not cost a pass over the whole record.
+def first_rising_edge(values, threshold=3, reference=None):
+    values = np.asarray(values, dtype=np.float64)
+    if reference is None:
+        reference = abs(values[2])
+    start, block = 0, 1024
+    while start < len(values):
+        above = np.abs(values[start:start + block]) - reference > threshold
+        if above.any():
+            return start + int(np.argmax(above))
+        start += block
+        block *= 2
+    return -1
+
+#Channel column of the capture DataFrame as a float array
+def channel_values(waveform, col):
+    return waveform.iloc[:, col].to_numpy(dtype=np.float64)
+
+#Every start pulse (channel 1) edge, with the same +2 offset as start_pulse_edge
+def start_pulse_edges(waveform, threshold=3, hysteresis=0):
+    return rising_edges(channel_values(waveform, 1), threshold, hysteresis) + 2
+
+#Every stop pulse (channel 3) edge
+def stop_pulse_edges(waveform, threshold=3, hysteresis=0):
+    return rising_edges(channel_values(waveform, 3), threshold, hysteresis)
+
 #Finds rising edge for channel 1. This value corresponds to the start pulse from the TDC1000 sensor.
-#pulse steady state needs to be compared against the iterating rising edge value (3 volts) to determine start pulse.
-def start_pulse_edge(waveform):
+#pulse steady state needs to be compared against the rising edge value (3 volts) to determine start pulse.
+#Returns 0 when there is no start pulse.
+def start_pulse_edge(waveform, threshold=3):
+    edge = first_rising_edge(channel_values(waveform, 1), threshold)
+    return edge + 2 if edge >= 0 else 0
+
+#Finds rising edge for channel three. This value corresponds to the stop pulse from the TDC1000 sensor.
+#Returns 0 when there is no stop pulse.
+def stop_pulse_edge(waveform, threshold=3):
+    edge = first_rising_edge(channel_values(waveform, 3), threshold)
+    return edge if edge >= 0 else 0
+
+#Row by row start pulse search the vectorized one replaced, kept as reference for benchmark_edges
+def start_pulse_edge_loop(waveform):
     start_pulse = 0
     rows = waveform.shape[0]
     pulse_steady_state = abs(waveform.iloc[2,1])
@@ -19,16 +99,32 @@ def start_pulse_edge(waveform):
             break
     return(start_pulse)
 
+#Row by row stop pulse search the vectorized one replaced, kept as reference for benchmark_edges
+def stop_pulse_edge_loop(waveform):
+    stop_pulse = 0
+    pulse_steady_state = abs(waveform.iloc[2,3])
+    rows = waveform.shape[0]
+    for itr in range(rows):
+        rising_edge = abs(waveform.iloc[itr,3])
+        rising_edge = rising_edge - pulse_steady_state
+        if rising_edge > 3:
+            #print(rising_edge)
+            #print(itr)
+            stop_pulse = itr
+            break
+    return(stop_pulse)
+
+#Row by row metric calculations waveform_metrics replaced, kept as reference for benchmark_metrics. They return their
+#results instead of printing them.
+
 #Calculates the amplitude of the noise echo, noise echo amplitude calculation will stop if there is a water level pulse 
 #detection (stop_pulse).
-def calculate_noise_echo(waveform,start_pulse, stop_pulse):
+def calculate_noise_echo_loop(waveform,start_pulse, stop_pulse):
     itr = start_pulse
     itr_stop_value = stop_pulse
     max_peak = waveform.iloc[start_pulse,2]
     min_peak = waveform.iloc[start_pulse,2]
-    #print(itr)
     while (itr <= itr_stop_value):
-        #print(itr)
         current_value = waveform.iloc[itr,2]
         if max_peak < current_value:
             max_peak = current_value
@@ -36,12 +132,12 @@ def calculate_noise_echo(waveform,start_pulse, stop_pulse):
             min_peak = current_value
         itr = itr + 1
     noise_echo_amplitude = max_peak - min_peak
-    print("Noise echo amplitude equals = ", noise_echo_amplitude, "Volts")
+    return noise_echo_amplitude
 
 #Calcuates noise echo time duration before returning to steady state based of % of noise of circuit versus noise of 
 #noise echo pulse. Signal noise deviation is 1% of the static signal noise. Calculation works from end of waveform or
-#start of stop pulse (channel 3 / water level echo pulse).
-def calculate_noise_echo_time(waveform,start_pulse, stop_pulse):
+#start of stop pulse (channel 3 / water level echo pulse). Returns the steady state index and the noise echo length.
+def calculate_noise_echo_time_loop(waveform,start_pulse, stop_pulse):
     #Calculate signal noise deviation boundaries by iterating 100 times to smooth out any noise_sampling peaks/valleys
     signal_noise_deviation = .01
     noise_sampling = waveform.iloc[2,2]
@@ -50,9 +146,6 @@ def calculate_noise_echo_time(waveform,start_pulse, stop_pulse):
         noise_sampling = noise_sampling / 2
     upper_noise_sampling = noise_sampling + (noise_sampling*signal_noise_deviation)
     lower_noise_sampling = noise_sampling - (noise_sampling*signal_noise_deviation)
-    #print("Noise sampling value = ", noise_sampling, "Volts")
-    #print("upper noise samping value = ", upper_noise_sampling)
-    #print("lower noise samping value = ", lower_noise_sampling)
 
     noise_echo_start = waveform.iloc[start_pulse,0]
     noise_echo_stop = 0
@@ -60,83 +153,455 @@ def calculate_noise_echo_time(waveform,start_pulse, stop_pulse):
     #Water level echo stop pulse was found
     if stop_pulse != 0:
         itr = stop_pulse
-        #print("Water level echo detected")
     #No water level echo found
     else:
         itr = waveform.shape[0] - 1
-        #print("No water level echo detected")
     #Begin sampling/calcuating noise echo length
     sampling = 0
     while sampling != 25:
         noise_echo = waveform.iloc[itr,2]
-        #print("noise echo", noise_echo)
         if (noise_echo > upper_noise_sampling or noise_echo < lower_noise_sampling):
             sampling = 0
             itr = itr - 1
         else:
             sampling = sampling + 1
             itr = itr - 1
-    #print(itr)
     noise_echo_stop = waveform.iloc[itr,0]
     noise_echo_steady_state = itr
     noise_echo_length = float(noise_echo_stop) - float(noise_echo_start)
-    print("Noise echo length =",noise_echo_length ,"seconds")
-    return noise_echo_steady_state
-     
+    return noise_echo_steady_state, noise_echo_length
 
-#Finds rising edge for channel three. This value corresponds to the stop pulse from the TDC1000 sensor
-def stop_pulse_edge(waveform):
-    stop_pulse = 0
-    pulse_steady_state = abs(waveform.iloc[2,3])
-    rows = waveform.shape[0]
-    for itr in range(rows):
-        rising_edge = abs(waveform.iloc[itr,3])
-        rising_edge = rising_edge - pulse_steady_state
-        if rising_edge > 3:
-            #print(rising_edge)
-            #print(itr)
-            stop_pulse = itr
-            break
-    return(stop_pulse)
-
-#Calculates the amplitude of the water level echo
-def calculate_waterlevel_echo(waveform,stop_pulse):
+#Calculates the amplitude of the water level echo, NaN without a stop pulse
+def calculate_waterlevel_echo_loop(waveform,stop_pulse):
     max_peak = waveform.iloc[stop_pulse,2]
     min_peak = waveform.iloc[stop_pulse,2]
-    if stop_pulse != 0:
-        itr = stop_pulse
-        rows = waveform.shape[0]
-        #print(itr)
-        while (itr < rows):
-            #print(itr)
-            current_value = waveform.iloc[itr,2]
-            if max_peak < current_value:
-                max_peak = current_value
-            elif min_peak > current_value:
-                min_peak = current_value          
-            itr = itr + 1
-        waterlevel_echo_amplitude = max_peak - min_peak
-        print("Water level echo amplitude equals = ", waterlevel_echo_amplitude, "Volts")
+    if stop_pulse == 0:
+        return float('nan')
+    itr = stop_pulse
+    rows = waveform.shape[0]
+    while (itr < rows):
+        current_value = waveform.iloc[itr,2]
+        if max_peak < current_value:
+            max_peak = current_value
+        elif min_peak > current_value:
+            min_peak = current_value          
+        itr = itr + 1
+    return max_peak - min_peak
 
 #Calculates the time of flight by finding the corresponding time values associated with the 3 Volts rising edge of channel
-#one and channel three. Will not calculate a time of flight if a stop pulse is not found.
-def calculate_tof(waveform,start_pulse,stop_pulse):
+#one and channel three. NaN if a stop pulse is not found.
+def calculate_tof_loop(waveform,start_pulse,stop_pulse):
+    if stop_pulse == 0:
+        return float('nan')
     start_time = waveform.iloc[start_pulse,0]
+    stop_time = waveform.iloc[stop_pulse,0] 
+    return float(stop_time) - float(start_time)
+
+#All metrics of a capture DataFrame the way the original main() computed them, as a waveform_metrics dict
+def waveform_metrics_loop(waveform):
+    start_pulse = start_pulse_edge_loop(waveform)
+    stop_pulse = stop_pulse_edge_loop(waveform)
+    waterlevel_echo_amplitude = calculate_waterlevel_echo_loop(waveform,stop_pulse)
+    noise_echo_steady_state, noise_echo_length = calculate_noise_echo_time_loop(waveform,start_pulse, stop_pulse)
+    noise_echo_amplitude = calculate_noise_echo_loop(waveform,start_pulse,noise_echo_steady_state)
+    return {'start_pulse': start_pulse, 'stop_pulse': stop_pulse, 'time_of_flight': calculate_tof_loop(waveform,start_pulse,stop_pulse),
+            'noise_echo_amplitude': float(noise_echo_amplitude), 'noise_echo_length': noise_echo_length,
+            'noise_echo_steady_state': noise_echo_steady_state, 'waterlevel_echo_amplitude': float(waterlevel_echo_amplitude)}
+
+#Index of the last sample of the first run of length consecutive True values in mask, -1 if there is none
+def first_run_end(mask, length):
+    if len(mask) < length:
+        return -1
+    counts = np.cumsum(mask, dtype=np.intp)
+    windows = counts[length - 1:] - np.concatenate(([0], counts[:-length]))
+    hits = np.flatnonzero(windows == length)
+    return int(hits[0]) + length - 1 if len(hits) else -1
+
+#Peak to peak of values like the calculate_* loops: NaN samples are skipped unless the first one is NaN
+def peak_to_peak(values):
+    if len(values) == 0 or np.isnan(values[0]):
+        return float('nan')
+    return float(np.nanmax(values) - np.nanmin(values))
+
+#All metrics of one capture from its time axis and channel 1 to 3 arrays, with the same results as the
+#calculate_*_loop functions (see benchmark_metrics), in a few vectorized passes over channel 2 instead of one iloc walk
+#per metric.
+#Returns a dict; values that need a stop (water level) pulse are NaN without one.
+def waveform_metrics(time_axis, start_channel, echo_channel, stop_channel, threshold=3):
+    echo = np.asarray(echo_channel, dtype=np.float64)
+    rows = len(echo)
+    start_pulse = first_rising_edge(start_channel, threshold)
+    start_pulse = start_pulse + 2 if start_pulse >= 0 else 0
+    stop_pulse = max(0, first_rising_edge(stop_channel, threshold))
+
+    #Static signal noise: running average of samples 2 to 102, boundaries 1% around it
+    signal_noise_deviation = .01
+    noise_sampling = echo[2]
+    for value in echo[3:103].tolist():
+        noise_sampling = (value + noise_sampling) / 2
+    upper_noise_sampling = noise_sampling + (noise_sampling*signal_noise_deviation)
+    lower_noise_sampling = noise_sampling - (noise_sampling*signal_noise_deviation)
+
+    #Walking back from the stop pulse (or the end), the noise echo is over where 25 samples in a row are within the
+    #boundaries. Like the iloc walk, the search wraps around to the end of the record if it passes the first sample.
+    walk = echo[stop_pulse if stop_pulse != 0 else rows - 1::-1]
+    steady = first_run_end(~((walk > upper_noise_sampling) | (walk < lower_noise_sampling)), 25)
+    if steady < 0:
+        walk = np.concatenate((walk, echo[::-1]))
+        steady = first_run_end(~((walk > upper_noise_sampling) | (walk < lower_noise_sampling)), 25)
+        if steady < 0:
+            raise IndexError("Noise echo never returns to steady state")
+    noise_echo_steady_state = (stop_pulse if stop_pulse != 0 else rows - 1) - steady - 1
+
+    time_axis = np.asarray(time_axis, dtype=np.float64)
+    noise_echo_length = float(time_axis[noise_echo_steady_state]) - float(time_axis[start_pulse])
+    if noise_echo_steady_state >= start_pulse:
+        noise_echo_amplitude = peak_to_peak(echo[start_pulse:noise_echo_steady_state + 1])
+    else:
+        noise_echo_amplitude = peak_to_peak(echo[start_pulse:start_pulse + 1])
     if stop_pulse != 0:
-        stop_time = waveform.iloc[stop_pulse,0] 
-        time_of_flight = float(stop_time) - float(start_time)
-        print("Time of flight = ", time_of_flight, "seconds")
-    
-#Open csv file and perform calculations
-def main():
-    filename = FILE_NAME 
-    waveform = pd.read_csv(filename)
-    start_pulse = start_pulse_edge(waveform)
-    stop_pulse = stop_pulse_edge(waveform)
-    calculate_waterlevel_echo(waveform,stop_pulse)
-    noise_echo_steady_state = calculate_noise_echo_time(waveform,start_pulse, stop_pulse)
-    calculate_noise_echo(waveform,start_pulse,noise_echo_steady_state)
-    calculate_tof(waveform,start_pulse,stop_pulse)
+        waterlevel_echo_amplitude = peak_to_peak(echo[stop_pulse:])
+        time_of_flight = float(time_axis[stop_pulse]) - float(time_axis[start_pulse])
+    else:
+        waterlevel_echo_amplitude = float('nan')
+        time_of_flight = float('nan')
+    return {'start_pulse': start_pulse, 'stop_pulse': stop_pulse, 'time_of_flight': time_of_flight,
+            'noise_echo_amplitude': noise_echo_amplitude, 'noise_echo_length': noise_echo_length,
+            'noise_echo_steady_state': noise_echo_steady_state, 'waterlevel_echo_amplitude': waterlevel_echo_amplitude}
+
+#waveform_metrics of a capture DataFrame (load_waveform); the time column of a CSV holds text, unreadable rows are NaN
+def analyze_waveform(waveform, threshold=3):
+    time_axis = pd.to_numeric(waveform.iloc[:, 0], errors='coerce').to_numpy(dtype=np.float64)
+    return waveform_metrics(time_axis, channel_values(waveform, 1), channel_values(waveform, 2), channel_values(waveform, 3),
+                            threshold)
+
+#Metrics that are indices
+INDEX_METRICS = ('start_pulse', 'stop_pulse', 'noise_echo_steady_state')
+
+#Metrics of a loaded capture (analyze_waveform) with the indices of the samples instead of the rows of the file, which
+#start with the NaN row under the titles; a missing start / stop pulse (row 0) becomes -1
+def sample_indices(metrics):
+    return dict(metrics, **{name: metrics[name] - 1 for name in INDEX_METRICS})
+
+#Metrics of a capture held in memory: time axis and scaled (channels, points) data, channel 1 to 3 in the first rows.
+#The results are the same as analyzing the saved capture, the indices are of the arrays passed in (-1: no start / stop
+#pulse).
+def capture_metrics(time_axis, volts, threshold=3):
+    if len(volts) < 3:
+        raise ValueError("Need the start pulse, echo and stop pulse channels, got {} channel(s)".format(len(volts)))
+    ## the edge and steady state searches work on the rows of a file, leading NaN row included
+    padded = np.full((4, len(time_axis) + 1), np.nan)
+    padded[0, 1:] = time_axis
+    padded[1:, 1:] = volts[:3]
+    return sample_indices(waveform_metrics(padded[0], padded[1], padded[2], padded[3], threshold))
+
+#capture_metrics that does not raise: a capture the analysis fails on (too few channels, no steady state) gets
+#{'error': "<type>: <message>"} instead, like the rows of analyze_file
+def try_capture_metrics(time_axis, volts, threshold=3):
+    try:
+        return capture_metrics(time_axis, volts, threshold)
+    except (ValueError, IndexError) as e:
+        return {'error': "{}: {}".format(type(e).__name__, e)}
+
+#try_capture_metrics of every segment of a segmented capture, the segments being len(time_axis) points long
+def segment_metrics(time_axis, volts, threshold=3):
+    length = len(time_axis)
+    return [try_capture_metrics(time_axis, volts[:, start:start + length], threshold) for start in range(0, volts.shape[1], length)]
+
+#Reference echo for matched_filter_tof: length samples of the echo channel of a capture with a known stop pulse, starting
+#before samples ahead of it, with the mean removed and scaled to unit energy
+def echo_template(echo, stop_pulse, length=5000, before=1000):
+    start = max(0, stop_pulse - before)
+    template = np.asarray(echo[start:start + length], dtype=np.float64)
+    template = template - template.mean()
+    return template / np.sqrt(np.sum(template * template))
+
+#First start pulse edge (with the +2 offset of start_pulse_edge) of every row of a (captures, points) channel 1 array,
+#-1 for rows without one. The rows have no leading NaN row, so the steady state reference is sample 1 (sample 2 of a
+#loaded file); the edges are the ones capture_metrics finds.
+def start_pulse_edges_batch(start_channels, threshold=3):
+    start_channels = np.asarray(start_channels, dtype=np.float64)
+    above = np.abs(start_channels) - np.abs(start_channels[:, 1:2]) > threshold
+    return np.where(above.any(axis=1), np.argmax(above, axis=1) + 2, -1)
+
+#Time of flight of a batch of captures from the position of the echo instead of a threshold on channel 3.
+#echoes: (captures, points) echo channel, template: echo_template, template_offset: where the stop pulse is in the
+#template (its before). Every row is cross-correlated with the template by FFT, normalized by the energy of the signal
+#under the template so the score (-1..1) does not depend on the echo amplitude, and the best match from sample
+#search_from on (to skip the transmit ringing) is refined to a fraction of a sample. Rows scoring below min_score get a
+#NaN time of flight. Returns a dict of arrays: time_of_flight, echo (sample of the stop pulse), score, start_pulse.
+def matched_filter_tof(echoes, template, x_increment, start_pulses, template_offset=1000, search_from=0, min_score=0.5):
+    echoes = np.atleast_2d(np.asarray(echoes, dtype=np.float64))
+    rows, points = echoes.shape
+    length = len(template)
+    lags = points - length + 1
+    size = 1 << int(np.ceil(np.log2(points + length - 1)))
+    spectrum = np.fft.rfft(echoes, size, axis=1)
+    spectrum *= np.fft.rfft(template[::-1], size)
+    ## correlation[k] = sum_j echoes[k + j] * template[j]
+    correlation = np.fft.irfft(spectrum, size, axis=1)[:, length - 1:points]
+    del spectrum
+    sums = np.zeros((rows, points + 1))
+    np.cumsum(echoes, axis=1, out=sums[:, 1:])
+    window = sums[:, length:] - sums[:, :lags]
+    np.cumsum(echoes * echoes, axis=1, out=sums[:, 1:])
+    variance = sums[:, length:] - sums[:, :lags] - window * window / length
+    score = correlation / np.sqrt(np.maximum(variance, 1e-30) * np.sum(template * template))
+    score[:, :min(search_from, lags)] = -np.inf
+    best = np.argmax(score, axis=1)
+    peak = score[np.arange(rows), best]
+    ## parabola through the peak and its neighbours
+    inner = (best > 0) & (best < lags - 1)
+    left = score[np.arange(rows), np.maximum(best - 1, 0)]
+    right = score[np.arange(rows), np.minimum(best + 1, lags - 1)]
+    curvature = left - 2 * peak + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(inner & (curvature < 0), 0.5 * (left - right) / curvature, 0.0)
+    echo = best + np.clip(fraction, -0.5, 0.5) + template_offset
+    start_pulses = np.asarray(start_pulses)
+    time_of_flight = np.where((peak >= min_score) & (start_pulses >= 0), (echo - start_pulses) * x_increment, np.nan)
+    return {'time_of_flight': time_of_flight, 'echo': echo, 'score': peak, 'start_pulse': start_pulses}
+
+#matched_filter_tof of binary capture files of one setup (same record length as reference, else ValueError; every segment), loaded blocks captures at
+#a time. The template comes from reference (a capture file whose stop pulse is found by threshold). Returns a DataFrame
+#with one row per capture (segment).
+def matched_filter_files(files, reference, length=5000, before=1000, search_from=None, min_score=0.5, block=256):
+    capture = readCapture(reference)
+    time_axis = capture.time(0, capture.segment_points)
+    volts = np.array([capture.segment(ch, 0)[:] for ch in capture.channels[:3]])
+    metrics = capture_metrics(time_axis, volts)
+    template = echo_template(volts[1], metrics['stop_pulse'], length, before)
+    if search_from is None:
+        ## past the start pulse and the transmit ringing of the reference
+        search_from = max(0, metrics['stop_pulse'] - before - (metrics['stop_pulse'] - metrics['start_pulse']) // 2)
+    results = []
+    names, starts, echoes, x_increments = [], [], [], []
+    def flush():
+        result = matched_filter_tof(np.array(echoes), template, np.array(x_increments),
+                                    start_pulse_edges_batch(np.array(starts)), before, search_from, min_score)
+        result = pd.DataFrame(result)
+        result.insert(0, 'file', [name for name, _ in names])
+        result.insert(1, 'segment', [segment for _, segment in names])
+        results.append(result)
+        names.clear()
+        starts.clear()
+        echoes.clear()
+        x_increments.clear()
+    points = len(time_axis)
+    for filename in files:
+        capture = readCapture(filename)
+        if capture.segment_points != points:
+            raise ValueError("{} has {} points per segment, the reference {} has {}; matched filtering needs captures of one "
+                             "setup".format(filename, capture.segment_points, reference, points))
+        for segment in range(len(capture.time_tags)):
+            names.append((filename, segment))
+            starts.append(capture.segment(capture.channels[0], segment)[:])
+            echoes.append(capture.segment(capture.channels[1], segment)[:])
+            x_increments.append(capture.info['x_increment'])
+            if len(names) == block:
+                flush()
+    if names:
+        flush()
+    if not results:
+        return pd.DataFrame(columns=['file', 'segment', 'time_of_flight', 'echo', 'score', 'start_pulse'])
+    return pd.concat(results, ignore_index=True)
+
+#Capture as a DataFrame with the time axis in column 0 and the channels after it, from a CSV or a binary .wfb capture.
+#quickscan CSVs have a "# " line under the column titles that read_csv turns into a first row of NaN, binary captures get
+#the same row so the row indices (and results) do not depend on the file format. The segments of a segmented capture
+#follow each other in the rows, analyze_file splits them.
+def load_waveform(filename):
+    if filename.endswith(capture_type):
+        capture = readCapture(filename)
+        columns = [capture.time()] + [capture.channel(ch)[:] for ch in capture.channels]
+        data = np.vstack((np.full(len(columns), np.nan), np.column_stack(columns)))
+        return pd.DataFrame(data, columns=("# " + capture.columnTitles()).split(','))
+    return pd.read_csv(filename)
+
+#Time the row by row edge searches against the vectorized ones and check they find the same indices
+def benchmark_edges(waveform, repeats=3):
+    timings = {}
+    for name, search in (("start loop", start_pulse_edge_loop), ("start vectorized", start_pulse_edge),
+                         ("stop loop", stop_pulse_edge_loop), ("stop vectorized", stop_pulse_edge)):
+        now = time.perf_counter()
+        for _ in range(repeats):
+            index = search(waveform)
+        timings[name] = ((time.perf_counter() - now) / repeats, index)
+    for name, (seconds, index) in timings.items():
+        print("{:17} {:10.6f} s  index {}".format(name, seconds, index))
+    if timings["start loop"][1] != timings["start vectorized"][1] or timings["stop loop"][1] != timings["stop vectorized"][1]:
+        raise AssertionError("Vectorized edge search disagrees with the loop")
+    print("start pulse {:.0f}x, stop pulse {:.0f}x faster".format(timings["start loop"][0] / timings["start vectorized"][0],
+                                                                 timings["stop loop"][0] / timings["stop vectorized"][0]))
+    return timings
+
+#Time the row by row metric calculations against waveform_metrics and check they give the same results
+def benchmark_metrics(waveform, repeats=1):
+    timings = {}
+    for name, calculate in (("loop", waveform_metrics_loop), ("vectorized", analyze_waveform)):
+        now = time.perf_counter()
+        for _ in range(repeats):
+            metrics = calculate(waveform)
+        timings[name] = ((time.perf_counter() - now) / repeats, metrics)
+    loop, vectorized = timings["loop"][1], timings["vectorized"][1]
+    for name in loop:
+        print("{:26} {!r:>24} {!r:>24}".format(name, loop[name], vectorized[name]))
+        ## the time column of a CSV is parsed by float() in the loop and by pandas in waveform_metrics
+        if not np.isclose(loop[name], vectorized[name], rtol=1e-12, atol=0, equal_nan=True):
+            raise AssertionError("waveform_metrics disagrees with the loop on {}".format(name))
+    print("loop {:.6f} s, vectorized {:.6f} s, {:.0f}x faster".format(timings["loop"][0], timings["vectorized"][0],
+                                                                    timings["loop"][0] / timings["vectorized"][0]))
+    return timings
+
+#Content hash of a file, read in 1 MB pieces
+def file_hash(filename):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for piece in iter(lambda: f.read(1 << 20), b''):
+            digest.update(piece)
+    return digest.hexdigest()
+
+#Results rows of a capture file, one per segment of a segmented binary capture (each segment is analyzed on its own,
+#like matched_filter_files does), else one with segment 0. Indices are of the samples, for CSV captures as well. A capture (segment) the analysis fails on gets its error
+#instead of metrics. digest: file_hash of the file when the caller already has it
+def analyze_file(filename, digest=None):
+    info = os.stat(filename)
+    row = {'file': filename, 'segment': 0, 'mtime': info.st_mtime, 'size': info.st_size, 'hash': digest or file_hash(filename),
+           'error': ""}
+    try:
+        if not filename.endswith(capture_type):
+            return [dict(row, **sample_indices(analyze_waveform(load_waveform(filename))))]
+        capture = readCapture(filename)
+        time_axis = capture.time(0, capture.segment_points)
+        rows = []
+        for segment in range(len(capture.time_tags)):
+            volts = np.array([capture.segment(ch, segment)[:] for ch in capture.channels[:3]])
+            metrics = try_capture_metrics(time_axis, volts)
+            rows.append(dict(row, segment=segment, **metrics))
+        return rows
+    except Exception as e:
+        row['error'] = "{}: {}".format(type(e).__name__, e)
+        return [row]
+
+#Default results table of the batch and matched modes in directory. Without pyarrow it is a CSV, which is logged so a
+#missing parquet file is not a surprise.
+def default_results_file(directory, name):
+    if results_type == ".csv":
+        logging.warning("pyarrow is not installed, the results are written as CSV instead of parquet")
+    return os.path.join(directory, name + results_type)
+
+#Check that every segment of a segmented capture gets the same analyze_file results as the segment saved as a capture
+#of its own (WaveformStore.splitSegments)
+def check_segments(filename):
+    metrics = [name for name in RESULT_COLUMNS if name not in ('file', 'segment', 'mtime', 'size', 'hash')]
+    rows = analyze_file(filename)
+    with tempfile.TemporaryDirectory() as directory:
+        singles = splitSegments(filename, directory)
+        if len(singles) != len(rows):
+            raise AssertionError("{} segments, {} results rows".format(len(singles), len(rows)))
+        for row, single in zip(rows, singles):
+            expected = analyze_file(single)[0]
+            for name in metrics:
+                same = row[name] == expected[name] if name == 'error' else np.isclose(row[name], expected[name], rtol=0, atol=0,
+                                                                                       equal_nan=True)
+                if not same:
+                    raise AssertionError("Segment {} {}: {!r}, as a single capture {!r}".format(row['segment'], name, row[name],
+                                                                                            expected[name]))
+    print("{} segments analyzed like single captures".format(len(rows)))
+    return rows
+
+#Results tables of the batch and matched modes: the default names, or any CSV with their "file,..." header
+def is_results_file(filename):
+    if os.path.basename(filename).startswith(RESULT_NAMES):
+        return True
+    if filename.endswith(".csv"):
+        with open(filename, 'rb') as f:
+            return f.readline().startswith(b"file,")
+    return False
+
+#Capture files of a directory (.csv and .wfb) or a glob pattern. The CSV export of a binary capture and results tables
+#are left out.
+def capture_files(pattern):
+    if os.path.isdir(pattern):
+        files = glob.glob(os.path.join(pattern, "*.csv")) + glob.glob(os.path.join(pattern, "*" + capture_type))
+    else:
+        files = glob.glob(pattern)
+    binary = set(os.path.splitext(f)[0] for f in files if f.endswith(capture_type))
+    return sorted(f for f in files if not (f.endswith(".csv") and os.path.splitext(f)[0] in binary) and not is_results_file(f))
+
+#Previous results table; one from before segments got rows of their own has no segment column and is not used
+def read_results(results_file):
+    if not os.path.exists(results_file):
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    if results_file.endswith(".parquet"):
+        results = pd.read_parquet(results_file)
+    else:
+        results = pd.read_csv(results_file, keep_default_na=False, na_values=[""])
+    return results if 'segment' in results.columns else pd.DataFrame(columns=RESULT_COLUMNS)
+
+#Analyze every capture of a directory or glob on a pool of processes and write one row per capture (segment) to
+#results_file (default: waveform_results.parquet / .csv in the directory). The previous results file is the cache: a file
+#with the same size and modification time keeps its rows, otherwise it is hashed and only analyzed if the content is new.
+def analyze_batch(pattern, results_file=None, workers=None):
+    if results_file is None:
+        directory = pattern if os.path.isdir(pattern) else os.path.dirname(pattern)
+        results_file = default_results_file(directory, RESULT_NAMES[0])
+    files = [f for f in capture_files(pattern) if os.path.abspath(f) != os.path.abspath(results_file)]
+    previous = read_results(results_file)
+    by_file = {}
+    for row in previous.to_dict('records'):
+        by_file.setdefault(row['file'], []).append(row)
+    ## files with the same content have the same rows
+    by_hash = {known[0]['hash']: known for known in by_file.values()}
+    rows = {}
+    unknown = []
+    for filename in files:
+        info = os.stat(filename)
+        known = by_file.get(filename)
+        if known is not None and known[0]['size'] == info.st_size and known[0]['mtime'] == info.st_mtime:
+            rows[filename] = known
+        else:
+            unknown.append(filename)
+    ## files that changed on disk are hashed first; a known content (copied, touched) keeps its metrics, a new one is
+    ## analyzed with the digest it already has
+    new = []
+    digests = []
+    if unknown:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for filename, digest in zip(unknown, pool.map(file_hash, unknown, chunksize=16)):
+                known = by_hash.get(digest)
+                if known is not None:
+                    info = os.stat(filename)
+                    rows[filename] = [dict(row, file=filename, mtime=info.st_mtime, size=info.st_size) for row in known]
+                else:
+                    new.append(filename)
+                    digests.append(digest)
+            chunksize = max(1, len(new) // (4 * (workers or os.cpu_count() or 1)))
+            for file_rows in pool.map(analyze_file, new, digests, chunksize=chunksize):
+                rows[file_rows[0]['file']] = file_rows
+    results = pd.DataFrame([row for f in files for row in rows[f]], columns=RESULT_COLUMNS)
+    temporary = results_file + ".tmp"
+    if results_file.endswith(".parquet"):
+        results.to_parquet(temporary, index=False)
+    else:
+        results.to_csv(temporary, index=False)
+    os.replace(temporary, results_file)
+    failed = int((results['error'].fillna("") != "").sum())
+    print("{} captures ({} rows): {} analyzed, {} from the cache, {} failed -> {}".format(len(files), len(results), len(new),
+          len(files) - len(new), failed, results_file))
+    return results
+
+#Open capture file and perform calculations
+def main(filename=FILE_NAME):
+    waveform = load_waveform(filename)
+    metrics = analyze_waveform(waveform)
+    if metrics['stop_pulse'] != 0:
+        print("Water level echo amplitude equals = ", metrics['waterlevel_echo_amplitude'], "Volts")
+    print("Noise echo length =", metrics['noise_echo_length'], "seconds")
+    print("Noise echo amplitude equals = ", metrics['noise_echo_amplitude'], "Volts")
+    if metrics['stop_pulse'] != 0:
+        print("Time of flight = ", metrics['time_of_flight'], "seconds")
+    return metrics
 
     #write values to excel file 
     #try:
@@ -145,4 +610,30 @@ def main():
     #except:
     #    print("no file found")
 
-main()
\ No newline at end of file
+#usage: python WaveformCalculations.py [capture file] [benchmark]
+#       python WaveformCalculations.py <segmented .wfb capture> segments
+#       python WaveformCalculations.py <directory or glob> batch [results file]
+#       python WaveformCalculations.py <directory or glob> matched <reference .wfb capture> [results file]
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[2] == "benchmark":
+        waveform = load_waveform(sys.argv[1])
+        benchmark_edges(waveform)
+        benchmark_metrics(waveform)
+    elif len(sys.argv) > 2 and sys.argv[2] == "segments":
+        check_segments(sys.argv[1])
+    elif len(sys.argv) > 2 and sys.argv[2] == "batch":
+        analyze_batch(sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else None)
+    elif len(sys.argv) > 3 and sys.argv[2] == "matched":
+        files = [f for f in capture_files(sys.argv[1]) if f.endswith(capture_type)]
+        results = matched_filter_files(files, sys.argv[3])
+        directory = sys.argv[1] if os.path.isdir(sys.argv[1]) else os.path.dirname(sys.argv[1])
+        results_file = sys.argv[4] if len(sys.argv) > 4 else default_results_file(directory, RESULT_NAMES[1])
+        if results_file.endswith(".parquet"):
+            results.to_parquet(results_file, index=False)
+        else:
+            results.to_csv(results_file, index=False)
+        print("{} captures, time of flight {:.6g} s +- {:.3g} s, {} without echo -> {}".format(len(results),
+              results['time_of_flight'].mean(), results['time_of_flight'].std(), int(results['time_of_flight'].isna().sum()),
+              results_file))
+    else:
+        main(sys.argv[1] if len(sys.argv) > 1 else FILE_NAME)
\ No newline at end of file
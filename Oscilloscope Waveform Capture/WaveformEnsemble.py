@@ -0,0 +1,186 @@
+#Ensemble statistics over a stream of echo captures (files or live arrays) in constant memory.
+#Every sample keeps a running mean and variance (Welford) and min / max envelopes, every metric of
+#WaveformCalculations a running mean, variance and range (ToF jitter, amplitude spread), so no waveform is kept after it
+#was added. The metrics of the ensemble mean waveform use a noise baseline averaged over all shots instead of one.
+#usage: python WaveformEnsemble.py <directory or glob of captures> [output .npz]
+
+import sys
+import numpy as np
+import pandas as pd
+from WaveformStore import capture_type, readCapture
+from WaveformCalculations import analyze_waveform, capture_files, capture_metrics, load_waveform, sample_indices, try_capture_metrics
+
+#An ensemble holds the start pulse, echo and stop pulse channels (1 to 3) of every capture, whatever else was on
+ENSEMBLE_CHANNELS = 3
+#Metrics that get a distribution
+ENSEMBLE_METRICS = ('time_of_flight', 'noise_echo_amplitude', 'noise_echo_length', 'waterlevel_echo_amplitude')
+
+#Running count, mean, sum of squared deviations, min and max of a scalar; NaN values are only counted as missing
+class RunningStatistic:
+    def __init__(self):
+        self.count = 0
+        self.missing = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value):
+        if value is None or np.isnan(value):
+            self.missing += 1
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    #Combine with the statistic of another part of the stream (Chan et al. pairwise update)
+    def merge(self, other):
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count = count
+        self.missing += other.missing
+
+    @property
+    def std(self) -> float:
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else float('nan')
+
+    def summary(self) -> dict:
+        empty = self.count == 0
+        return {'count': self.count, 'missing': self.missing, 'mean': float('nan') if empty else self.mean, 'std': self.std,
+                'min': float('nan') if empty else self.min, 'max': float('nan') if empty else self.max,
+                'spread': float('nan') if empty else self.max - self.min}
+
+class WaveformEnsemble:
+    def __init__(self):
+        self.count = 0
+        self.time_axis = None
+        #(channels, points) running mean, sum of squared deviations and envelopes
+        self.mean = None
+        self.m2 = None
+        self.minimum = None
+        self.maximum = None
+        self.delta = None
+        self.metrics = {name: RunningStatistic() for name in ENSEMBLE_METRICS}
+        self.failed = 0
+
+    #Add one capture: time axis and (channels, points) scaled data, channel 1 to 3 first; only those are kept. metrics as
+    #returned by try_capture_metrics, computed here when not given; a capture without metrics ({'error': ...}) counts
+    #as failed.
+    def addCapture(self, time_axis, volts, metrics=None):
+        volts = np.asarray(volts, dtype=np.float64)[:ENSEMBLE_CHANNELS]
+        if self.mean is None:
+            self.time_axis = np.array(time_axis, dtype=np.float64)
+            self.mean = np.zeros(volts.shape)
+            self.m2 = np.zeros(volts.shape)
+            self.minimum = volts.copy()
+            self.maximum = volts.copy()
+            self.delta = np.empty(volts.shape)
+        elif volts.shape != self.mean.shape:
+            raise ValueError("Capture of shape {} does not fit the ensemble of shape {}".format(volts.shape, self.mean.shape))
+        self.count += 1
+        ## Welford, in place: delta = x - mean; mean += delta / n; m2 += delta * (x - mean)
+        np.subtract(volts, self.mean, out=self.delta)
+        self.mean += self.delta / self.count
+        self.m2 += self.delta * (volts - self.mean)
+        np.minimum(self.minimum, volts, out=self.minimum)
+        np.maximum(self.maximum, volts, out=self.maximum)
+        if metrics is None:
+            metrics = try_capture_metrics(time_axis, volts)
+        if 'error' in metrics:
+            self.failed += 1
+        self.addMetrics(metrics)
+
+    def addMetrics(self, metrics):
+        for name, statistic in self.metrics.items():
+            statistic.add(metrics.get(name))
+
+    #Add every segment of a capture whose segments are len(time_axis) points long
+    def addSegments(self, time_axis, volts, metrics=None):
+        length = len(time_axis)
+        for i, start in enumerate(range(0, volts.shape[1], length)):
+            self.addCapture(time_axis, volts[:, start:start + length], metrics[i] if metrics is not None else None)
+
+    #Add a capture file: every segment of a binary capture, or a CSV capture
+    def addFile(self, filename):
+        if filename.endswith(capture_type):
+            capture = readCapture(filename)
+            time_axis = capture.time(0, capture.segment_points)
+            for segment in range(len(capture.time_tags)):
+                self.addCapture(time_axis, np.array([capture.segment(ch, segment)[:] for ch in capture.channels]))
+            return
+        waveform = load_waveform(filename)
+        try:
+            metrics = sample_indices(analyze_waveform(waveform))
+        except (ValueError, IndexError) as e:
+            metrics = {'error': "{}: {}".format(type(e).__name__, e)}
+        ## the first row is the one read_csv makes of the "# " line under the titles
+        time_axis = pd.to_numeric(waveform.iloc[1:, 0], errors='coerce').to_numpy(dtype=np.float64)
+        self.addCapture(time_axis, waveform.iloc[1:, 1:].to_numpy(dtype=np.float64).T, metrics)
+
+    #Combine with an ensemble of other captures of the same shape and time axis, e.g. built by another process
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count and other.mean.shape != self.mean.shape:
+            raise ValueError("Ensemble of shape {} does not fit the ensemble of shape {}".format(other.mean.shape, self.mean.shape))
+        if self.count:
+            ## the time axes have to agree to a small fraction of a sample
+            step = abs(self.time_axis[-1] - self.time_axis[0]) / max(1, len(self.time_axis) - 1)
+            if not np.allclose(other.time_axis, self.time_axis, rtol=0, atol=1e-3 * step):
+                raise ValueError("Ensembles were captured with different time axes")
+        if self.count == 0:
+            self.time_axis, self.mean, self.m2 = other.time_axis, other.mean.copy(), other.m2.copy()
+            self.minimum, self.maximum, self.delta = other.minimum.copy(), other.maximum.copy(), np.empty(other.mean.shape)
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            np.minimum(self.minimum, other.minimum, out=self.minimum)
+            np.maximum(self.maximum, other.maximum, out=self.maximum)
+        self.count += other.count
+        self.failed += other.failed
+        for name, statistic in self.metrics.items():
+            statistic.merge(other.metrics[name])
+
+    #Per sample standard deviation (channels, points)
+    def std(self):
+        if self.count < 2:
+            return np.full(self.mean.shape, np.nan)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    #Distribution of every metric: count, missing, mean, std (ToF jitter), min, max, spread
+    def distributions(self) -> dict:
+        return {name: statistic.summary() for name, statistic in self.metrics.items()}
+
+    #Metrics of the ensemble mean waveform
+    def meanMetrics(self) -> dict:
+        return capture_metrics(self.time_axis, self.mean)
+
+    #Mean, std and envelopes with the time axis as a numpy .npz file
+    def save(self, filename):
+        np.savez(filename, count=self.count, time=self.time_axis, mean=self.mean, std=self.std(), minimum=self.minimum,
+                 maximum=self.maximum)
+
+def main():
+    ensemble = WaveformEnsemble()
+    for filename in capture_files(sys.argv[1]):
+        ensemble.addFile(filename)
+    print("{} captures, {} without metrics".format(ensemble.count, ensemble.failed))
+    for name, summary in ensemble.distributions().items():
+        print("{:26} mean {mean:.6g} std {std:.6g} min {min:.6g} max {max:.6g} ({count} values, {missing} missing)".format(
+            name, **summary))
+    print("Metrics of the mean waveform: {}".format(ensemble.meanMetrics()))
+    if len(sys.argv) > 2:
+        ensemble.save(sys.argv[2])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#Binary capture files for the scope tools.
+#A capture stores the raw int16 codes of every channel as they came from :WAVeform:DATA? (WORD format) together with the
+#preambles and channel units, so a file is about 2 bytes per point instead of ~25 characters per value in CSV.
+#Layout: 64 byte header, one 64 byte record per channel, IDN string, the trigger time tags of a segmented capture
+#(float64 seconds per segment), then the codes as (channels, points) little endian int16 starting at a 64 byte aligned
+#offset. Segments follow each other in a channel's row. readCapture() memory maps the codes and scales them only when asked.
+#Version 1 files (magic SCPWFM01, no segments field) are still read.
+
+import os
+import time
+import numpy as np
+
+CAPTURE_MAGIC = b'SCPWFM02'
+CAPTURE_HEADER_SIZE = 64
+CAPTURE_HEADER = np.dtype([('magic', 'S8'), ('channels', '<u4'), ('points', '<u4'), ('x_increment', '<f8'), ('x_origin', '<f8'),
+                           ('x_reference', '<f8'), ('acq_type', 'S4'), ('idn_length', '<u2'), ('segments', '<u2'), ('data_offset', '<u8'),
+                           ('epoch_ns', '<i8')])
+#Version 1 files (before segmented captures): a u4 IDN length and no time tags
+CAPTURE_MAGIC_V1 = b'SCPWFM01'
+CAPTURE_HEADER_V1 = np.dtype([('magic', 'S8'), ('channels', '<u4'), ('points', '<u4'), ('x_increment', '<f8'), ('x_origin', '<f8'),
+                              ('x_reference', '<f8'), ('acq_type', 'S4'), ('idn_length', '<u4'), ('data_offset', '<u8'),
+                              ('epoch_ns', '<i8')])
+CHANNEL_RECORD = np.dtype([('channel', '<u4'), ('units', 'S12'), ('y_increment', '<f8'), ('y_origin', '<f8'), ('y_reference', '<f8'),
+                           ('reserved', 'V16')])
+capture_type = '.wfb'
+
+#codes: int16 array (channels, points), int8 codes of a BYTE export are widened. preambles: {channel: [format, type, points, count, xinc, xorig, xref, yinc, yorig, yref]}
+#time_tags: trigger time of every segment of a segmented capture (the rows of codes are then segments x points per segment)
+def writeCapture(filename, codes, channels, units, preambles, idn="", acq_type="NORM", epoch_ns=None, time_tags=None):
+    codes = np.asarray(codes, dtype='<i2')
+    pre = preambles[channels[0]]
+    idn = idn.encode()
+    time_tags = np.asarray(time_tags if time_tags is not None else [], dtype='<f8')
+    data_offset = CAPTURE_HEADER_SIZE + len(channels) * CHANNEL_RECORD.itemsize + len(idn) + time_tags.nbytes
+    data_offset += -data_offset % 64
+    header = np.zeros(1, dtype=CAPTURE_HEADER)
+    header['magic'] = CAPTURE_MAGIC
+    header['channels'] = len(channels)
+    header['points'] = codes.shape[1]
+    header['x_increment'] = pre[4]
+    header['x_origin'] = pre[5]
+    header['x_reference'] = pre[6]
+    header['acq_type'] = acq_type.encode()
+    header['idn_length'] = len(idn)
+    header['segments'] = len(time_tags)
+    header['data_offset'] = data_offset
+    header['epoch_ns'] = time.time_ns() if epoch_ns is None else epoch_ns
+    records = np.zeros(len(channels), dtype=CHANNEL_RECORD)
+    for i, ch in enumerate(channels):
+        records[i] = (ch, units[ch].encode(), preambles[ch][7], preambles[ch][8], preambles[ch][9], b'')
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(records.tobytes())
+        f.write(idn)
+        f.write(time_tags.tobytes())
+        f.write(b'\0' * (data_offset - f.tell()))
+        f.write(np.ascontiguousarray(codes).tobytes())
+
+#Scaled view of one channel: volts are computed from the mapped codes only for the part that is indexed
+class ScaledChannel:
+    def __init__(self, codes, y_increment, y_origin, y_reference):
+        self.codes = codes
+        self.y_increment = y_increment
+        self.y_origin = y_origin
+        self.y_reference = y_reference
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __getitem__(self, index):
+        return ((self.codes[index] - self.y_reference) * self.y_increment) + self.y_origin
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype) if dtype is not None else self[:]
+
+class WaveformCapture:
+    def __init__(self, path, info, records, codes, time_tags=None):
+        self.path = path
+        self.info = info
+        self.records = records
+        #(channels, points) int16, memory mapped
+        self.codes = codes
+        self.channels = [int(ch) for ch in records['channel']]
+        self.units = {int(r['channel']): r['units'].decode() for r in records}
+        #trigger time tags (s) of a segmented capture, one entry for a normal capture
+        self.time_tags = time_tags if time_tags is not None else np.zeros(1)
+        self.segment_points = info['points'] // len(self.time_tags)
+
+    def channel(self, ch) -> ScaledChannel:
+        i = self.channels.index(ch)
+        r = self.records[i]
+        return ScaledChannel(self.codes[i], float(r['y_increment']), float(r['y_origin']), float(r['y_reference']))
+
+    #Scaled view of one segment (0 based) of a channel
+    def segment(self, ch, index) -> ScaledChannel:
+        channel = self.channel(ch)
+        channel.codes = channel.codes[index * self.segment_points:(index + 1) * self.segment_points]
+        return channel
+
+    #Time axis of points start to stop, relative to each segment's trigger for segmented captures;
+    #peak detect captures hold a low and a high point per time bucket
+    def time(self, start=0, stop=None):
+        stop = self.info['points'] if stop is None else stop
+        bucket = np.arange(start, stop) % self.segment_points
+        if self.info['acq_type'] == 'PEAK':
+            bucket //= 2
+        return ((bucket - self.info['x_reference']) * self.info['x_increment']) + self.info['x_origin']
+
+    #Scaled (channels, points) float64 array of every channel, loaded fully
+    def volts(self):
+        return np.array([self.channel(ch)[:] for ch in self.channels])
+
+    def columnTitles(self) -> str:
+        return "Time (s)," + ",".join("Channel {} ({})".format(ch, self.units[ch]) for ch in self.channels)
+
+#Open a capture file (current or version 1 layout): header information plus the memory mapped codes
+def readCapture(path) -> WaveformCapture:
+    header = np.fromfile(path, dtype=CAPTURE_HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] not in (CAPTURE_MAGIC, CAPTURE_MAGIC_V1):
+        raise ValueError("{} is not a waveform capture file".format(path))
+    if header['magic'][0] == CAPTURE_MAGIC_V1:
+        header = np.fromfile(path, dtype=CAPTURE_HEADER_V1, count=1)
+    header = header[0]
+    channels = int(header['channels'])
+    records = np.fromfile(path, dtype=CHANNEL_RECORD, count=channels, offset=CAPTURE_HEADER_SIZE)
+    with open(path, 'rb') as f:
+        f.seek(CAPTURE_HEADER_SIZE + channels * CHANNEL_RECORD.itemsize)
+        idn = f.read(int(header['idn_length'])).decode()
+        segments = int(header['segments']) if 'segments' in header.dtype.names else 0
+        time_tags = np.frombuffer(f.read(8 * segments), dtype='<f8') if segments else None
+    info = {'channels': channels, 'points': int(header['points']), 'x_increment': float(header['x_increment']),
+            'x_origin': float(header['x_origin']), 'x_reference': float(header['x_reference']),
+            'acq_type': header['acq_type'].decode(), 'idn': idn, 'epoch_ns': int(header['epoch_ns']), 'segments': max(1, segments)}
+    codes = np.memmap(path, dtype='<i2', mode='r', offset=int(header['data_offset']), shape=(channels, info['points']))
+    return WaveformCapture(path, info, records, codes, time_tags)
+
+#Save every segment of a segmented capture as a capture of its own, "<name> - segment <n>.wfb" in directory.
+#Returns the file names.
+def splitSegments(path, directory):
+    capture = readCapture(path)
+    info = capture.info
+    preambles = {int(r['channel']): [0, 0, capture.segment_points, 1, info['x_increment'], info['x_origin'], info['x_reference'],
+                                     float(r['y_increment']), float(r['y_origin']), float(r['y_reference'])] for r in capture.records}
+    name = os.path.splitext(os.path.basename(path))[0]
+    files = []
+    for segment in range(len(capture.time_tags)):
+        filename = os.path.join(directory, "{} - segment {}{}".format(name, segment, capture_type))
+        codes = capture.codes[:, segment * capture.segment_points:(segment + 1) * capture.segment_points]
+        writeCapture(filename, codes, capture.channels, capture.units, preambles, info['idn'], info['acq_type'], info['epoch_ns'])
+        files.append(filename)
+    return files
+
+#Convert a capture to the CSV layout quickscan used to write (time axis + one scaled column per channel), in blocks of
+#rows so memory stays flat for long records
+def exportCsv(path, csv_path=None, rows_per_block=100000):
+    capture = readCapture(path)
+    csv_path = csv_path if csv_path != None else os.path.splitext(path)[0] + ".csv"
+    points = capture.info['points']
+    with open(csv_path, 'w') as f:
+        for start in range(0, points, rows_per_block):
+            stop = min(points, start + rows_per_block)
+            columns = [capture.time(start, stop)] + [capture.channel(ch)[start:stop] for ch in capture.channels]
+            np.savetxt(f, np.column_stack(columns), delimiter=',', header=capture.columnTitles() + "\n" if start == 0 else '')
+    return csv_path